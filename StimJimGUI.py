@@ -3,14 +3,10 @@ import logging
 
 import serial
 
-# noinspection PyUnresolvedReferences
-from PyQt5 import uic
 from PyQt5.QtWidgets import (
     QApplication,
 )
 
-# noinspection PyUnresolvedReferences
-import resources.resources
 from src.StimJim import discover_ports, choose_port_dialog, STIMJIM_SERIAL_BAUDRATE
 from src.GUI import StimJimGUI
 
@@ -52,6 +48,26 @@ if __name__ == "__main__":
                         default="localhost:37497")
     parser.add_argument("--no-broadcast", action="store_const", dest="broadcast", const=None,
                         help="Suppress broadcasting to OpenEphys GUI.")
+    parser.add_argument(
+        "--control-server",
+        help="start a local control server so that other processes can drive the StimJim. "
+        "ADDRESS is either unix:/path/to/socket, host:port or port (on localhost)",
+        metavar="ADDRESS",
+        default=None,
+    )
+    parser.add_argument(
+        "--closed-loop",
+        help="fire trains in response to events received on a local socket or named pipe, "
+        "as described in the JSON file CONFIG",
+        metavar="CONFIG",
+        default=None,
+    )
+    parser.add_argument(
+        "--device-process",
+        action="store_true",
+        help="run the serial communication with the StimJim in a separate process, "
+        "which keeps the connection open if the GUI crashes",
+    )
     args = parser.parse_args()
 
     level = LOGGING_LEVELS[
@@ -80,10 +96,23 @@ if __name__ == "__main__":
             "--port argument"
         )
 
-    serial_port = serial.Serial(args.port, baudrate=STIMJIM_SERIAL_BAUDRATE)
+    if args.device_process:
+        from src.DeviceProcess import DeviceProcessSerial
+
+        serial_port = DeviceProcessSerial(args.port, baudrate=STIMJIM_SERIAL_BAUDRATE)
+    else:
+        serial_port = serial.Serial(args.port, baudrate=STIMJIM_SERIAL_BAUDRATE)
 
     app = QApplication([])
-    mw = StimJimGUI(serial_port=serial_port, log_filename=args.log, broadcast=args.broadcast)
+    mw = StimJimGUI(
+        serial_port=serial_port,
+        log_filename=args.log,
+        broadcast=args.broadcast,
+        control_server=args.control_server,
+        closed_loop=args.closed_loop,
+    )
     mw.show()
     # Start the event loop.
     app.exec()
+    if args.device_process:
+        serial_port.close()
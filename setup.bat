@@ -11,6 +11,12 @@ echo 📦 Installing requirements...
 pip install --upgrade pip
 pip install -r requirements.txt
 
+echo 📦 Compiling the user interface forms...
+python -m src.UiForms
+
+echo 📦 Packing the icons...
+python -m src.Icons
+
 echo ✅ Setup complete!
 echo.
 echo ⚡ To run the application, activate the environment and provide a serial port:
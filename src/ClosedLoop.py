@@ -0,0 +1,280 @@
+"""
+Closed-loop triggering: fires StimJim trains in response to events (spikes, behavioural events...) sent by another
+process on a local socket or named pipe.
+
+Events are plain text tokens, one per line (or one per datagram), e.g. b"spike\\n". Each token is mapped to a rule,
+which holds the pre-encoded T/U command to send, and refractory/rate-limit settings.
+
+UDP works everywhere, unix datagram sockets and named pipes (FIFOs) only on POSIX systems (Linux, macOS).
+"""
+import bisect
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from src.StimJim import StimJim, STIMJIM_TRIGGER_COMMANDS, STIMJIM_MAX_PULSETRAINS, STIMJIM_N_TRIGGERS
+
+CLOSED_LOOP_POLL_INTERVAL_S = 0.1  # how often the listening thread checks if it should stop
+CLOSED_LOOP_READ_SIZE = 4096
+# upper edges of the latency histogram bins, in μs. Last bin collects everything above
+CLOSED_LOOP_HISTOGRAM_EDGES_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class ClosedLoopRule(object):
+    def __init__(
+        self, event, trigger=0, train=0, refractory_ms=0.0, max_rate_hz=None
+    ):
+        """
+        Raises ValueError if a field has the wrong type or is out of range
+        """
+        if not isinstance(event, str) or not event.strip():
+            raise ValueError(f"Closed-loop rule event must be a non-empty string, not {event!r}")
+        for name, value, maximum in [
+            ("trigger", trigger, STIMJIM_N_TRIGGERS - 1),
+            ("train", train, STIMJIM_MAX_PULSETRAINS - 1),
+        ]:
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= maximum:
+                raise ValueError(
+                    f"Closed-loop rule '{event}': {name} must be an integer between 0 and {maximum}, not {value!r}"
+                )
+        if isinstance(refractory_ms, bool) or not isinstance(refractory_ms, (int, float)) or refractory_ms < 0:
+            raise ValueError(f"Closed-loop rule '{event}': refractory_ms must be a number >= 0, not {refractory_ms!r}")
+        if max_rate_hz is not None and (
+            isinstance(max_rate_hz, bool) or not isinstance(max_rate_hz, (int, float)) or max_rate_hz <= 0
+        ):
+            raise ValueError(f"Closed-loop rule '{event}': max_rate_hz must be a number > 0, not {max_rate_hz!r}")
+        self.event = event
+        self.trigger = trigger
+        self.train = train
+        self.refractory_ms = refractory_ms
+        self.max_rate_hz = max_rate_hz
+        self.command = f"{STIMJIM_TRIGGER_COMMANDS[trigger]}{train:d}\n".encode()
+        self._refractory_ns = int(refractory_ms * 1e6)
+        # token bucket refilled at max_rate_hz tokens per second, allowing bursts of up to max_rate_hz events (at least
+        # one, so that rates below 1 Hz can fire)
+        self._capacity = None if max_rate_hz is None else max(1.0, max_rate_hz)
+        self._tokens = self._capacity
+        self._last_fired_ns = None
+        self._last_refill_ns = None
+
+    def __repr__(self):
+        return f"ClosedLoopRule [{self.event}] -> {self.command.strip().decode()}"
+
+    def accept(self, t_ns: int) -> bool:
+        if (
+            self._last_fired_ns is not None
+            and t_ns - self._last_fired_ns < self._refractory_ns
+        ):
+            return False
+        if self.max_rate_hz is not None:
+            if self._last_refill_ns is not None:
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (t_ns - self._last_refill_ns) * 1e-9 * self.max_rate_hz,
+                )
+            self._last_refill_ns = t_ns
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        self._last_fired_ns = t_ns
+        return True
+
+    def to_json(self):
+        return dict(
+            event=self.event,
+            trigger=self.trigger,
+            train=self.train,
+            refractory_ms=self.refractory_ms,
+            max_rate_hz=self.max_rate_hz,
+        )
+
+    @staticmethod
+    def from_json(json_dict):
+        try:
+            return ClosedLoopRule(**json_dict)
+        except TypeError as e:  # missing or unknown field
+            raise ValueError(f"Invalid closed-loop rule {json_dict!r} ({e})") from e
+
+
+class LatencyHistogram(object):
+    def __init__(self, edges_us=None):
+        self.edges_ns = [
+            int(e * 1e3)
+            for e in (CLOSED_LOOP_HISTOGRAM_EDGES_US if edges_us is None else edges_us)
+        ]
+        self.counts = [0] * (len(self.edges_ns) + 1)
+        self.n = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, latency_ns: int):
+        self.counts[bisect.bisect_left(self.edges_ns, latency_ns)] += 1
+        self.n += 1
+        self.total_ns += latency_ns
+        self.max_ns = max(self.max_ns, latency_ns)
+
+    def summary(self) -> str:
+        if self.n == 0:
+            return "no event"
+        lines = [
+            f"{self.n} events, mean {self.total_ns / self.n / 1e3:.1f} μs, max {self.max_ns / 1e3:.1f} μs"
+        ]
+        lower = 0
+        for edge, count in zip(self.edges_ns + [None], self.counts):
+            label = f"{lower / 1e3:g}-{edge / 1e3:g} μs" if edge is not None else f">{lower / 1e3:g} μs"
+            lines.append(f"  {label:>16}: {count}")
+            lower = edge
+        return "\n".join(lines)
+
+
+class ClosedLoopTrigger(object):
+    """
+    Listens for events on ADDRESS, which is either "udp:host:port", "unix:/path/to/socket" (datagram socket)
+    or "fifo:/path/to/named/pipe", and fires the matching rule
+    """
+
+    def __init__(self, stimjim: StimJim, address: str, rules, on_error=None):
+        self.stimjim = stimjim
+        self.address = address
+        self.rules = {rule.event.encode(): rule for rule in rules}
+        # called from the listening thread with a message when an event cannot be handled
+        self.on_error = on_error
+        self.histogram = LatencyHistogram()
+        self.n_fired = 0
+        self.n_rejected = 0
+        self.n_unknown = 0
+        self.n_errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._fd = None
+        self._sock = None
+
+    @staticmethod
+    def from_json(stimjim: StimJim, json_dict, on_error=None):
+        try:
+            address, rules = json_dict["address"], json_dict["rules"]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"A closed-loop configuration needs an address and rules ({e})") from e
+        return ClosedLoopTrigger(stimjim, address, [ClosedLoopRule.from_json(d) for d in rules], on_error=on_error)
+
+    @staticmethod
+    def from_file(stimjim: StimJim, filename: str, on_error=None):
+        with open(filename, "r") as f:
+            return ClosedLoopTrigger.from_json(stimjim, json.load(f), on_error=on_error)
+
+    def start(self):
+        self._open()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimClosedLoop", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Closed-loop trigger listening on {self.address} with rules {list(self.rules.values())}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        self._close()
+
+    def summary(self) -> str:
+        return (
+            f"Closed loop: {self.n_fired} fired, {self.n_rejected} rejected (refractory/rate), "
+            f"{self.n_unknown} unknown events, {self.n_errors} errors\n"
+            f"Event to serial write latency: {self.histogram.summary()}"
+        )
+
+    def _open(self):
+        kind, _, target = self.address.partition(":")
+        if kind in ("unix", "fifo") and os.name != "posix":
+            raise ValueError(
+                f"'{kind}:' closed-loop addresses are only supported on Linux and macOS, use udp:host:port instead"
+            )
+        if kind == "udp":
+            host, _, port = target.rpartition(":")
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind((host or "127.0.0.1", int(port)))
+        elif kind == "unix":
+            if os.path.exists(target):
+                os.remove(target)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(target)
+        elif kind == "fifo":
+            if not os.path.exists(target):
+                os.mkfifo(target)
+            # opening read-write means we never see EOF when writers come and go
+            self._fd = os.open(target, os.O_RDWR | os.O_NONBLOCK)
+        else:
+            raise ValueError(f"Unknown closed-loop address '{self.address}'")
+        if self._sock is not None:
+            self._sock.setblocking(False)
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            if self.address.startswith("unix:"):
+                os.remove(self.address[len("unix:") :])
+        if self._fd is not None:
+            os.close(self._fd)
+        self._sock = None
+        self._fd = None
+
+    def _read(self) -> bytes:
+        if self._sock is not None:
+            # sockets cannot be read with os.read on Windows
+            return self._sock.recv(CLOSED_LOOP_READ_SIZE)
+        return os.read(self._fd, CLOSED_LOOP_READ_SIZE)
+
+    def _run(self):
+        buffer = b""
+        source = self._sock if self._sock is not None else self._fd
+        while not self._stop.is_set():
+            ready, _, _ = select.select([source], [], [], CLOSED_LOOP_POLL_INTERVAL_S)
+            if not ready:
+                continue
+            try:
+                data = self._read()
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on a UDP socket, the next datagrams can still be read
+                self._report_error(f"Closed loop: error reading from {self.address} ({e})")
+                continue
+            t_arrival = time.monotonic_ns()
+            if self._sock is not None:
+                # each datagram is a complete message
+                events = data.split(b"\n")
+            else:
+                *events, buffer = (buffer + data).split(b"\n")
+            for event in events:
+                try:
+                    self._on_event(event.strip(), t_arrival)
+                except Exception as e:
+                    self._report_error(f"Closed loop: error handling event {event!r} ({type(e).__name__}: {e})")
+
+    def _report_error(self, message: str):
+        self.n_errors += 1
+        logger.exception(message)
+        if self.on_error is not None:
+            self.on_error(message)
+
+    def _on_event(self, event: bytes, t_arrival: int):
+        if not event:
+            return
+        rule = self.rules.get(event)
+        if rule is None:
+            self.n_unknown += 1
+            return
+        if not rule.accept(t_arrival):
+            self.n_rejected += 1
+            return
+        self.stimjim.write(rule.command)
+        self.histogram.record(time.monotonic_ns() - t_arrival)
+        self.n_fired += 1
@@ -0,0 +1,122 @@
+"""
+Configuration banks: the device slots are partitioned into banks, and several configurations are uploaded at once,
+one per bank. Switching the active configuration then only takes a few R (trigger retarget) commands.
+
+The banks are written to the slots of the Full Mode model: uploading a bank also replaces the trains of its slots in
+the model, and switching to a bank also replaces its triggers, so that the model keeps matching the device. Like in
+Full Mode, trains with validation errors are never uploaded: a configuration containing one is refused.
+"""
+import logging
+import time
+from typing import List
+
+from src.StimJim import (
+    StimJim,
+    PulseTrain,
+    Trigger,
+    STIMJIM_MAX_PULSETRAINS,
+)
+from src.Validation import ValidationLimits, Severity, validate
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class StimJimBankFullException(Exception):
+    pass
+
+
+class ConfigBank(object):
+    def __init__(self, name: str, slots: range):
+        self.name = name
+        self.slots = slots
+        self.train_map = {}  # train id in the configuration -> device slot
+        self.pulse_trains = []  # trains of the configuration, renumbered to their slot
+        self.triggers = []  # triggers of the configuration, retargeted to the slots
+        self.upload_commands = []
+        self.switch_command = b""
+
+    def __repr__(self):
+        return f"ConfigBank [{self.name}] slots {self.slots.start}-{self.slots.stop - 1}: {len(self.train_map)} trains"
+
+    def get_slot(self, train_id: int) -> int:
+        return self.train_map.get(train_id, -1)
+
+
+class ConfigBanks(object):
+    def __init__(self, stimjim: StimJim, n_banks: int, limits: ValidationLimits = None):
+        if not 1 <= n_banks <= STIMJIM_MAX_PULSETRAINS:
+            raise ValueError(f"The number of banks must be between 1 and {STIMJIM_MAX_PULSETRAINS}, not {n_banks}")
+        self.stimjim = stimjim
+        self.limits = limits
+        bank_size = STIMJIM_MAX_PULSETRAINS // n_banks
+        self.banks = [
+            ConfigBank("", range(i * bank_size, (i + 1) * bank_size))
+            for i in range(n_banks)
+        ]
+        self.active = None
+        self.last_switch_ns = None
+
+    def load(self, bank_index: int, json_dict: dict, name: str = "") -> ConfigBank:
+        """
+        Prepares the bank from a configuration in the StimJim.to_json() format. Only the trains that have stages,
+        or that are targeted by a trigger, are placed in the bank. Raises ValueError if one of them is not valid
+        """
+        from src.TrainArrays import TrainArrays
+
+        bank = self.banks[bank_index]
+        bank.name = name
+        pulse_trains = [PulseTrain.from_json(d) for d in json_dict["pulse_trains"]]
+        triggers = [Trigger.from_json(d) for d in json_dict["triggers"]]
+        targets = {trigger.train_target for trigger in triggers}
+        used = [pt for pt in pulse_trains if pt.stages or pt.train_id in targets]
+        if len(used) > len(bank.slots):
+            raise StimJimBankFullException(
+                f"Configuration '{name}' uses {len(used)} trains but banks only have {len(bank.slots)} slots"
+            )
+        errors = [
+            f"train {used[d.train].train_id} [{d.rule}] {d.message}"
+            for d in validate(TrainArrays.from_pulse_trains(used), self.limits)
+            if d.severity == Severity.ERROR
+        ]
+        if errors:
+            raise ValueError(f"Configuration '{name}' is not valid: {'; '.join(errors)}")
+        bank.train_map = {pt.train_id: slot for pt, slot in zip(used, bank.slots)}
+        bank.upload_commands = []
+        for pt in used:
+            pt.train_id = bank.train_map[pt.train_id]
+            bank.upload_commands.append(pt.get_stimjim_string())
+        for trigger in triggers:
+            trigger.train_target = bank.get_slot(trigger.train_target)
+        bank.pulse_trains = used
+        bank.triggers = [trigger for trigger in triggers if 0 <= trigger.trig_id < len(self.stimjim.triggers)]
+        bank.switch_command = "".join(
+            trigger.get_stimjim_string() + "\n" for trigger in triggers
+        ).encode()
+        return bank
+
+    def upload(self, bank_indices: List[int] = None):
+        """
+        Uploads the trains of the banks (all by default) in a single write, and puts them in the model
+        """
+        if bank_indices is None:
+            bank_indices = range(len(self.banks))
+        commands = [c for i in bank_indices for c in self.banks[i].upload_commands]
+        for i in bank_indices:
+            for pt in self.banks[i].pulse_trains:
+                self.stimjim.pulse_trains[pt.train_id] = pt
+        if commands:
+            self.stimjim.send_commands(commands)
+
+    def switch(self, bank_index: int) -> int:
+        """
+        Makes the configuration of that bank active, and returns the time it took (in ns)
+        """
+        bank = self.banks[bank_index]
+        t0 = time.perf_counter_ns()
+        self.stimjim.write(bank.switch_command)
+        self.last_switch_ns = time.perf_counter_ns() - t0
+        for trigger in bank.triggers:
+            self.stimjim.triggers[trigger.trig_id] = Trigger(trigger.trig_id, trigger.trig_direction, trigger.train_target)
+        self.active = bank_index
+        logger.info(f"Switched to {bank} in {self.last_switch_ns / 1e3:.1f} μs")
+        return self.last_switch_ns
@@ -0,0 +1,178 @@
+"""
+Loading of configuration files (in the StimJimGUI.to_json() format) off the GUI thread.
+
+The file is parsed and validated in a background thread, then the complete state of the active tab (all its trains
+and triggers) is sent to the device as one burst: the commands are written in chunks of whole commands, with a short
+pause between chunks so that the StimJim can parse them as they arrive. Only then are the widgets refreshed, from
+on_finished. The time taken by each step is kept, to report the load time.
+"""
+import json
+import logging
+import threading
+import time
+from typing import List
+
+from src.StimJim import StimJim, StimJimTooManyStagesException, STIMJIM_N_OUTPUTS
+from src.Validation import ValidationLimits, validate_stimjim, has_errors
+
+CONFIG_BURST_CHUNK_BYTES = 512
+CONFIG_BURST_PAUSE_S = 0.002
+CONFIG_SIMPLE_MODE_TAB = 0
+CONFIG_FULL_MODE_TAB = 1
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class ConfigLoadError(Exception):
+    pass
+
+
+class LoadedConfig(object):
+    def __init__(self, json_dict: dict, serial_port):
+        try:
+            self.current_tab = json_dict.get("CurrentTab")
+            self.full_stimjim = StimJim(serial_port)
+            self.full_stimjim.from_json(json_dict=json_dict["FullMode"])
+            self.simple_stimjim = StimJim(serial_port)
+            self.simple_stimjim.from_json(json_dict=json_dict["SimpleMode"])
+            self.limits = (
+                ValidationLimits.from_json(json_dict["SafetyLimits"])
+                if "SafetyLimits" in json_dict
+                else None
+            )
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError, StimJimTooManyStagesException) as e:
+            raise ConfigLoadError(f"invalid configuration ({type(e).__name__}: {e})") from e
+
+
+def write_paced(
+    stimjim: StimJim,
+    commands: List[str],
+    chunk_bytes: int = CONFIG_BURST_CHUNK_BYTES,
+    pause_s: float = CONFIG_BURST_PAUSE_S,
+    stop_event: threading.Event = None,
+) -> int:
+    """
+    Writes the commands in chunks of at most chunk_bytes (a single command can be longer), without splitting commands.
+    Returns the number of bytes written
+    """
+    chunks = [b""]
+    for command in commands:
+        data = command.encode()
+        if chunks[-1] and len(chunks[-1]) + len(data) > chunk_bytes:
+            chunks.append(b"")
+        chunks[-1] += data
+    n_bytes = 0
+    for i, chunk in enumerate(chunks):
+        if i > 0:
+            if stop_event is None:
+                time.sleep(pause_s)
+            elif stop_event.wait(pause_s):
+                break
+        stimjim.write(chunk)
+        n_bytes += len(chunk)
+    return n_bytes
+
+
+class ConfigLoader(object):
+    def __init__(
+        self,
+        filename: str,
+        serial_port,
+        current_tab: int,
+        limits: ValidationLimits = None,
+        on_finished=None,
+    ):
+        """
+        Loads filename and sends the state of the tab that will be active (the one saved in the file, or current_tab)
+        to the device. limits are used unless the file has its own safety limits. on_finished(loader) is called from
+        the loading thread when done, with either config or error set
+        """
+        self.filename = filename
+        self.serial_port = serial_port
+        self.current_tab = current_tab
+        self.limits = limits
+        self.on_finished = on_finished
+        self.config = None
+        self.error = None
+        self.diagnostics = []
+        self.skipped_trains = []  # trains with validation errors, not uploaded
+        self.n_bytes = 0
+        self.parse_ns = 0
+        self.validate_ns = 0
+        self.upload_ns = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimConfigLoader", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def total_ns(self) -> int:
+        return self.parse_ns + self.validate_ns + self.upload_ns
+
+    def summary(self) -> str:
+        return (
+            f"Loaded {self.filename} in {self.total_ns / 1e6:.1f} ms (parse {self.parse_ns / 1e6:.1f} ms, "
+            f"validation {self.validate_ns / 1e6:.1f} ms, upload of {self.n_bytes} bytes {self.upload_ns / 1e6:.1f} ms)"
+        )
+
+    def _run(self):
+        try:
+            self._load()
+        except (OSError, ValueError, ConfigLoadError) as e:
+            # json.JSONDecodeError is a ValueError
+            self.error = f"{self.filename}: {e}"
+            logger.debug(f"Error while loading config file: {self.error}")
+        except Exception as e:
+            # an unexpected error must not leave the GUI waiting for a loader that died
+            self.error = f"{self.filename}: unexpected error ({type(e).__name__}: {e})"
+            logger.exception(f"Error while loading config file {self.filename}")
+        finally:
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def _load(self):
+        t0 = time.perf_counter_ns()
+        with open(self.filename, "r") as f:
+            json_dict = json.load(f)
+        config = LoadedConfig(json_dict, self.serial_port)
+        if config.current_tab is not None:
+            self.current_tab = config.current_tab
+        if config.limits is not None:
+            self.limits = config.limits
+        t1 = time.perf_counter_ns()
+        self.parse_ns = t1 - t0
+
+        if self.current_tab == CONFIG_FULL_MODE_TAB:
+            stimjim = config.full_stimjim
+            train_ids = range(len(stimjim.pulse_trains))
+        else:
+            stimjim = config.simple_stimjim
+            train_ids = range(STIMJIM_N_OUTPUTS)
+        self.diagnostics = validate_stimjim(stimjim, self.limits)
+        self.skipped_trains = [i for i in train_ids if has_errors(self.diagnostics, i)]
+        commands = stimjim.get_state_commands(train_ids, excluded=self.skipped_trains)
+        t2 = time.perf_counter_ns()
+        self.validate_ns = t2 - t1
+
+        for train_id in self.skipped_trains:
+            logger.warning(f"Pulse train {train_id} is not valid, it was not uploaded")
+        self.n_bytes = write_paced(stimjim, commands, stop_event=self._stop)
+        self.upload_ns = time.perf_counter_ns() - t2
+        self.config = config
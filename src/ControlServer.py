@@ -0,0 +1,390 @@
+"""
+Local control server, allowing other processes to drive the StimJim while the GUI owns the serial port.
+
+The protocol is line-delimited JSON: each request is a JSON object on a single line, with a "cmd" key and an
+optional "id" key which is echoed in the reply. Replies are {"id": ..., "ok": true, ...} or
+{"id": ..., "ok": false, "error": "..."}. Clients that sent {"cmd": "subscribe"} also receive device events as
+{"event": "serial", "text": "...", "t_ns": ...} lines.
+
+Trains sent by clients go through the same validation as Full Mode (see src.Validation): a train with errors is
+rejected with an error reply, and neither uploaded nor stored. S and R commands sent with "send" are parsed and
+handled like "set_train" and "set_trigger".
+
+The model is only read and modified in the thread that owns it (the GUI thread, see call_in_owner), and is only
+uploaded while it is the state of the device (see is_active).
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from src.StimJim import (
+    StimJim,
+    PulseTrain,
+    STIMJIM_TRIGGER_COMMANDS,
+    STIMJIM_MAX_PULSETRAINS,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_N_TRIGGERS,
+    StimJimOutputModes,
+    StimJimTrigDirection,
+    StimJimTooManyStagesException,
+    PulseStage,
+)
+from src.Validation import ValidationLimits, Severity, validate
+
+CONTROL_SERVER_DEFAULT_HOST = "127.0.0.1"
+CONTROL_SERVER_START_TIMEOUT_S = 5.0
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class StimJimControlServerError(Exception):
+    pass
+
+
+def parse_train_command(command: str) -> PulseTrain:
+    """
+    Parses a S command ("S<train>,<mode0>,<mode1>,<period>,<duration>;<amp0>,<amp1>,<duration>;...").
+    Raises ValueError if it is not valid
+    """
+    try:
+        header, *stages = command.strip()[1:].split(";")
+        train_id, mode0, mode1, period_us, duration_us = (int(x) for x in header.split(","))
+        pulse_train = PulseTrain(
+            train_id,
+            train_period_us=period_us,
+            train_duration_us=duration_us,
+            channel_modes=[StimJimOutputModes(mode0), StimJimOutputModes(mode1)],
+        )
+        for stage in stages:
+            ch0_amp, ch1_amp, stage_duration_us = (int(x) for x in stage.split(","))
+            pulse_train.add_stage(PulseStage(ch0_amp, ch1_amp, stage_duration_us))
+    except (ValueError, StimJimTooManyStagesException) as e:
+        raise ValueError(f"Invalid pulse train command '{command.strip()}' ({e})") from e
+    return pulse_train
+
+
+def parse_trigger_command(command: str):
+    """
+    Parses a R command ("R<trigger>,<train>[,<direction>]"), returns (trigger, train, direction or None).
+    Raises ValueError if it is not valid
+    """
+    try:
+        fields = [int(x) for x in command.strip()[1:].split(",")]
+        if len(fields) not in (2, 3):
+            raise ValueError("expected 2 or 3 fields")
+    except ValueError as e:
+        raise ValueError(f"Invalid trigger command '{command.strip()}' ({e})") from e
+    return fields[0], fields[1], fields[2] if len(fields) == 3 else None
+
+
+def parse_address(address: str):
+    """
+    Parses a control server address, either "unix:/path/to/socket", "host:port" or just "port"
+    Returns a tuple ("unix", path) or ("tcp", host, port)
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    return "tcp", host or CONTROL_SERVER_DEFAULT_HOST, int(port)
+
+
+class StimJimControlServer(object):
+    def __init__(self, stimjim: StimJim, address: str, on_state_changed=None, call_in_owner=None, is_active=None):
+        self.stimjim = stimjim
+        self.address = parse_address(address)
+        # called from the thread owning the model with the id of the modified train (or None for triggers)
+        self.on_state_changed = on_state_changed
+        # call_in_owner(function, *args) runs function in the thread owning the model and returns a
+        # concurrent.futures.Future of its result. By default, the model is owned by the server thread
+        self.call_in_owner = call_in_owner
+        # is_active() is called from the thread owning the model, and returns False while the model is not the state of
+        # the device (e.g. the Simple Mode tab is displayed): edits are then only stored, and uploaded by the owner
+        self.is_active = is_active
+        self.validation_limits = None  # the safety limits of the GUI, see _check_train
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._clients = set()
+        self._subscribers = set()
+        self._started = threading.Event()
+        self._start_error = None
+
+    def start(self):
+        if self.address[0] == "unix":
+            if os.name != "posix":
+                raise StimJimControlServerError(
+                    "unix: control server addresses are only supported on Linux and macOS, use host:port instead"
+                )
+            self._remove_stale_socket(self.address[1])
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimControlServer", daemon=True
+        )
+        self._thread.start()
+        self._started.wait(CONTROL_SERVER_START_TIMEOUT_S)
+        if self._start_error is not None:
+            raise StimJimControlServerError(
+                f"Could not start control server on {self.address}: {self._start_error}"
+            )
+        logger.info(f"Control server listening on {self.address}")
+
+    @staticmethod
+    def _remove_stale_socket(path: str):
+        """
+        Removes the socket file left behind by a server that did not stop cleanly, so that it can be bound again.
+        Raises StimJimControlServerError if another server is listening on it
+        """
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            logger.info(f"Removing stale control server socket {path}")
+            os.remove(path)
+            return
+        except OSError:
+            return  # not a socket, binding will report it
+        finally:
+            probe.close()
+        # asyncio would silently replace the socket of the running server
+        raise StimJimControlServerError(f"Another control server is already listening on {path}")
+
+    def stop(self):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(CONTROL_SERVER_START_TIMEOUT_S)
+        self._thread = None
+
+    def publish(self, text: str, t_ns: int = None):
+        """
+        Sends device output to all the subscribed clients, with the time it was read (time.monotonic_ns(), now by
+        default). Can be called from any thread
+        """
+        if self._loop is None or not self._subscribers:
+            return
+        line = json.dumps({"event": "serial", "text": text, "t_ns": time.monotonic_ns() if t_ns is None else t_ns})
+        self._loop.call_soon_threadsafe(self._broadcast, (line + "\n").encode())
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(self._start_server())
+        except OSError as e:
+            self._start_error = e
+            self._started.set()
+            self._loop.close()
+            return
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            # closing the connections lets the client handlers return on their own
+            for writer in list(self._clients):
+                writer.close()
+            tasks = asyncio.all_tasks(self._loop)
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+            if self.address[0] == "unix" and os.path.exists(self.address[1]):
+                os.remove(self.address[1])
+
+    async def _start_server(self):
+        if self.address[0] == "unix":
+            return await asyncio.start_unix_server(self._handle_client, path=self.address[1])
+        return await asyncio.start_server(
+            self._handle_client, host=self.address[1], port=self.address[2]
+        )
+
+    def _broadcast(self, data: bytes):
+        for writer in list(self._subscribers):
+            if writer.is_closing():
+                self._subscribers.discard(writer)
+            else:
+                writer.write(data)
+
+    async def _handle_client(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            # replies are tiny, don't let Nagle's algorithm hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = writer.get_extra_info("peername")
+        logger.debug(f"Control server: client {peer} connected")
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                reply = await self._handle_line(line, writer)
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(writer)
+            self._subscribers.discard(writer)
+            writer.close()
+            logger.debug(f"Control server: client {peer} disconnected")
+
+    async def _handle_line(self, line: bytes, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            reply = await self._dispatch(request, writer)
+            reply["ok"] = True
+        except Exception as e:
+            reply = dict(ok=False, error=f"{type(e).__name__}: {e}")
+        reply["id"] = request_id
+        return reply
+
+    async def _dispatch(self, request: dict, writer):
+        cmd = request["cmd"]
+        if cmd == "ping":
+            return dict(t_ns=time.monotonic_ns())
+        elif cmd == "subscribe":
+            self._subscribers.add(writer)
+            return dict()
+        elif cmd == "unsubscribe":
+            self._subscribers.discard(writer)
+            return dict()
+        elif cmd == "send":
+            # parsed before anything is sent, so that an invalid line rejects the whole request
+            calls = []
+            for line in str(request["command"]).splitlines():
+                if line.startswith("S"):
+                    calls.append((self._set_train, parse_train_command(line)))
+                elif line.startswith("R"):
+                    calls.append((self._set_trigger, *parse_trigger_command(line)))
+                elif line.strip():
+                    calls.append((self.stimjim.send_command, line))
+            await self._call_in_owner(self._call_all, calls)
+            return dict()
+        elif cmd == "get_train":
+            return dict(train=await self._call_in_owner(self._get_train, self._train_id(request["train"])))
+        elif cmd == "set_train":
+            await self._call_in_owner(self._set_train, PulseTrain.from_json(request["train"]))
+            return dict()
+        elif cmd == "set_amplitude":
+            await self._call_in_owner(
+                self._set_amplitude,
+                self._train_id(request["train"]),
+                request["stage"],
+                self._index(request["channel"], STIMJIM_N_OUTPUTS, "Channel"),
+                int(request["value"]),
+            )
+            return dict()
+        elif cmd == "get_trigger":
+            return dict(trigger=await self._call_in_owner(self._get_trigger, self._trig_id(request["trigger"])))
+        elif cmd == "set_trigger":
+            direction = request.get("direction")
+            await self._call_in_owner(
+                self._set_trigger,
+                self._trig_id(request["trigger"]),
+                int(request["train"]),
+                None if direction is None else int(direction),
+            )
+            return dict()
+        elif cmd == "fire":
+            trig_id = self._trig_id(request["trigger"])
+            train_id = request.get("train")
+            if train_id is None:
+                train_id = await self._call_in_owner(lambda: self.stimjim.triggers[trig_id].train_target)
+            self.stimjim.send_command(f"{STIMJIM_TRIGGER_COMMANDS[trig_id]}{int(train_id)}")
+            return dict()
+        elif cmd == "cancel":
+            trig_id = self._trig_id(request["trigger"])
+            self.stimjim.send_command(f"{STIMJIM_TRIGGER_COMMANDS[trig_id]}-1")
+            return dict()
+        raise ValueError(f"Unknown command '{cmd}'")
+
+    async def _call_in_owner(self, function, *args):
+        if self.call_in_owner is None:
+            return function(*args)
+        return await asyncio.wrap_future(self.call_in_owner(function, *args))
+
+    #
+    # Called in the thread owning the model
+    #
+    @staticmethod
+    def _call_all(calls):
+        for function, *args in calls:
+            function(*args)
+
+    def _get_train(self, train_id: int):
+        return self.stimjim.pulse_trains[train_id].to_json()
+
+    def _get_trigger(self, trig_id: int):
+        return self.stimjim.triggers[trig_id].to_json()
+
+    def _set_train(self, pulse_train: PulseTrain):
+        self._train_id(pulse_train.train_id)
+        self._check_train(pulse_train)
+        self.stimjim.pulse_trains[pulse_train.train_id] = pulse_train
+        if self._is_active():
+            self.stimjim.send_command(pulse_train.get_stimjim_string())
+        self._notify(pulse_train.train_id)
+
+    def _set_amplitude(self, train_id: int, stage_index, channel: int, value: int):
+        # modified on a copy, so that an invalid amplitude leaves the model untouched
+        pulse_train = PulseTrain.from_json(self.stimjim.pulse_trains[train_id].to_json())
+        pulse_train.stages[self._index(stage_index, len(pulse_train.stages), "Stage")].channel_amps[channel] = value
+        self._set_train(pulse_train)
+
+    def _set_trigger(self, trig_id: int, train_id: int, direction=None):
+        self._trig_id(trig_id)
+        trigger = self.stimjim.triggers[trig_id]
+        direction = StimJimTrigDirection(trigger.trig_direction if direction is None else direction)
+        trigger.train_target = train_id
+        trigger.trig_direction = direction
+        if self._is_active():
+            self.stimjim.send_command(trigger.get_stimjim_string())
+        self._notify(None)
+
+    def _is_active(self) -> bool:
+        return self.is_active is None or self.is_active()
+
+    def _notify(self, train_id):
+        if self.on_state_changed is not None:
+            self.on_state_changed(train_id)
+
+    def _check_train(self, pulse_train: PulseTrain):
+        """
+        Raises ValueError if the train has validation errors, like Full Mode it must then not be uploaded
+        """
+        from src.TrainArrays import TrainArrays
+
+        limits = self.validation_limits if self.validation_limits is not None else ValidationLimits()
+        diagnostics = validate(TrainArrays.from_pulse_trains([pulse_train]), limits)
+        errors = [f"[{d.rule}] {d.message}" for d in diagnostics if d.severity == Severity.ERROR]
+        if errors:
+            raise ValueError(f"Pulse train {pulse_train.train_id} is not valid: {'; '.join(errors)}")
+
+    @staticmethod
+    def _index(value, n: int, name: str):
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value < n:
+            raise ValueError(f"{name} must be an integer between 0 and {n - 1}, not {value!r}")
+        return value
+
+    @staticmethod
+    def _train_id(value):
+        value = int(value)
+        if not 0 <= value < STIMJIM_MAX_PULSETRAINS:
+            raise ValueError(f"Train id must be between 0 and {STIMJIM_MAX_PULSETRAINS - 1}")
+        return value
+
+    @staticmethod
+    def _trig_id(value):
+        value = int(value)
+        if not 0 <= value < STIMJIM_N_TRIGGERS:
+            raise ValueError(f"Trigger id must be between 0 and {STIMJIM_N_TRIGGERS - 1}")
+        return value
@@ -0,0 +1,349 @@
+"""
+Runs the StimJim serial I/O in a separate process, so that reads, writes and event timestamps are not delayed by the
+GIL or by the GUI repainting, and so that a GUI crash does not close the serial port.
+
+The device process owns the serial port and two shared-memory ring buffers: one carrying commands from the GUI to
+the device, the other carrying timestamped device output back to the GUI. DeviceProcessSerial exposes the
+small subset of the serial.Serial API used by StimJim, so it can be used in its place.
+"""
+import argparse
+import logging
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import serial
+
+from src.StimJim import STIMJIM_SERIAL_BAUDRATE
+
+DEVICE_RING_SIZE = 1 << 20
+DEVICE_POLL_INTERVAL_S = 0.0005
+DEVICE_START_TIMEOUT_S = 5.0
+DEVICE_HEARTBEAT_TIMEOUT_S = 1.0  # a device process that has not updated its heartbeat for that long is dead
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class DeviceProcessError(Exception):
+    pass
+
+
+class SharedRingBuffer(object):
+    """
+    Single-producer / single-consumer ring of timestamped records in shared memory.
+    The producer only ever updates the write counter and the consumer the read counter, so no lock is needed
+    """
+
+    # header: capacity, write counter, read counter, closed flag, heartbeat (ns), dropped records (all uint64)
+    HEADER_SIZE = 64
+    RECORD_HEADER = struct.Struct("<IQ")  # payload length, timestamp (ns)
+    _WRITE, _READ, _CLOSED, _HEARTBEAT, _DROPPED = (8, 16, 24, 32, 40)
+
+    def __init__(self, name: str, create: bool = False, size: int = DEVICE_RING_SIZE):
+        if create:
+            self._shm = shared_memory.SharedMemory(
+                name=name, create=True, size=self.HEADER_SIZE + size
+            )
+            self._shm.buf[: self.HEADER_SIZE] = bytes(self.HEADER_SIZE)
+            struct.pack_into("<Q", self._shm.buf, 0, size)
+        else:
+            self._shm = _attach_shared_memory(name)
+        self._owner = create
+        self._buf = self._shm.buf
+        self.capacity = struct.unpack_from("<Q", self._buf, 0)[0]
+        self._data = self._buf[self.HEADER_SIZE : self.HEADER_SIZE + self.capacity]
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def _get(self, offset) -> int:
+        return struct.unpack_from("<Q", self._buf, offset)[0]
+
+    def _set(self, offset, value: int):
+        struct.pack_into("<Q", self._buf, offset, value)
+
+    @property
+    def closed(self) -> bool:
+        return self._get(self._CLOSED) != 0
+
+    @closed.setter
+    def closed(self, value: bool):
+        self._set(self._CLOSED, int(value))
+
+    @property
+    def heartbeat_ns(self) -> int:
+        return self._get(self._HEARTBEAT)
+
+    def beat(self):
+        self._set(self._HEARTBEAT, time.monotonic_ns())
+
+    @property
+    def dropped(self) -> int:
+        return self._get(self._DROPPED)
+
+    def _copy_in(self, position: int, data: bytes):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._data[start : start + first] = data[:first]
+        self._data[: len(data) - first] = data[first:]
+
+    def _copy_out(self, position: int, n: int) -> bytes:
+        start = position % self.capacity
+        first = min(n, self.capacity - start)
+        return bytes(self._data[start : start + first]) + bytes(self._data[: n - first])
+
+    def put(self, payload: bytes, t_ns: int) -> bool:
+        write = self._get(self._WRITE)
+        size = self.RECORD_HEADER.size + len(payload)
+        if size > self.capacity - (write - self._get(self._READ)):
+            self._set(self._DROPPED, self.dropped + 1)
+            return False
+        self._copy_in(write, self.RECORD_HEADER.pack(len(payload), t_ns) + payload)
+        self._set(self._WRITE, write + size)
+        return True
+
+    def get(self):
+        """
+        Returns the oldest record as a tuple (t_ns, payload), or None if the ring is empty
+        """
+        read = self._get(self._READ)
+        if read == self._get(self._WRITE):
+            return None
+        length, t_ns = self.RECORD_HEADER.unpack(
+            self._copy_out(read, self.RECORD_HEADER.size)
+        )
+        payload = self._copy_out(read + self.RECORD_HEADER.size, length)
+        self._set(self._READ, read + self.RECORD_HEADER.size + length)
+        return t_ns, payload
+
+    def close(self, unlink: bool = False):
+        """
+        Detaches from the ring. The ring is also removed if this object created it, or if unlink is True (e.g. the
+        ring of a dead device process)
+        """
+        self._data.release()
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        elif unlink:
+            if os.name == "posix" and getattr(self._shm, "_track", True):
+                # Python < 3.13: the segment was unregistered when attached, unlink() unregisters it again
+                # noinspection PyProtectedMember
+                resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 always registers the segment, which would then be unlinked when we exit
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            # noinspection PyProtectedMember
+            resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def ring_names(port: str):
+    stem = "stimjim_" + re.sub(r"[^A-Za-z0-9]", "_", port).strip("_")
+    return f"{stem}_cmd", f"{stem}_evt"
+
+
+class DeviceProcessSerial(object):
+    """
+    Stands in for serial.Serial in the GUI process, forwarding writes to the device process and returning the
+    device output it timestamped. If a device process is already running for that port (e.g. the GUI crashed),
+    it is reused instead of opening the port again
+    """
+
+    def __init__(self, port: str, baudrate: int):
+        self.port = port
+        self.baudrate = baudrate
+        self._process = None
+        self._pending = deque()
+        self._n_pending = 0
+        command_name, event_name = ring_names(port)
+        try:
+            self._commands = SharedRingBuffer(command_name)
+            self._events = SharedRingBuffer(event_name)
+        except FileNotFoundError:
+            self._spawn()
+            self._commands = SharedRingBuffer(command_name)
+            self._events = SharedRingBuffer(event_name)
+        else:
+            if (
+                time.monotonic_ns() - self._events.heartbeat_ns
+                > DEVICE_HEARTBEAT_TIMEOUT_S * 1e9
+            ):
+                # the process that created the rings is dead, remove them so that the next attempt starts a new one
+                self._commands.close(unlink=True)
+                self._events.close(unlink=True)
+                self._commands = None
+                self._events = None
+                raise DeviceProcessError(
+                    f"Found a stale device process for port {port}, its shared memory was removed, try again"
+                )
+            logger.info(f"Reconnected to running device process for port {port}")
+
+    def _spawn(self):
+        logger.info(f"Starting device process for port {self.port}")
+        # don't die with the GUI, e.g. on Ctrl+C in its terminal
+        if os.name == "posix":
+            detach = dict(start_new_session=True)
+        else:
+            detach = dict(creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "src.DeviceProcess", self.port, "--baudrate", str(self.baudrate)],
+            cwd=Path(__file__).resolve().parent.parent,
+            **detach,
+        )
+        deadline = time.monotonic() + DEVICE_START_TIMEOUT_S
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise DeviceProcessError(
+                    f"Device process for port {self.port} exited with code {self._process.returncode}"
+                )
+            try:
+                events = SharedRingBuffer(ring_names(self.port)[1])
+                ready = events.heartbeat_ns != 0  # set once both rings are initialized
+                events.close()
+                if ready:
+                    return
+            except FileNotFoundError:
+                pass
+            time.sleep(0.01)
+        raise DeviceProcessError(f"Timed out waiting for the device process for port {self.port}")
+
+    @property
+    def is_open(self) -> bool:
+        return self._commands is not None
+
+    def _check_alive(self):
+        """
+        Raises serial.SerialException, like an unplugged serial port, if the device process stopped updating its
+        heartbeat (e.g. it exited because the port was unplugged)
+        """
+        if time.monotonic_ns() - self._events.heartbeat_ns > DEVICE_HEARTBEAT_TIMEOUT_S * 1e9:
+            raise serial.SerialException(f"The device process for port {self.port} is not running")
+
+    def write(self, data: bytes) -> int:
+        self._check_alive()
+        while not self._commands.put(data, time.monotonic_ns()):
+            # the ring is full, wait for the device process to empty it, as long as it is running
+            time.sleep(DEVICE_POLL_INTERVAL_S)
+            self._check_alive()
+        return len(data)
+
+    def _drain(self):
+        record = self._events.get()
+        while record is not None:
+            self._pending.append(record)
+            self._n_pending += len(record[1])
+            record = self._events.get()
+
+    @property
+    def in_waiting(self) -> int:
+        self._drain()
+        if not self._pending:
+            self._check_alive()
+        return self._n_pending
+
+    def read(self, size: int = 1) -> bytes:
+        out = b""
+        while self._pending and len(out) < size:
+            t_ns, data = self._pending.popleft()
+            n = size - len(out)
+            if len(data) > n:
+                self._pending.appendleft((t_ns, data[n:]))
+                data = data[:n]
+            out += data
+        self._n_pending -= len(out)
+        return out
+
+    def read_events(self):
+        """
+        Returns all the device output received so far as a list of (t_ns, data) tuples, where t_ns is the
+        time.monotonic_ns() at which the device process read it from the serial port (see StimJim.read_serial_events)
+        """
+        self._drain()
+        if not self._pending:
+            self._check_alive()
+        events = list(self._pending)
+        self._pending.clear()
+        self._n_pending = 0
+        return events
+
+    def detach(self):
+        """
+        Disconnects from the device process, leaving it running
+        """
+        self._commands.close()
+        self._events.close()
+        self._commands = None
+        self._events = None
+
+    def close(self):
+        """
+        Stops the device process, which closes the serial port
+        """
+        if self._commands is None:
+            return
+        self._commands.closed = True
+        self.detach()
+        if self._process is not None:
+            try:
+                self._process.wait(DEVICE_START_TIMEOUT_S)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"The device process for port {self.port} did not stop, killing it")
+                self._process.kill()
+                self._process.wait()
+
+
+def run_device_process(port: str, baudrate: int):
+    command_name, event_name = ring_names(port)
+    serial_port = serial.Serial(port, baudrate=baudrate, timeout=0)
+    commands = SharedRingBuffer(command_name, create=True)
+    events = SharedRingBuffer(event_name, create=True)
+    events.beat()
+    logger.info(f"Device process serving port {port}")
+    try:
+        while not commands.closed:
+            events.beat()
+            busy = False
+            record = commands.get()
+            while record is not None:
+                serial_port.write(record[1])
+                busy = True
+                record = commands.get()
+            n = serial_port.in_waiting
+            if n > 0:
+                t_ns = time.monotonic_ns()
+                events.put(serial_port.read(n), t_ns)
+                busy = True
+            if not busy:
+                time.sleep(DEVICE_POLL_INTERVAL_S)
+    finally:
+        serial_port.close()
+        commands.close()
+        events.close()
+        logger.info(f"Device process for port {port} stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="StimJimDeviceProcess",
+        description="Serial I/O process for StimJimGUI (started automatically by --device-process)",
+    )
+    parser.add_argument("port")
+    parser.add_argument("--baudrate", type=int, default=STIMJIM_SERIAL_BAUDRATE)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    run_device_process(args.port, args.baudrate)
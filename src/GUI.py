@@ -1,14 +1,24 @@
 import json
 import logging
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import List
 
-import requests
 import serial
 
-# noinspection PyUnresolvedReferences
-from PyQt5 import uic
-from PyQt5.QtCore import QTimer, QAbstractTableModel, Qt, QSignalBlocker, pyqtSignal
-from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import (
+    QTimer,
+    QAbstractTableModel,
+    Qt,
+    QSignalBlocker,
+    pyqtSignal,
+    QPersistentModelIndex,
+    QModelIndex,
+    QItemSelectionModel,
+    QEvent,
+)
+from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import (
     QInputDialog,
     QWidget,
@@ -26,8 +36,14 @@ from PyQt5.QtWidgets import (
     QTableView,
     QStyledItemDelegate,
     QFileDialog,
+    QDialog,
+    QDialogButtonBox,
+    QFormLayout,
+    QDoubleSpinBox,
+    QLineEdit,
 )
 
+from src.StatisticsPanel import TrainStatisticsDock, format_si
 from src.StimJim import (
     SERIAL_READ_INTERVAL_MS,
     StimJim,
@@ -46,19 +62,54 @@ from src.StimJim import (
     StimJimTooManyStagesException,
     StimJimTrigDirection,
     STIMJIM_N_TRIGGERS,
+    STIMJIM_MAX_PULSETRAINS,
+)
+from src.TrainLibrary import StimJimNoFreeSlotException
+from src.ConfigBanks import ConfigBanks, StimJimBankFullException
+from src.ConfigLoader import ConfigLoader, CONFIG_SIMPLE_MODE_TAB, CONFIG_FULL_MODE_TAB
+from src.Scheduler import (
+    TriggerScheduler,
+    fixed_rate_times,
+    poisson_times,
+    list_times,
+)
+from src.Sequencer import Protocol, ProtocolRunner, ProtocolError
+from src.Threshold import (
+    ThresholdSearch,
+    BinarySearch,
+    Staircase,
+    ManualResponseSource,
+    response_source_from_address,
+    THRESHOLD_RESPONSE_TIMEOUT_S,
+    THRESHOLD_INTERVAL_S,
+    THRESHOLD_MAX_TRIALS,
+)
+from src.Icons import get_icon
+from src.UiForms import setup_form
+from src.Validation import (
+    Severity,
+    ValidationLimits,
+    validate_stimjim,
+    has_errors,
 )
 from src.scientific_spinbox import ScienDSpinBox
 
 logger = logging.getLogger("StimJimGUI")
 
+VALIDATION_COLORS = {
+    Severity.WARNING: QColor(255, 235, 170),
+    Severity.ERROR: QColor(255, 200, 200),
+}
+
 
 class DelayScienDSpinBox(ScienDSpinBox):
     """
     This is a variant of ScienDSpinBox, which delays the emission of the valueChanged signal until the widget
-    loses focus or the enter key is pressed
+    loses focus or the enter key is pressed. valueEdited is emitted immediately, e.g. to update previews
     """
 
     valueChanged = pyqtSignal(object, name="valueChanged")
+    valueEdited = pyqtSignal(object, name="valueEdited")
 
     def __init__(self, parent):
         super().__init__(parent)
@@ -68,6 +119,11 @@ class DelayScienDSpinBox(ScienDSpinBox):
         self.blockSignals(True)
         super().update_value()
         self.blockSignals(False)
+        self.valueEdited.emit(self.value())
+
+    def stepBy(self, steps):
+        super().stepBy(steps)
+        self.valueEdited.emit(self.value())
 
     def setValue(self, value):
         self.blockSignals(True)
@@ -91,12 +147,51 @@ class DelayScienDSpinBox(ScienDSpinBox):
 
 # noinspection PyMethodOverriding
 class PulseStageTableDelegate(QStyledItemDelegate):
+    """
+    Paints the values of the stages table with their unit, and only creates an editor for the cell being edited.
+    Editors are kept in pools and reused, instead of being created and destroyed each time. Amplitude and duration
+    editors are pooled separately, since they are not configured the same way
+    """
+
+    # row, column, value in mV, μA or μs, emitted while the value is being edited
+    valueEdited = pyqtSignal(int, int, float)
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self._editor_pools = {True: [], False: []}  # is amplitude: editors
+
+    @staticmethod
+    def _get_scaling(index):
+        """
+        Returns the factor converting V, A or s to the units of the cell (mV, μA or μs), and the unit
+        """
+        stage: PulseStage = index.model().list_of_stages[index.row()]
+        if index.column() in range(len(stage.channel_amps)):
+            mode = (
+                stage.pulse_train.get_mode(index.column())
+                if stage.pulse_train is not None
+                else STIMJIM_DEFAULT_MODE
+            )
+            return STIMJIM_SCALING_FACTORS[mode], STIMJIM_UNITS[mode]
+        return STIMJIM_DURATION_SCALING_FACTOR, "s"
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        scale, unit = self._get_scaling(index)
+        option.text = format_si(index.data(Qt.EditRole) / scale, unit).strip()
+        option.displayAlignment = Qt.AlignRight | Qt.AlignVCenter
 
     def createEditor(self, parent, option, index):
-        spinbox = DelayScienDSpinBox(parent)
         stage: PulseStage = index.model().list_of_stages[index.row()]
+        pool = self._editor_pools[index.column() in range(len(stage.channel_amps))]
+        if pool:
+            spinbox = pool.pop()
+            spinbox.setParent(parent)
+        else:
+            spinbox = DelayScienDSpinBox(parent)
+            spinbox.valueEdited.connect(lambda value, editor=spinbox: self._on_value_edited(editor, value))
+        spinbox.index = QPersistentModelIndex(index)
+        spinbox.pool = pool
 
         if (
             index.column() in range(len(stage.channel_amps))
@@ -119,29 +214,27 @@ class PulseStageTableDelegate(QStyledItemDelegate):
 
         return spinbox
 
+    def destroyEditor(self, editor: DelayScienDSpinBox, index):
+        editor.hide()
+        editor.index = None
+        editor.pool.append(editor)
+
+    def _on_value_edited(self, editor: DelayScienDSpinBox, value: float):
+        index = getattr(editor, "index", None)
+        if index is None or not index.isValid():
+            return
+        self.valueEdited.emit(index.row(), index.column(), value * self._get_scaling(index)[0])
+
     def setEditorData(self, editor: DelayScienDSpinBox, index):
-        stage: PulseStage = index.model().list_of_stages[index.row()]
-        value = (stage.channel_amps + [stage.duration_us])[index.column()]
-        if index.column() in range(len(stage.channel_amps)):
-            value = (
-                value
-                / STIMJIM_SCALING_FACTORS[stage.pulse_train.get_mode(index.column())]
-            )
-        else:
-            value = value / STIMJIM_DURATION_SCALING_FACTOR
-        editor.setValue(value)
+        scale, _ = self._get_scaling(index)
+        editor.setValue(index.data(Qt.EditRole) / scale)
+        color = index.data(Qt.BackgroundRole)
+        editor.setStyleSheet("" if color is None else f"background-color: {color.name()}")
+        editor.setToolTip(index.data(Qt.ToolTipRole) or "")
 
     def setModelData(self, editor: DelayScienDSpinBox, model, index):
-        value = editor.value()
-        stage: PulseStage = index.model().list_of_stages[index.row()]
-        if index.column() in range(len(stage.channel_amps)):
-            scale = STIMJIM_SCALING_FACTORS[stage.pulse_train.get_mode(index.column())]
-            value = value * scale
-            stage.channel_amps[index.column()] = value
-        else:
-            value = value * STIMJIM_DURATION_SCALING_FACTOR
-            stage.duration_us = value
-        index.model().dataChanged.emit(index, index, [Qt.EditRole])
+        scale, _ = self._get_scaling(index)
+        model.setData(index, editor.value() * scale, Qt.EditRole)
 
 
 # noinspection PyMethodOverriding
@@ -151,6 +244,25 @@ class PulseStageTableModel(QAbstractTableModel):
     def __init__(self, pulse_stages, parent=None):
         super().__init__(parent)
         self.list_of_stages = pulse_stages
+        self.diagnostics = {}  # (row, column): [Diagnostic]
+
+    def set_diagnostics(self, diagnostics):
+        """
+        Sets the validation diagnostics of the train, only those pointing at a cell are shown
+        """
+        cells = {}
+        for diagnostic in diagnostics:
+            if diagnostic.stage >= 0:
+                cells.setdefault((diagnostic.stage, diagnostic.column), []).append(diagnostic)
+        if cells == self.diagnostics:
+            return
+        self.diagnostics = cells
+        if self.rowCount() > 0:
+            self.dataChanged.emit(
+                self.index(0, 0),
+                self.index(self.rowCount() - 1, self.columnCount() - 1),
+                [Qt.BackgroundRole, Qt.ToolTipRole],
+            )
 
     def headerData(self, section, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
@@ -169,6 +281,15 @@ class PulseStageTableModel(QAbstractTableModel):
                 return stage.channel_amps[index.column()]
             else:
                 return stage.duration_us
+        elif role == Qt.BackgroundRole:
+            diagnostics = self.diagnostics.get((index.row(), index.column()))
+            if diagnostics:
+                return VALIDATION_COLORS[max(d.severity for d in diagnostics)]
+        elif role == Qt.ToolTipRole:
+            diagnostics = self.diagnostics.get((index.row(), index.column()))
+            if diagnostics:
+                return "\n".join(d.message for d in diagnostics)
+        return None
 
     def setData(self, index, value, role):
         if role == Qt.EditRole:
@@ -187,6 +308,30 @@ class PulseStageTableModel(QAbstractTableModel):
     def columnCount(self, index=None):
         return 3
 
+    def append_stage(self, pulse_train: PulseTrain):
+        """
+        Adds a stage at the end of pulse_train, whose stages are those of the model
+        """
+        row = self.rowCount()
+        if row >= pulse_train.MAX_N_PHASES:
+            raise StimJimTooManyStagesException(
+                f"Cannot add more that {pulse_train.MAX_N_PHASES} to a PulseTrain"
+            )
+        self.beginInsertRows(QModelIndex(), row, row)
+        pulse_train.add_stage()
+        self.endInsertRows()
+
+    def pop_stage(self, pulse_train: PulseTrain):
+        """
+        Removes the last stage of pulse_train, whose stages are those of the model
+        """
+        row = self.rowCount() - 1
+        if row < 0:
+            raise IndexError("pop from empty list")
+        self.beginRemoveRows(QModelIndex(), row, row)
+        pulse_train.remove_stage()
+        self.endRemoveRows()
+
 
 class FullModeWidget(QWidget):
     trig0SpinBox: QSpinBox
@@ -209,68 +354,103 @@ class FullModeWidget(QWidget):
     trainPeriodSpinBox: DelayScienDSpinBox
     addStageButton: QToolButton
     removeStageButton: QToolButton
+    waveformPreview: "WaveformPreviewWidget"  # imported by the form, see src.WaveformPreview
+
+    # emitted when the trains or triggers of stimjim change
+    trainsChanged = pyqtSignal()
+    # emitted with the diagnostics of all the trains each time they are validated
+    validationChanged = pyqtSignal(object)
 
     def __init__(self, stimjim: StimJim, parent=None):
         super().__init__(parent=parent)
         self.stimjim = stimjim
+        self.validation_limits = ValidationLimits()
+        self.diagnostics = []
+        # the model can be changed from outside (configuration loaded, control server...), all the trains must then be
+        # validated again. Otherwise only the trains modified by an edit transaction are
+        self._diagnostics_stale = True
+        self.stage_models = {}  # train id: PulseStageTableModel
+        # edit transactions
+        self.upload_count = 0  # number of writes to the StimJim
+        self.last_action_uploads = 0  # number of writes caused by the last edit
+        self._transaction_depth = 0
+        self._transaction_upload_count = 0
+        self._pending_trains = set()
+        self._pending_triggers = False
+        self._pending_validation = False
         #
         # UI
         #
-        uic.loadUi("./src/FullModeWidget.ui", self)
+        setup_form(self, "FullModeWidget")
         self.ch0ModeSpinBox.addItems(STIMJIM_MODE_NAMES.values())
         self.ch1ModeSpinBox.addItems(STIMJIM_MODE_NAMES.values())
-        self.pulseStagesTable.setItemDelegate(PulseStageTableDelegate())
+        self.pulseStagesTableDelegate = PulseStageTableDelegate()
+        self.pulseStagesTable.setItemDelegate(self.pulseStagesTableDelegate)
 
         #
         # SIGNALS
         #
-        self.trig0SpinBox.valueChanged.connect(self._on_trig0_spinbox_changed)
-        self.trig1SpinBox.valueChanged.connect(self._on_trig1_spinbox_changed)
-        self.trig0RisingEdgeButton.clicked.connect(self._on_trig0_spinbox_changed)
-        self.trig0FallingEdgeButton.clicked.connect(self._on_trig0_spinbox_changed)
-        self.trig1RisingEdgeButton.clicked.connect(self._on_trig1_spinbox_changed)
-        self.trig1FallingEdgeButton.clicked.connect(self._on_trig1_spinbox_changed)
         self.trig0ManualTriggerButton.clicked.connect(self._on_trig0_manual_trigger)
         self.trig1ManualTriggerButton.clicked.connect(self._on_trig1_manual_trigger)
         self.trig0CancelTrainButton.clicked.connect(self._on_trig0_cancel)
         self.trig1CancelTrainButton.clicked.connect(self._on_trig1_cancel)
-        self.pulseTrainIDSpinBox.valueChanged.connect(self._on_pulse_train_id_changed)
-        self.ch0ModeSpinBox.currentIndexChanged.connect(self._on_ch0mode_changed)
-        self.ch1ModeSpinBox.currentIndexChanged.connect(self._on_ch1mode_changed)
-        self.trainDurationSpinBox.valueChanged.connect(self._on_train_duration_changed)
-        self.trainPeriodSpinBox.valueChanged.connect(self._on_train_period_changed)
-        self.addStageButton.clicked.connect(self._on_add_stage)
-        self.removeStageButton.clicked.connect(self._on_remove_stage)
-
-        self.trig0SpinBox.valueChanged.connect(self.update_stimjim)
-        self.trig1SpinBox.valueChanged.connect(self.update_stimjim)
-        self.trig0RisingEdgeButton.clicked.connect(self.update_stimjim)
-        self.trig0FallingEdgeButton.clicked.connect(self.update_stimjim)
-        self.trig1RisingEdgeButton.clicked.connect(self.update_stimjim)
-        self.trig1FallingEdgeButton.clicked.connect(self.update_stimjim)
-        self.pulseTrainIDSpinBox.valueChanged.connect(self.update_stimjim)
-        self.ch0ModeSpinBox.currentIndexChanged.connect(self.update_stimjim)
-        self.ch1ModeSpinBox.currentIndexChanged.connect(self.update_stimjim)
-        self.trainDurationSpinBox.valueChanged.connect(self.update_stimjim)
-        self.trainPeriodSpinBox.valueChanged.connect(self.update_stimjim)
-        self.addStageButton.clicked.connect(self.update_stimjim)
-        self.removeStageButton.clicked.connect(self.update_stimjim)
+        self.pulseStagesTableDelegate.valueEdited.connect(self.waveformPreview.set_stage_value)
+        self.trainDurationSpinBox.valueEdited.connect(
+            lambda value: self.waveformPreview.set_timing(
+                duration_us=value * STIMJIM_DURATION_SCALING_FACTOR
+            )
+        )
+        self.trainPeriodSpinBox.valueEdited.connect(
+            lambda value: self.waveformPreview.set_timing(
+                period_us=value * STIMJIM_DURATION_SCALING_FACTOR
+            )
+        )
+
+        # each edit runs its handler (if any) and update_stimjim in a transaction, so that it is uploaded once
+        self._connect_edit(self.trig0SpinBox.valueChanged)
+        self._connect_edit(self.trig1SpinBox.valueChanged)
+        self._connect_edit(self.trig0RisingEdgeButton.clicked)
+        self._connect_edit(self.trig0FallingEdgeButton.clicked)
+        self._connect_edit(self.trig1RisingEdgeButton.clicked)
+        self._connect_edit(self.trig1FallingEdgeButton.clicked)
+        self._connect_edit(self.pulseTrainIDSpinBox.valueChanged, self._on_pulse_train_id_changed)
+        self._connect_edit(self.ch0ModeSpinBox.currentIndexChanged, self._on_ch0mode_changed)
+        self._connect_edit(self.ch1ModeSpinBox.currentIndexChanged, self._on_ch1mode_changed)
+        self._connect_edit(self.trainDurationSpinBox.valueChanged, self._on_train_duration_changed)
+        self._connect_edit(self.trainPeriodSpinBox.valueChanged, self._on_train_period_changed)
+        self._connect_edit(self.addStageButton.clicked, self._on_add_stage)
+        self._connect_edit(self.removeStageButton.clicked, self._on_remove_stage)
 
         #
         # UPDATE
         #
         self.populate_pulse_train(0)
 
-    def _on_trig0_spinbox_changed(self, _):
-        # this function can be called either from the spinbox or the buttons, so we don't use the argument
-        direction = "0" if self.trig0RisingEdgeButton.isChecked() else "1"
-        command = f"R0,{self.trig0SpinBox.value()},{direction}"
-        self.stimjim.send_command(command)
-
-    def _on_trig1_spinbox_changed(self, _):
-        direction = "0" if self.trig1RisingEdgeButton.isChecked() else "1"
-        command = f"R1,{self.trig0SpinBox.value()},{direction}"
-        self.stimjim.send_command(command)
+    def _connect_edit(self, signal, handler=None):
+        def on_edit(*args):
+            with self.edit_transaction():
+                if handler is not None:
+                    handler(*args)
+                self.update_stimjim()
+
+        signal.connect(on_edit)
+
+    @contextmanager
+    def edit_transaction(self):
+        """
+        Groups edits: inside a transaction, update_stimjim only records what has changed, and everything is uploaded
+        in a single write when the outermost transaction ends. Transactions can be nested
+        """
+        if self._transaction_depth == 0:
+            self._transaction_upload_count = self.upload_count
+        self._transaction_depth += 1
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self._commit_transaction()
+                self.last_action_uploads = self.upload_count - self._transaction_upload_count
 
     def _on_trig0_manual_trigger(self, _):
         self.stimjim.send_command(f"T{self.trig0SpinBox.value()}")
@@ -290,68 +470,157 @@ class FullModeWidget(QWidget):
     def _on_ch0mode_changed(self, index: int):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         pulsetrain.set_mode(channel_index=0, mode=StimJimOutputModes(index))
-        self.show_all_delegates()
+        self.waveformPreview.set_mode(0, index)
+        # the units of the amplitudes changed
+        self.pulseStagesTable.viewport().update()
 
     def _on_ch1mode_changed(self, index: int):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         pulsetrain.set_mode(channel_index=1, mode=StimJimOutputModes(index))
-        self.show_all_delegates()
+        self.waveformPreview.set_mode(1, index)
+        # the units of the amplitudes changed
+        self.pulseStagesTable.viewport().update()
 
     def _on_train_duration_changed(self, value: float):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         pulsetrain.train_duration_s = value
+        self.waveformPreview.set_timing(duration_us=pulsetrain.train_duration_us)
 
     def _on_train_period_changed(self, value: float):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         pulsetrain.train_period_s = value
+        self.waveformPreview.set_timing(period_us=pulsetrain.train_period_us)
 
     def _on_add_stage(self, _):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         try:
-            pulsetrain.add_stage()
-            # noinspection PyUnresolvedReferences
-            self.pulseStagesTable.model().layoutChanged.emit()
-            self.show_all_delegates()
+            self.pulseStagesTable.model().append_stage(pulsetrain)
+            self.waveformPreview.set_pulse_train(pulsetrain)
         except StimJimTooManyStagesException:
             pass  # TODO: could add a sound effect here?
 
     def _on_remove_stage(self, _):
         pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
         try:
-            pulsetrain.remove_stage()
-            # noinspection PyUnresolvedReferences
-            self.pulseStagesTable.model().layoutChanged.emit()
-            self.show_all_delegates()
+            self.pulseStagesTable.model().pop_stage(pulsetrain)
+            self.waveformPreview.set_pulse_train(pulsetrain)
         except IndexError:
             pass  # TODO: could add a sound effect?
 
-    def show_all_delegates(self):
-        # FIXME: This works but is very hacky
-        if self.pulseStagesTable.model() is not None:
-            for i in range(self.pulseStagesTable.model().rowCount()):
-                for j in range(self.pulseStagesTable.model().columnCount()):
-                    self.pulseStagesTable.closePersistentEditor(
-                        self.pulseStagesTable.model().index(i, j)
-                    )
-                    self.pulseStagesTable.openPersistentEditor(
-                        self.pulseStagesTable.model().index(i, j)
-                    )
-
     def populate_pulse_train(self, pulsetrain_id: int):
-        pulsetrain: PulseTrain = self.stimjim.pulse_trains[pulsetrain_id]
-        self.ch0ModeSpinBox.setCurrentIndex(pulsetrain.get_mode(0))
-        self.ch1ModeSpinBox.setCurrentIndex(pulsetrain.get_mode(1))
-        self.trainDurationSpinBox.setValue(pulsetrain.train_duration_s)
-        self.trainPeriodSpinBox.setValue(pulsetrain.train_period_s)
-        self.pulseStagesTable.setModel(PulseStageTableModel(pulsetrain.stages))
-        self.show_all_delegates()
-        self.pulseStagesTable.model().dataChanged.connect(self.update_stimjim)
+        with self.edit_transaction():
+            pulsetrain: PulseTrain = self.stimjim.pulse_trains[pulsetrain_id]
+            # the widgets follow the model, there is nothing to upload
+            with QSignalBlocker(self.ch0ModeSpinBox), QSignalBlocker(self.ch1ModeSpinBox):
+                self.ch0ModeSpinBox.setCurrentIndex(pulsetrain.get_mode(0))
+                self.ch1ModeSpinBox.setCurrentIndex(pulsetrain.get_mode(1))
+            self.trainDurationSpinBox.setValue(pulsetrain.train_duration_s)
+            self.trainPeriodSpinBox.setValue(pulsetrain.train_period_s)
+            model = self.get_stage_model(pulsetrain_id)
+            if self.pulseStagesTable.model() is not model:
+                self.pulseStagesTable.setModel(model)
+                # setModel creates new selection models for the table and its headers, but never deletes the old ones
+                for view in [
+                    self.pulseStagesTable,
+                    self.pulseStagesTable.horizontalHeader(),
+                    self.pulseStagesTable.verticalHeader(),
+                ]:
+                    for selection_model in view.findChildren(QItemSelectionModel, options=Qt.FindDirectChildrenOnly):
+                        if selection_model is not self.pulseStagesTable.selectionModel():
+                            selection_model.deleteLater()
+            self.waveformPreview.set_pulse_train(pulsetrain)
+            self._pending_validation = True
+
+    def get_stage_model(self, pulsetrain_id: int) -> PulseStageTableModel:
+        """
+        Returns the model of the stages of a train. Models are kept until the train is replaced (e.g. when a
+        configuration is loaded), so switching trains does not create models or connect signals
+        """
+        stages = self.stimjim.pulse_trains[pulsetrain_id].stages
+        model = self.stage_models.get(pulsetrain_id)
+        if model is None or model.list_of_stages is not stages:
+            if model is not None:
+                model.deleteLater()
+            model = PulseStageTableModel(stages, parent=self)
+            model.dataChanged.connect(self._on_stage_data_changed)
+            self.stage_models[pulsetrain_id] = model
+        return model
+
+    def _on_stage_data_changed(self, top_left, bottom_right, roles=None):
+        if roles and Qt.EditRole not in roles:
+            return  # e.g. new validation diagnostics
+        self.update_stimjim()
+        # only the edited cells are sent to the preview
+        stages = self.pulseStagesTable.model().list_of_stages
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            for column in range(top_left.column(), bottom_right.column() + 1):
+                stage: PulseStage = stages[row]
+                value = (stage.channel_amps + [stage.duration_us])[column]
+                self.waveformPreview.set_stage_value(row, column, value)
+
+    def validate(self, train_ids=None):
+        """
+        Checks the trains train_ids (all by default, or when the model was changed from outside), keeping the
+        diagnostics of the others, and highlights the problems of the current train in the stages table. Returns the
+        diagnostics of all the trains
+        """
+        if train_ids is None or self._diagnostics_stale:
+            self.diagnostics = validate_stimjim(self.stimjim, self.validation_limits)
+            self._diagnostics_stale = False
+        elif train_ids:
+            train_ids = set(train_ids)
+            self.diagnostics = [d for d in self.diagnostics if d.train not in train_ids] + validate_stimjim(
+                self.stimjim, self.validation_limits, sorted(train_ids)
+            )
+        train_id = self.pulseTrainIDSpinBox.value()
+        model = self.pulseStagesTable.model()
+        if model is not None:
+            model.set_diagnostics([d for d in self.diagnostics if d.train == train_id])
+        self.validationChanged.emit(self.diagnostics)
+        return self.diagnostics
+
+    def upload_trains(self, train_ids):
+        """
+        Uploads several trains in a single write, e.g. after a bulk edit, then refreshes the widgets
+        """
+        with self.edit_transaction():
+            self._pending_trains.update(train_ids)
+            if self.pulseTrainIDSpinBox.value() in train_ids:
+                self.populate_pulse_train(self.pulseTrainIDSpinBox.value())
 
     # noinspection PyUnusedLocal
     def update_stimjim(self, *args):
-        current_pulsetrain = self.stimjim.pulse_trains[self.pulseTrainIDSpinBox.value()]
-        self.stimjim.send_command(current_pulsetrain.get_stimjim_string())
-
+        """
+        Uploads the current train and the triggers, at the end of the current edit transaction
+        """
+        with self.edit_transaction():
+            self._pending_trains.add(self.pulseTrainIDSpinBox.value())
+            self._pending_triggers = True
+
+    def _commit_transaction(self):
+        if not (self._pending_trains or self._pending_triggers or self._pending_validation):
+            return
+        diagnostics = self.validate(self._pending_trains)
+        commands = []
+        for train_id in sorted(self._pending_trains):
+            if has_errors(diagnostics, train_id):
+                logger.warning(f"Pulse train {train_id} is not valid, it was not uploaded")
+            else:
+                commands.append(self.stimjim.pulse_trains[train_id].get_stimjim_string())
+        if self._pending_triggers:
+            self._update_triggers()
+            commands += [trigger.get_stimjim_string() for trigger in self.stimjim.triggers]
+        changed = bool(self._pending_trains or self._pending_triggers)
+        self._pending_trains.clear()
+        self._pending_triggers = False
+        self._pending_validation = False
+        if len(commands) > 0:
+            self.stimjim.send_commands(commands)
+            self.upload_count += 1
+        if changed:
+            self.trainsChanged.emit()
+
+    def _update_triggers(self):
         self.stimjim.triggers[0].train_target = self.trig0SpinBox.value()
         self.stimjim.triggers[0].trig_direction = (
             0 if self.trig0RisingEdgeButton.isChecked() else 1
@@ -361,25 +630,25 @@ class FullModeWidget(QWidget):
             0 if self.trig1RisingEdgeButton.isChecked() else 1
         )
 
-        command = "\n".join(
-            [
-                self.stimjim.triggers[i].get_stimjim_string()
-                for i in range(STIMJIM_N_TRIGGERS)
-            ]
-        )
-        self.stimjim.send_command(command)
-
     # noinspection PyUnusedLocal
     def update_widgets(self, *args):
-        self.trig0SpinBox.setValue(self.stimjim.triggers[0].train_target)
-        self.trig0RisingEdgeButton.setChecked(
-            self.stimjim.triggers[0].trig_direction == StimJimTrigDirection.RISING
-        )
-        self.trig1SpinBox.setValue(self.stimjim.triggers[1].train_target)
-        self.trig1RisingEdgeButton.setChecked(
-            self.stimjim.triggers[1].trig_direction == StimJimTrigDirection.RISING
-        )
-        self.populate_pulse_train(self.pulseTrainIDSpinBox.value())
+        """
+        Shows the state of stimjim, without uploading anything
+        """
+        self._diagnostics_stale = True
+        with self.edit_transaction():
+            with QSignalBlocker(self.trig0SpinBox), QSignalBlocker(self.trig1SpinBox):
+                self.trig0SpinBox.setValue(self.stimjim.triggers[0].train_target)
+                self.trig1SpinBox.setValue(self.stimjim.triggers[1].train_target)
+            for trigger, rising_button, falling_button in [
+                (self.stimjim.triggers[0], self.trig0RisingEdgeButton, self.trig0FallingEdgeButton),
+                (self.stimjim.triggers[1], self.trig1RisingEdgeButton, self.trig1FallingEdgeButton),
+            ]:
+                # the buttons are exclusive, so only checking one of them works
+                rising = trigger.trig_direction == StimJimTrigDirection.RISING
+                with QSignalBlocker(rising_button), QSignalBlocker(falling_button):
+                    (rising_button if rising else falling_button).setChecked(True)
+            self.populate_pulse_train(self.pulseTrainIDSpinBox.value())
 
 
 class SimpleModeWidget(QWidget):
@@ -397,7 +666,7 @@ class SimpleModeWidget(QWidget):
 
     def __init__(self, channel_id, stimjim: StimJim, parent=None):
         super().__init__(parent=parent)
-        uic.loadUi("./src/SimpleModeWidget.ui", self)
+        setup_form(self, "SimpleModeWidget")
 
         self.channel_id = channel_id
         self.stimjim = stimjim
@@ -433,7 +702,7 @@ class SimpleModeWidget(QWidget):
 
         self._update_train_duration(None)
         self._on_mode_changed(StimJimOutputModes.GROUNDED)
-        self.update_stimjim()
+        # the model (and the device) are only updated by StimJimGUI once the window is shown, see _on_first_paint
 
     def _on_mode_changed(self, current_id: int):
         self.thresholdButton.setChecked(False)
@@ -472,115 +741,355 @@ class SimpleModeWidget(QWidget):
             self._on_mode_changed(self.stimModeComboBox.currentIndex())
             self.stimAmplitudeSpinBox.setValue(value)
 
+    def set_threshold(self, value: float, upload: bool = True):
+        """
+        Switches to threshold mode (amplitudes in x T) with threshold value (in V or A). If upload is False, only the
+        model is updated
+        """
+        with QSignalBlocker(self.thresholdValueSpinBox), QSignalBlocker(self.stimAmplitudeSpinBox):
+            if not self.thresholdButton.isChecked():
+                self.thresholdButton.setChecked(True)
+                self._on_threshold_button(True)
+            self.thresholdValueSpinBox.setValue(value)
+        self.update_stimjim(upload=upload)
+
     # noinspection PyUnusedLocal
-    def update_stimjim(self, *args):
+    def update_stimjim(self, *args, upload: bool = True):
+        from src.SimpleMode import compile_simple_mode
+
         # trigger
         self.stimjim.triggers[self.channel_id].train_target = self.channel_id
         self.stimjim.triggers[self.channel_id].trig_direction = (
             StimJimTrigDirection.RISING
         )
         # Pulse Train
+        compiled = compile_simple_mode(
+            self.channel_id,
+            mode=self.stimModeComboBox.currentIndex(),
+            amplitude=self.stimAmplitudeSpinBox.value(),
+            pulse_duration_s=self.stimDurationSpinBox.value(),
+            bipolar=self.isBipolarCheckBox.isChecked(),
+            n_pulses=self.stimNPulsesSpinBox.value(),
+            frequency_hz=self.stimTrainFreqSpinBox.value(),
+            threshold=(
+                self.thresholdValueSpinBox.value()
+                if self.thresholdButton.isChecked()
+                else None
+            ),
+        ).to_pulse_trains([self.channel_id])[0]
         pulse_train = self.stimjim.pulse_trains[self.channel_id]
-        pulse_train.set_mode(self.channel_id, self.stimModeComboBox.currentIndex())
-        other_channel = (
-            range(STIMJIM_N_OUTPUTS).index(self.channel_id) + 1
-        ) % STIMJIM_N_OUTPUTS
-        pulse_train.set_mode(other_channel, StimJimOutputModes.GROUNDED)
-
-        period_us = int(
-            STIMJIM_DURATION_SCALING_FACTOR / self.stimTrainFreqSpinBox.value()
-        )
-        train_duration_us = (
-            STIMJIM_DURATION_SCALING_FACTOR * self.stimTrainDurationSpinBox.value()
-        )
-        pulse_train.train_duration_us = train_duration_us
-        pulse_train.train_period_us = period_us
-
-        # Pulse Stage(s)
-        amps = [0, 0]
-        if self.thresholdButton.isChecked():
-            amp = int(
-                self.stimAmplitudeSpinBox.value()
-                * self.thresholdValueSpinBox.value()
-                * STIMJIM_SCALING_FACTORS[self.stimModeComboBox.currentIndex()]
-            )
-        else:
-            amp = int(
-                self.stimAmplitudeSpinBox.value()
-                * STIMJIM_SCALING_FACTORS[self.stimModeComboBox.currentIndex()]
-            )
-        amps[self.channel_id] = amp
-
-        stage_duration_us = (
-            STIMJIM_DURATION_SCALING_FACTOR * self.stimDurationSpinBox.value()
-        )
-        if self.isBipolarCheckBox.isChecked():
-            stage_duration_us /= 2
-        stage_duration_us = int(stage_duration_us)
-
+        for channel in range(STIMJIM_N_OUTPUTS):
+            pulse_train.set_mode(channel, compiled.get_mode(channel))
+        pulse_train.train_period_us = compiled.train_period_us
+        pulse_train.train_duration_us = compiled.train_duration_us
         while len(pulse_train.stages) > 0:
             pulse_train.remove_stage(-1)
-        pulse_train.add_stage(
-            PulseStage(ch0_amp=amps[0], ch1_amp=amps[1], duration=stage_duration_us)
-        )
-        if self.isBipolarCheckBox.isChecked():
-            pulse_train.add_stage(
-                PulseStage(
-                    ch0_amp=-1 * amps[0],
-                    ch1_amp=-1 * amps[1],
-                    duration=stage_duration_us,
-                )
-            )
+        for stage in compiled.stages:
+            pulse_train.add_stage(stage)
 
+        if not upload:
+            return
         command = self.stimjim.get_stimjim_string(self.channel_id)
         command += "\n"
         command += self.stimjim.triggers[self.channel_id].get_stimjim_string()
         command += "\n"
         self.stimjim.send_command(command)
 
-    def update_widgets(self):
-        pulse_train = self.stimjim.pulse_trains[self.channel_id]
-        stage0: PulseStage = pulse_train.stages[0]
-        is_bipolar = len(pulse_train.stages) > 1
+    def update_widgets(self, upload: bool = True):
+        from src.SimpleMode import decompile_simple_mode
+        from src.TrainArrays import TrainArrays
+
+        params = decompile_simple_mode(
+            self.channel_id,
+            TrainArrays.from_pulse_trains([self.stimjim.pulse_trains[self.channel_id]]),
+        )
         with QSignalBlocker(self.stimModeComboBox):
-            self.stimModeComboBox.setCurrentIndex(pulse_train.get_mode(self.channel_id))
+            self.stimModeComboBox.setCurrentIndex(int(params["mode"][0]))
             self._on_mode_changed(self.stimModeComboBox.currentIndex())
         with QSignalBlocker(self.stimAmplitudeSpinBox):
-            self.stimAmplitudeSpinBox.setValue(
-                stage0.channel_amps[self.channel_id]
-                / STIMJIM_SCALING_FACTORS[pulse_train.get_mode(self.channel_id)]
-            )
-        stim_duration_us = (
-            stage0.duration_us if not is_bipolar else stage0.duration_us * 2
-        )
-        stim_duration_s = stim_duration_us / STIMJIM_DURATION_SCALING_FACTOR
+            self.stimAmplitudeSpinBox.setValue(float(params["amplitude"][0]))
         with QSignalBlocker(self.stimDurationSpinBox):
-            self.stimDurationSpinBox.setValue(stim_duration_s)
+            self.stimDurationSpinBox.setValue(float(params["pulse_duration_s"][0]))
         with QSignalBlocker(self.isBipolarCheckBox):
-            self.isBipolarCheckBox.setChecked(is_bipolar)
-        n_stim = int(
-            (pulse_train.train_duration_s - stim_duration_s)
-            / (pulse_train.train_period_us * 1e-6)
-            + 1
-        )  # this in the inverse of the calculation in _update_train_duration
+            self.isBipolarCheckBox.setChecked(bool(params["bipolar"][0]))
         with QSignalBlocker(self.stimNPulsesSpinBox):
-            self.stimNPulsesSpinBox.setValue(n_stim)
+            self.stimNPulsesSpinBox.setValue(int(params["n_pulses"][0]))
         with QSignalBlocker(self.stimTrainFreqSpinBox):
-            self.stimTrainFreqSpinBox.setValue(1 / pulse_train.train_period_s)
+            self.stimTrainFreqSpinBox.setValue(float(params["frequency_hz"][0]))
         with QSignalBlocker(self.stimTrainDurationSpinBox):
-            self.stimTrainDurationSpinBox.setValue(pulse_train.train_duration_s)
-        self.update_stimjim()
+            self.stimTrainDurationSpinBox.setValue(float(params["train_duration_s"][0]))
+        if upload:
+            self.update_stimjim()
+
+
+class TriggerScheduleDialog(QDialog):
+    SCHEDULE_TYPES = ["Fixed rate", "Poisson", "List of times"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent=parent)
+        self.setWindowTitle("Trigger schedule")
+        self.triggerSpinBox = QSpinBox(self)
+        self.triggerSpinBox.setRange(0, STIMJIM_N_TRIGGERS - 1)
+        self.trainSpinBox = QSpinBox(self)
+        self.trainSpinBox.setRange(0, STIMJIM_MAX_PULSETRAINS - 1)
+        self.typeComboBox = QComboBox(self)
+        self.typeComboBox.addItems(self.SCHEDULE_TYPES)
+        self.rateSpinBox = QDoubleSpinBox(self)
+        self.rateSpinBox.setRange(0.001, 1000)
+        self.rateSpinBox.setDecimals(3)
+        self.rateSpinBox.setValue(1.0)
+        self.rateSpinBox.setSuffix(" Hz")
+        self.countSpinBox = QSpinBox(self)
+        self.countSpinBox.setRange(1, 1000000)
+        self.countSpinBox.setValue(10)
+        self.timesLineEdit = QLineEdit(self)
+        self.timesLineEdit.setPlaceholderText("0, 0.5, 1.25 (s)")
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow("Trigger", self.triggerSpinBox)
+        layout.addRow("Pulse train", self.trainSpinBox)
+        layout.addRow("Schedule", self.typeComboBox)
+        layout.addRow("Rate", self.rateSpinBox)
+        layout.addRow("Number of triggers", self.countSpinBox)
+        layout.addRow("Times", self.timesLineEdit)
+        layout.addRow(buttons)
+
+        self.typeComboBox.currentIndexChanged.connect(self._on_type_changed)
+        self._on_type_changed(0)
+
+    def _on_type_changed(self, index: int):
+        is_list = self.SCHEDULE_TYPES[index] == "List of times"
+        self.rateSpinBox.setEnabled(not is_list)
+        self.countSpinBox.setEnabled(not is_list)
+        self.timesLineEdit.setEnabled(is_list)
+
+    def get_times_ns(self):
+        schedule_type = self.typeComboBox.currentText()
+        if schedule_type == "Fixed rate":
+            return fixed_rate_times(self.rateSpinBox.value(), self.countSpinBox.value())
+        elif schedule_type == "Poisson":
+            return poisson_times(self.rateSpinBox.value(), self.countSpinBox.value())
+        return list_times(
+            float(t) for t in self.timesLineEdit.text().replace(",", " ").split()
+        )
+
+
+class ThresholdSearchDialog(QDialog):
+    METHODS = ["Binary search", "Staircase"]
+
+    def __init__(self, channel_modes, parent=None):
+        super().__init__(parent=parent)
+        self.setWindowTitle("Threshold search")
+        self.channel_modes = channel_modes
+        self.channelSpinBox = QSpinBox(self)
+        self.channelSpinBox.setRange(0, STIMJIM_N_OUTPUTS - 1)
+        self.methodComboBox = QComboBox(self)
+        self.methodComboBox.addItems(self.METHODS)
+        self.lowSpinBox = ScienDSpinBox(self)
+        self.highSpinBox = ScienDSpinBox(self)
+        self.toleranceSpinBox = ScienDSpinBox(self)
+        self.startSpinBox = ScienDSpinBox(self)
+        self.stepSpinBox = ScienDSpinBox(self)
+        self.amplitudeSpinBoxes = [
+            self.lowSpinBox,
+            self.highSpinBox,
+            self.toleranceSpinBox,
+            self.startSpinBox,
+            self.stepSpinBox,
+        ]
+        self.reversalsSpinBox = QSpinBox(self)
+        self.reversalsSpinBox.setRange(1, 100)
+        self.reversalsSpinBox.setValue(6)
+        self.responseLineEdit = QLineEdit(self)
+        self.responseLineEdit.setPlaceholderText("Manual (Y/N keys), file:/path, udp:host:port or unix:/path")
+        self.timeoutSpinBox = QDoubleSpinBox(self)
+        self.timeoutSpinBox.setRange(0.001, 3600)
+        self.timeoutSpinBox.setDecimals(3)
+        self.timeoutSpinBox.setValue(THRESHOLD_RESPONSE_TIMEOUT_S)
+        self.timeoutSpinBox.setSuffix(" s")
+        self.intervalSpinBox = QDoubleSpinBox(self)
+        self.intervalSpinBox.setRange(0, 3600)
+        self.intervalSpinBox.setDecimals(3)
+        self.intervalSpinBox.setValue(THRESHOLD_INTERVAL_S)
+        self.intervalSpinBox.setSuffix(" s")
+        self.maxTrialsSpinBox = QSpinBox(self)
+        self.maxTrialsSpinBox.setRange(1, 10000)
+        self.maxTrialsSpinBox.setValue(THRESHOLD_MAX_TRIALS)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow("Channel", self.channelSpinBox)
+        layout.addRow("Method", self.methodComboBox)
+        layout.addRow("Lowest amplitude", self.lowSpinBox)
+        layout.addRow("Highest amplitude", self.highSpinBox)
+        layout.addRow("Tolerance", self.toleranceSpinBox)
+        layout.addRow("Start amplitude", self.startSpinBox)
+        layout.addRow("Step", self.stepSpinBox)
+        layout.addRow("Reversals", self.reversalsSpinBox)
+        layout.addRow("Responses", self.responseLineEdit)
+        layout.addRow("Response window", self.timeoutSpinBox)
+        layout.addRow("Minimum interval", self.intervalSpinBox)
+        layout.addRow("Maximum number of trials", self.maxTrialsSpinBox)
+        layout.addRow(buttons)
+
+        self.channelSpinBox.valueChanged.connect(self._on_channel_changed)
+        self.methodComboBox.currentIndexChanged.connect(self._on_method_changed)
+        self._on_channel_changed(0)
+        self._on_method_changed(0)
+
+    def _on_channel_changed(self, channel_id: int):
+        mode = self.channel_modes[channel_id]
+        for box in self.amplitudeSpinBoxes:
+            box.setSuffix(STIMJIM_UNITS[mode])
+            box.setMaximum(STIMJIM_MAX_VALS[mode])
+            box.setMinimum(-1 * STIMJIM_MAX_VALS[mode])
+            box.setSingleStep(STIMJIM_INCREMENT_STEPS[mode], dynamic_stepping=False)
+        self.highSpinBox.setValue(STIMJIM_MAX_VALS[mode])
+        self.toleranceSpinBox.setValue(STIMJIM_INCREMENT_STEPS[mode] * 10)
+        self.startSpinBox.setValue(STIMJIM_MAX_VALS[mode] / 10)
+        self.stepSpinBox.setValue(STIMJIM_MAX_VALS[mode] / 20)
+
+    def _on_method_changed(self, index: int):
+        is_binary = self.METHODS[index] == "Binary search"
+        for box in [self.lowSpinBox, self.highSpinBox, self.toleranceSpinBox]:
+            box.setEnabled(is_binary)
+        for box in [self.startSpinBox, self.stepSpinBox, self.reversalsSpinBox]:
+            box.setEnabled(not is_binary)
+
+    def get_strategy(self):
+        if self.methodComboBox.currentText() == "Binary search":
+            return BinarySearch(
+                self.lowSpinBox.value(),
+                self.highSpinBox.value(),
+                self.toleranceSpinBox.value(),
+            )
+        return Staircase(
+            self.startSpinBox.value(),
+            self.stepSpinBox.value(),
+            n_reversals=self.reversalsSpinBox.value(),
+            min_step=STIMJIM_INCREMENT_STEPS[self.channel_modes[self.channelSpinBox.value()]],
+        )
+
+
+class RecruitmentCurveDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent=parent)
+        self.setWindowTitle("Recruitment curve")
+        self.channelSpinBox = QSpinBox(self)
+        self.channelSpinBox.setRange(0, STIMJIM_N_OUTPUTS - 1)
+        self.fromSpinBox = QDoubleSpinBox(self)
+        self.toSpinBox = QDoubleSpinBox(self)
+        self.stepSpinBox = QDoubleSpinBox(self)
+        for box, value in [(self.fromSpinBox, 0.5), (self.toSpinBox, 3.0), (self.stepSpinBox, 0.25)]:
+            box.setRange(0.01, 100)
+            box.setSingleStep(0.1)
+            box.setValue(value)
+            box.setSuffix(" x T")
+        self.repeatsSpinBox = QSpinBox(self)
+        self.repeatsSpinBox.setRange(1, 10000)
+        self.repeatsSpinBox.setValue(5)
+        self.intervalSpinBox = QDoubleSpinBox(self)
+        self.intervalSpinBox.setRange(0.001, 3600)
+        self.intervalSpinBox.setDecimals(3)
+        self.intervalSpinBox.setValue(2.0)
+        self.intervalSpinBox.setSuffix(" s")
+        self.shuffleCheckBox = QCheckBox(self)
+        self.shuffleCheckBox.setChecked(True)
+        self.externalCheckBox = QCheckBox(self)
+        self.externalCheckBox.setToolTip(
+            "Only retarget the TRIG input at each trial, the trains are fired by the external trigger"
+        )
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow("Channel", self.channelSpinBox)
+        layout.addRow("From", self.fromSpinBox)
+        layout.addRow("To", self.toSpinBox)
+        layout.addRow("Step", self.stepSpinBox)
+        layout.addRow("Repeats", self.repeatsSpinBox)
+        layout.addRow("Interval", self.intervalSpinBox)
+        layout.addRow("Random order", self.shuffleCheckBox)
+        layout.addRow("External trigger", self.externalCheckBox)
+        layout.addRow(buttons)
+
+    def get_levels(self):
+        from src.Recruitment import ladder_levels
+
+        return ladder_levels(
+            self.fromSpinBox.value(), self.toSpinBox.value(), self.stepSpinBox.value()
+        )
+
+
+class ValidationLimitsDialog(QDialog):
+    def __init__(self, limits: ValidationLimits, parent=None):
+        super().__init__(parent=parent)
+        self.setWindowTitle("Safety limits")
+        self.areaSpinBox = QDoubleSpinBox(self)
+        self.areaSpinBox.setDecimals(6)
+        self.areaSpinBox.setRange(0, 100)
+        self.areaSpinBox.setSuffix(" cm²")
+        self.densitySpinBox = QDoubleSpinBox(self)
+        self.densitySpinBox.setRange(0, 1e6)
+        self.densitySpinBox.setSuffix(" μC/cm²")
+        self.netChargeSpinBox = QDoubleSpinBox(self)
+        self.netChargeSpinBox.setRange(0, 1e9)
+        self.netChargeSpinBox.setSuffix(" nC")
+        for box, value in [
+            (self.areaSpinBox, limits.electrode_area_cm2),
+            (self.densitySpinBox, limits.max_charge_density_uc_cm2),
+            (self.netChargeSpinBox, limits.max_net_charge_nc),
+        ]:
+            box.setSpecialValueText("None")  # shown at 0
+            box.setValue(value or 0)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow("Electrode area", self.areaSpinBox)
+        layout.addRow("Max charge density / phase", self.densitySpinBox)
+        layout.addRow("Max net charge / pulse", self.netChargeSpinBox)
+        layout.addRow(buttons)
+
+    def get_limits(self):
+        return ValidationLimits(
+            electrode_area_cm2=self.areaSpinBox.value() or None,
+            max_charge_density_uc_cm2=self.densitySpinBox.value() or None,
+            max_net_charge_nc=self.netChargeSpinBox.value() or None,
+        )
 
 
 class StimJimGUI(QMainWindow):
+    control_server_call = pyqtSignal(object)
+    trigger_run_finished = pyqtSignal(object)
+    protocol_step_started = pyqtSignal(int)
+    protocol_finished = pyqtSignal(object)
+    threshold_trial_done = pyqtSignal(object)
+    threshold_search_finished = pyqtSignal(object)
+    recruitment_trial_done = pyqtSignal(object)
+    recruitment_finished = pyqtSignal(object)
+    config_loaded = pyqtSignal(object)
+    closed_loop_error = pyqtSignal(str)
+
     def __init__(
         self,
         serial_port: serial.Serial,
         log_filename: str = None,
         broadcast: str = None,
+        control_server: str = None,
+        closed_loop: str = None,
         parent=None,
     ):
         super().__init__(parent=parent)
+        self._init_start_ns = time.perf_counter_ns()
+        self.first_paint_ns = None  # time from the start of __init__ to the first paint of the window
         self.serial = serial_port
         self.simple_stimjim = StimJim(serial_port)
         self.full_stimjim = StimJim(serial_port)
@@ -595,56 +1104,127 @@ class StimJimGUI(QMainWindow):
         self.splitter.addWidget(self.serialOutputTextEdit)
         self.setCentralWidget(self.splitter)
 
-        self.tabWidget.currentChanged.connect(self._on_tab_changed)
-
         #
-        # Simple Mode tab
+        # Tabs: the widgets of a tab are only built when it is first shown (see _build_tab)
         #
+        self.validation_limits = ValidationLimits()
         self.simpleModeTab = QWidget(self)
         self.simpleModeTab.setLayout(QHBoxLayout())
         self.simpleModeWidgets = []
-        for ch in range(STIMJIM_N_OUTPUTS):
-            w = SimpleModeWidget(channel_id=ch, stimjim=self.simple_stimjim)
-            self.simpleModeTab.layout().addWidget(w)
-            self.simpleModeWidgets.append(w)
         self.tabWidget.addTab(self.simpleModeTab, "Simple Mode")
-
-        #
-        # Full Mode tab
-        #
         self.fullModeTab = QWidget(self)
         self.fullModeTab.setLayout(QHBoxLayout())
-        self.fullModeWidget = FullModeWidget(stimjim=self.full_stimjim)
-        self.fullModeTab.layout().addWidget(self.fullModeWidget)
+        self.fullModeWidget = None
         self.tabWidget.addTab(self.fullModeTab, "Full Mode")
+        self._build_tab(self.tabWidget.currentIndex())
+        self.tabWidget.currentChanged.connect(self._on_tab_changed)
+        # the device is programmed in a single write after the first paint, see _on_first_paint
+        self.tabWidget.installEventFilter(self)
+
+        #
+        # Statistics panel
+        #
+        self.statisticsDock = TrainStatisticsDock(self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statisticsDock)
+        self.statisticsDock.hide()
+        self.statisticsDock.visibilityChanged.connect(self._on_train_statistics_changed)
+
+        #
+        # Trains overview, built after the first paint (see _build_overview_dock)
+        #
+        self.overviewDock = None
+        self.n_diagnostics = (0, 0)  # errors, warnings
+        self.config_loader = None
+        self.config_loaded.connect(self._on_config_loaded)
 
         #
         # Menu Items
         #
         file_menu = self.menuBar().addMenu("&File")
         action_open_file = file_menu.addAction("&Open configuration file...")
-        action_open_file.setIcon(QIcon(":/icons/Open"))
+        action_open_file.setIcon(get_icon("Open"))
         action_open_file.triggered.connect(self._on_action_open_config)
         action_load_file = file_menu.addAction("&Save current configuration...")
-        action_load_file.setIcon(QIcon(":/icons/Save"))
+        action_load_file.setIcon(get_icon("Save"))
         action_load_file.triggered.connect(self._on_action_save_config)
+        action_stage_banks = file_menu.addAction("Pre-stage configuration &banks...")
+        action_stage_banks.setIcon(get_icon("Open"))
+        action_stage_banks.triggered.connect(self._on_action_stage_banks)
         action_save_log = file_menu.addAction("Save &log to disk...")
-        action_save_log.setIcon(QIcon(":/icons/Stream"))
+        action_save_log.setIcon(get_icon("Stream"))
         action_save_log.triggered.connect(self._on_action_save_log)
         file_menu.addSeparator()
         action_quit = file_menu.addAction("&Quit")
-        action_quit.setIcon(QIcon(":/icons/Quit"))
+        action_quit.setIcon(get_icon("Quit"))
         action_quit.triggered.connect(self.close)
 
-        window_menu = self.menuBar().addMenu("&Window")
-        action_keep_on_top = window_menu.addAction("Keep on &top")
+        self.banks_menu = self.menuBar().addMenu("&Banks")
+        self.banks_menu.setEnabled(False)
+        self.config_banks = None
+
+        self.window_menu = self.menuBar().addMenu("&Window")
+        action_keep_on_top = self.window_menu.addAction("Keep on &top")
         action_keep_on_top.setCheckable(True)
         action_keep_on_top.triggered.connect(self._on_action_keep_on_top)
+        action_statistics = self.statisticsDock.toggleViewAction()
+        action_statistics.setText("Train &statistics")
+        self.window_menu.addAction(action_statistics)
+
+        tools_menu = self.menuBar().addMenu("&Tools")
+        self.action_closed_loop_stats = tools_menu.addAction("&Closed-loop statistics")
+        self.action_closed_loop_stats.triggered.connect(self._on_action_closed_loop_stats)
+        self.action_closed_loop_stats.setEnabled(closed_loop is not None)
+        tools_menu.addSeparator()
+        action_schedule = tools_menu.addAction("Trigger &schedule...")
+        action_schedule.triggered.connect(self._on_action_trigger_schedule)
+        self.action_stop_schedule = tools_menu.addAction("Stop trigger schedule")
+        self.action_stop_schedule.triggered.connect(self._on_action_stop_trigger_schedule)
+        self.action_stop_schedule.setEnabled(False)
+        self.trigger_scheduler = None
+        self.trigger_run_finished.connect(self._on_trigger_run_finished)
+        tools_menu.addSeparator()
+        action_run_protocol = tools_menu.addAction("Run &protocol...")
+        action_run_protocol.triggered.connect(self._on_action_run_protocol)
+        self.action_stop_protocol = tools_menu.addAction("Stop protocol")
+        self.action_stop_protocol.triggered.connect(self._on_action_stop_protocol)
+        self.action_stop_protocol.setEnabled(False)
+        self.protocol_runner = None
+        self.protocol_step_started.connect(self._on_protocol_step_started)
+        self.protocol_finished.connect(self._on_protocol_finished)
+        tools_menu.addSeparator()
+        action_threshold = tools_menu.addAction("Find &threshold...")
+        action_threshold.triggered.connect(self._on_action_threshold_search)
+        self.action_stop_threshold = tools_menu.addAction("Stop threshold search")
+        self.action_stop_threshold.triggered.connect(self._on_action_stop_threshold_search)
+        self.action_stop_threshold.setEnabled(False)
+        self.action_response_yes = tools_menu.addAction("Response: &yes")
+        self.action_response_yes.setShortcut("Y")
+        self.action_response_yes.triggered.connect(lambda: self._on_action_response(True))
+        self.action_response_no = tools_menu.addAction("Response: &no")
+        self.action_response_no.setShortcut("N")
+        self.action_response_no.triggered.connect(lambda: self._on_action_response(False))
+        self.action_response_yes.setEnabled(False)
+        self.action_response_no.setEnabled(False)
+        self.threshold_search = None
+        self.threshold_trial_done.connect(self._on_threshold_trial_done)
+        self.threshold_search_finished.connect(self._on_threshold_search_finished)
+        action_recruitment = tools_menu.addAction("&Recruitment curve...")
+        action_recruitment.triggered.connect(self._on_action_recruitment_curve)
+        self.action_stop_recruitment = tools_menu.addAction("Stop recruitment curve")
+        self.action_stop_recruitment.triggered.connect(self._on_action_stop_recruitment_curve)
+        self.action_stop_recruitment.setEnabled(False)
+        self.recruitment_curve = None
+        self.recruitment_log_filename = None
+        self.recruitment_trial_done.connect(self._on_recruitment_trial_done)
+        self.recruitment_finished.connect(self._on_recruitment_finished)
+        tools_menu.addSeparator()
+        action_limits = tools_menu.addAction("Safety &limits...")
+        action_limits.triggered.connect(self._on_action_validation_limits)
 
         help_menu = self.menuBar().addMenu("&Help")
         # noinspection SpellCheckingInspection
         action_send_command = help_menu.addAction("Send serial co&mmand...")
-        action_send_command.setIcon(QIcon(":/icons/Serial"))
+        action_send_command.setIcon(get_icon("Serial"))
         action_send_command.triggered.connect(self._on_action_send_command)
         self.previous_custom_commands = []
 
@@ -655,25 +1235,99 @@ class StimJimGUI(QMainWindow):
         self.serial_output_timer.timeout.connect(self._on_serial_output_timer)
         self.serial_output_timer.start(SERIAL_READ_INTERVAL_MS)
 
+        #
+        # Control server
+        #
+        self.control_server = None
+        self.control_server_call.connect(self._on_control_server_call)
+        if control_server is not None:
+            from src.ControlServer import StimJimControlServer, StimJimControlServerError
+
+            try:
+                self.control_server = StimJimControlServer(
+                    self.full_stimjim,
+                    control_server,
+                    on_state_changed=self._on_remote_state_changed,
+                    call_in_owner=self._call_in_gui_thread,
+                    is_active=self._is_full_mode_on_device,
+                )
+                self.control_server.validation_limits = self.validation_limits
+                self.control_server.start()
+            except (StimJimControlServerError, ValueError) as e:
+                # ValueError: the port of the address is not a number
+                self.control_server = None
+                self.serialOutputTextEdit.appendPlainText(f"Error starting control server: {e}")
+
+        #
+        # Closed-loop triggering
+        #
+        self.closed_loop = None
+        self.closed_loop_error.connect(self.serialOutputTextEdit.appendPlainText)
+        if closed_loop is not None:
+            from src.ClosedLoop import ClosedLoopTrigger
+
+            try:
+                self.closed_loop = ClosedLoopTrigger.from_file(
+                    self.full_stimjim, closed_loop, on_error=self.closed_loop_error.emit
+                )
+                self.closed_loop.start()
+            except (OSError, ValueError) as e:
+                # json.JSONDecodeError is a ValueError
+                self.closed_loop = None
+                self.action_closed_loop_stats.setEnabled(False)
+                self.serialOutputTextEdit.appendPlainText(f"Error starting closed-loop triggering: {e}")
+
+    def closeEvent(self, event):
+        if self.recruitment_curve is not None:
+            self.recruitment_curve.stop()
+        if self.threshold_search is not None:
+            self.threshold_search.stop()
+        if self.protocol_runner is not None:
+            self.protocol_runner.stop()
+        if self.trigger_scheduler is not None:
+            self.trigger_scheduler.stop()
+        if self.control_server is not None:
+            self.control_server.stop()
+        if self.closed_loop is not None:
+            self.closed_loop.stop()
+            logger.info(self.closed_loop.summary())
+        if self.config_loader is not None:
+            self.config_loader.stop()
+        super().closeEvent(event)
+
     def to_json(self):
         json_dict = {
             "CurrentTab": self.tabWidget.currentIndex(),
             "SimpleMode": self.simple_stimjim.to_json(),
             "FullMode": self.full_stimjim.to_json(),
+            "SafetyLimits": self.validation_limits.to_json(),
         }
         return json_dict
 
     def _on_serial_output_timer(self):
-        recv = self.full_stimjim.read_serial()
+        try:
+            events = self.full_stimjim.read_serial_events()
+        except serial.SerialException as e:
+            # e.g. the StimJim was unplugged, or its device process stopped
+            self.serial_output_timer.stop()
+            self.serialOutputTextEdit.appendPlainText(f"Error reading from the StimJim, stopped reading: {e}")
+            return
+        recv = "".join(text for _, text in events)
         if len(recv.strip()) > 0:
             # only keep actual content, StimJim sometimes sends a bunch of CR for no reason
             self.serialOutputTextEdit.appendPlainText(recv)
             self.serialOutputTextEdit.ensureCursorVisible()  # scroll to bottom
+            if self.control_server is not None:
+                # with --device-process, the time each chunk was read from the serial port, not by this timer
+                for t_ns, text in events:
+                    self.control_server.publish(text, t_ns)
             if self.log_filename is not None:
                 with open(self.log_filename, "a") as f:
                     f.write(recv)
             if "Train complete" in recv and self.broadcast:
                 logger.debug(f"Sending message [{recv}] to [{self.broadcast}]")
+                import requests
+
                 try:
                     r = requests.put(
                         f"http://{self.broadcast}/api/message", json={"text": f"{recv}"}
@@ -698,6 +1352,201 @@ class StimJimGUI(QMainWindow):
                 self.previous_custom_commands.insert(0, command)
             self.full_stimjim.send_command(command)
 
+    def _on_action_closed_loop_stats(self):
+        if self.closed_loop is not None:
+            self.serialOutputTextEdit.appendPlainText(self.closed_loop.summary())
+
+    def _on_action_trigger_schedule(self):
+        if self.trigger_scheduler is not None and self.trigger_scheduler.is_running:
+            return
+        dialog = TriggerScheduleDialog(self)
+        if dialog.exec() != QDialog.Accepted:
+            return
+        try:
+            times_ns = dialog.get_times_ns()
+        except ValueError:
+            self.serialOutputTextEdit.appendPlainText("Invalid list of trigger times")
+            return
+        self.trigger_scheduler = TriggerScheduler(
+            self.full_stimjim,
+            trigger=dialog.triggerSpinBox.value(),
+            train=dialog.trainSpinBox.value(),
+            times_ns=times_ns,
+            on_finished=self.trigger_run_finished.emit,
+        )
+        self.trigger_scheduler.start()
+        self.action_stop_schedule.setEnabled(True)
+
+    def _on_action_stop_trigger_schedule(self):
+        if self.trigger_scheduler is not None:
+            self.trigger_scheduler.stop()
+
+    def _on_trigger_run_finished(self, run):
+        self.action_stop_schedule.setEnabled(False)
+        self.serialOutputTextEdit.appendPlainText(run.summary())
+
+    def _on_action_run_protocol(self):
+        if self.protocol_runner is not None and self.protocol_runner.is_running:
+            return
+        filename, ok = QFileDialog.getOpenFileName(
+            self, "Open protocol file", str(Path.home()), "Json files (*.json)"
+        )
+        if not (ok and Path(filename).is_file()):
+            return
+        try:
+            self.protocol_runner = ProtocolRunner(
+                self.full_stimjim,
+                Protocol.from_file(filename),
+                on_step=self.protocol_step_started.emit,
+                on_finished=self.protocol_finished.emit,
+                limits=self.validation_limits,
+            )
+        except (ProtocolError, OSError, ValueError, KeyError) as e:
+            self.serialOutputTextEdit.appendPlainText(f"Error loading protocol file: {e}")
+            return
+        self.serialOutputTextEdit.appendPlainText(
+            f"Running protocol {Path(filename).name} "
+            f"({len(self.protocol_runner.compiled)} steps, {self.protocol_runner.duration_ns / 1e9:.1f} s)"
+        )
+        self.protocol_runner.start()
+        self.action_stop_protocol.setEnabled(True)
+
+    def _on_action_stop_protocol(self):
+        if self.protocol_runner is not None:
+            self.protocol_runner.stop()
+
+    def _on_protocol_step_started(self, index: int):
+        step = self.protocol_runner.compiled[index]
+        self.serialOutputTextEdit.appendPlainText(f"Protocol step {index + 1}: {step.kind}")
+
+    def _on_protocol_finished(self, runner):
+        self.action_stop_protocol.setEnabled(False)
+        self.serialOutputTextEdit.appendPlainText(runner.summary())
+
+    def _on_action_threshold_search(self):
+        if self.threshold_search is not None and self.threshold_search.is_running:
+            return
+        channel_modes = [
+            self.simple_stimjim.pulse_trains[ch].get_mode(ch) for ch in range(STIMJIM_N_OUTPUTS)
+        ]
+        dialog = ThresholdSearchDialog(channel_modes, self)
+        if dialog.exec() != QDialog.Accepted:
+            return
+        channel_id = dialog.channelSpinBox.value()
+        if STIMJIM_MAX_VALS[channel_modes[channel_id]] == 0:
+            self.serialOutputTextEdit.appendPlainText(
+                f"CH {channel_id} is {STIMJIM_MODE_NAMES[channel_modes[channel_id]]}, select a stimulation mode first"
+            )
+            return
+        source = response_source_from_address(dialog.responseLineEdit.text().strip())
+        self.threshold_search = ThresholdSearch(
+            self.simple_stimjim,
+            channel_id,
+            dialog.get_strategy(),
+            source,
+            response_timeout_s=dialog.timeoutSpinBox.value(),
+            interval_s=dialog.intervalSpinBox.value(),
+            max_trials=dialog.maxTrialsSpinBox.value(),
+            on_trial=self.threshold_trial_done.emit,
+            on_finished=self.threshold_search_finished.emit,
+        )
+        try:
+            self.threshold_search.start()
+        except (OSError, ValueError) as e:
+            self.serialOutputTextEdit.appendPlainText(f"Error opening response source: {e}")
+            return
+        is_manual = isinstance(source, ManualResponseSource)
+        self.action_response_yes.setEnabled(is_manual)
+        self.action_response_no.setEnabled(is_manual)
+        self.action_stop_threshold.setEnabled(True)
+
+    def _on_action_stop_threshold_search(self):
+        if self.threshold_search is not None:
+            self.threshold_search.stop()
+
+    def _on_action_response(self, response: bool):
+        if self.threshold_search is not None and isinstance(
+            self.threshold_search.source, ManualResponseSource
+        ):
+            self.threshold_search.source.respond(response)
+
+    def _on_threshold_trial_done(self, trial):
+        amplitude, response = trial
+        self.statusBar().showMessage(
+            f"Threshold search: {amplitude:g} -> {'response' if response else 'no response'}"
+        )
+
+    def _on_threshold_search_finished(self, search):
+        self.action_stop_threshold.setEnabled(False)
+        self.action_response_yes.setEnabled(False)
+        self.action_response_no.setEnabled(False)
+        self.serialOutputTextEdit.appendPlainText(search.summary())
+        if search.threshold is not None:
+            self._build_tab(CONFIG_SIMPLE_MODE_TAB)
+            self.simpleModeWidgets[search.channel_id].set_threshold(search.threshold, upload=False)
+        # the search fires the Simple Mode trains, which replaced the trains of the same slots of Full Mode. The
+        # active tab is sent last, so that the device ends up with its state
+        self.send_tab_state(self.tabWidget.currentIndex())
+
+    def _on_action_recruitment_curve(self):
+        if self.recruitment_curve is not None and self.recruitment_curve.is_running:
+            return
+        dialog = RecruitmentCurveDialog(self)
+        if dialog.exec() != QDialog.Accepted:
+            return
+        self._build_tab(CONFIG_SIMPLE_MODE_TAB)
+        widget = self.simpleModeWidgets[dialog.channelSpinBox.value()]
+        if not widget.thresholdButton.isChecked():
+            self.serialOutputTextEdit.appendPlainText(
+                f"Set the threshold of CH {widget.channel_id} first (threshold button or Tools > Find threshold...)"
+            )
+            return
+        from src.Recruitment import RecruitmentCurve
+
+        try:
+            self.recruitment_curve = RecruitmentCurve(
+                self.simple_stimjim,
+                widget.channel_id,
+                widget.thresholdValueSpinBox.value(),
+                dialog.get_levels(),
+                n_repeats=dialog.repeatsSpinBox.value(),
+                interval_s=dialog.intervalSpinBox.value(),
+                shuffle=dialog.shuffleCheckBox.isChecked(),
+                manual=not dialog.externalCheckBox.isChecked(),
+                on_trial=self.recruitment_trial_done.emit,
+                on_finished=self.recruitment_finished.emit,
+                limits=self.validation_limits,
+            )
+        except (StimJimNoFreeSlotException, ValueError) as e:
+            self.serialOutputTextEdit.appendPlainText(f"Error preparing recruitment curve: {e}")
+            return
+        filename, _ = QFileDialog.getSaveFileName(
+            self, "Save trial log", str(Path.home()), "CSV files (*.csv)"
+        )
+        self.recruitment_log_filename = filename or None
+        self.recruitment_curve.start()
+        self.action_stop_recruitment.setEnabled(True)
+
+    def _on_action_stop_recruitment_curve(self):
+        if self.recruitment_curve is not None:
+            self.recruitment_curve.stop()
+
+    def _on_recruitment_trial_done(self, entry):
+        trial, level, amplitude, slot, _, _ = entry
+        self.statusBar().showMessage(
+            f"Recruitment curve: trial {trial + 1}/{len(self.recruitment_curve.order)}, "
+            f"{level:g} x T ({amplitude:g}), train {slot}"
+        )
+
+    def _on_recruitment_finished(self, curve):
+        # the ladder replaced trains 2-99 and retargeted the trigger, which Full Mode may be using
+        self.send_tab_state(self.tabWidget.currentIndex())
+        self.action_stop_recruitment.setEnabled(False)
+        self.serialOutputTextEdit.appendPlainText(curve.summary())
+        if self.recruitment_log_filename is not None:
+            curve.save_log(self.recruitment_log_filename)
+            self.serialOutputTextEdit.appendPlainText(f"Trial log saved to {self.recruitment_log_filename}")
+
     def _on_action_keep_on_top(self, checked: bool):
         if checked:
             self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
@@ -706,8 +1555,175 @@ class StimJimGUI(QMainWindow):
             self.setWindowFlags(self.windowFlags() & ~Qt.WindowStaysOnTopHint)
             self.show()
 
+    # noinspection PyUnusedLocal
+    def _on_train_statistics_changed(self, *args):
+        self.statisticsDock.update_statistics(self.full_stimjim)
+
+    # noinspection PyUnusedLocal
+    def _on_train_overview_changed(self, *args):
+        if self.overviewDock is not None:
+            self.overviewDock.update_overview()
+
+    def _on_validation_changed(self, diagnostics):
+        n_errors = sum(d.severity == Severity.ERROR for d in diagnostics)
+        n_diagnostics = (n_errors, len(diagnostics) - n_errors)
+        if n_diagnostics == self.n_diagnostics:
+            return
+        if n_diagnostics != (0, 0):
+            self.statusBar().showMessage(
+                f"Full Mode: {n_diagnostics[0]} error(s), {n_diagnostics[1]} warning(s), "
+                f"trains with errors are not uploaded"
+            )
+        else:
+            self.statusBar().clearMessage()
+        for diagnostic in diagnostics:
+            if diagnostic.severity == Severity.ERROR:
+                logger.debug(repr(diagnostic))
+        self.n_diagnostics = n_diagnostics
+
+    def _on_action_validation_limits(self):
+        dialog = ValidationLimitsDialog(self.validation_limits, self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.set_validation_limits(dialog.get_limits())
+
+    def set_validation_limits(self, limits: ValidationLimits):
+        self.validation_limits = limits
+        if self.control_server is not None:
+            self.control_server.validation_limits = limits
+        if self.fullModeWidget is not None:
+            self.fullModeWidget.validation_limits = limits
+            self.fullModeWidget.validate()
+
+    def get_tab_state_commands(self, index: int) -> List[str]:
+        """
+        Returns the commands setting the device in the state wanted by that tab: all the valid trains and the triggers in
+        Full Mode, the trains of each channel and the triggers in Simple Mode
+        """
+        if index == CONFIG_FULL_MODE_TAB:
+            if self.fullModeWidget is not None:
+                diagnostics = self.fullModeWidget.validate(train_ids=())  # up to date unless the model was replaced
+            else:
+                diagnostics = validate_stimjim(self.full_stimjim, self.validation_limits)
+            excluded = {d.train for d in diagnostics if d.severity == Severity.ERROR}
+            return self.full_stimjim.get_state_commands(excluded=excluded)
+        return self.simple_stimjim.get_state_commands(range(STIMJIM_N_OUTPUTS))
+
+    def _build_tab(self, index: int):
+        """
+        Builds the widgets of the tab, if not done yet. They show the current state of the model, without uploading it.
+        Simple Mode widgets built before the first paint set the model instead, see _on_first_paint
+        """
+        if index == CONFIG_SIMPLE_MODE_TAB and not self.simpleModeWidgets:
+            for ch in range(STIMJIM_N_OUTPUTS):
+                w = SimpleModeWidget(channel_id=ch, stimjim=self.simple_stimjim)
+                self.simpleModeTab.layout().addWidget(w)
+                self.simpleModeWidgets.append(w)
+                if self.first_paint_ns is not None:
+                    w.update_widgets(upload=False)
+        elif index == CONFIG_FULL_MODE_TAB and self.fullModeWidget is None:
+            self.fullModeWidget = FullModeWidget(stimjim=self.full_stimjim)
+            self.fullModeWidget.validation_limits = self.validation_limits
+            self.fullModeTab.layout().addWidget(self.fullModeWidget)
+            self.fullModeWidget.trainsChanged.connect(self._on_train_statistics_changed)
+            self.fullModeWidget.trainsChanged.connect(self._on_train_overview_changed)
+            self.fullModeWidget.validationChanged.connect(self._on_validation_changed)
+            self.fullModeWidget.update_widgets()
+
+    def eventFilter(self, obj, event):
+        if obj is self.tabWidget and event.type() == QEvent.Paint and self.first_paint_ns is None:
+            self.first_paint_ns = time.perf_counter_ns() - self._init_start_ns
+            QTimer.singleShot(0, self._on_first_paint)
+        return super().eventFilter(obj, event)
+
+    def _on_first_paint(self):
+        self.tabWidget.removeEventFilter(self)
+        self._build_overview_dock()
+        for w in self.simpleModeWidgets:
+            w.update_stimjim(upload=False)
+        n_bytes = self.send_tab_state(self.tabWidget.currentIndex())
+        message = f"Window shown in {self.first_paint_ns / 1e6:.0f} ms, {n_bytes} bytes sent to the StimJim"
+        logger.info(message)
+        self.statusBar().showMessage(message)
+
+    def _build_overview_dock(self):
+        # the overview needs NumPy, which is not imported before the window is shown
+        from src.TrainOverview import TrainOverviewDock
+
+        self.overviewDock = TrainOverviewDock(self.full_stimjim, self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.overviewDock)
+        self.overviewDock.hide()
+        self.overviewDock.visibilityChanged.connect(self._on_train_overview_changed)
+        self.overviewDock.model.trainsEdited.connect(self._on_overview_trains_edited)
+        action_overview = self.overviewDock.toggleViewAction()
+        action_overview.setText("Trains &overview")
+        self.window_menu.addAction(action_overview)
+
+    def send_tab_state(self, index: int) -> int:
+        """
+        Sends what the device is missing of the state of the tab (see StimJim.send_state), and returns the number of
+        bytes sent
+        """
+        stimjim = self.full_stimjim if index == CONFIG_FULL_MODE_TAB else self.simple_stimjim
+        return stimjim.send_state(self.get_tab_state_commands(index))
+
     def _on_tab_changed(self, index: int):
-        pass
+        self._build_tab(index)
+        if self.first_paint_ns is None:
+            return  # the device has not been programmed yet
+        t_start = time.perf_counter_ns()
+        n_bytes = self.send_tab_state(index)
+        latency_ns = time.perf_counter_ns() - t_start
+        logger.debug(f"Switched to tab {index}: sent {n_bytes} bytes in {latency_ns / 1e3:.0f} μs")
+        self.statusBar().showMessage(
+            f"Switched to {self.tabWidget.tabText(index)}: {n_bytes} bytes sent in {latency_ns / 1e3:.0f} μs"
+        )
+
+    def _call_in_gui_thread(self, function, *args):
+        """
+        Runs function(*args) in the GUI thread, which owns the models, and returns a concurrent.futures.Future of its
+        result. Can be called from any thread
+        """
+        from concurrent.futures import Future
+
+        future = Future()
+        self.control_server_call.emit((future, function, args))
+        return future
+
+    @staticmethod
+    def _on_control_server_call(call):
+        future, function, args = call
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _is_full_mode_on_device(self) -> bool:
+        # until the first paint, and while Simple Mode is displayed, the device does not run the Full Mode model
+        return self.first_paint_ns is not None and self.tabWidget.currentIndex() == CONFIG_FULL_MODE_TAB
+
+    def _on_remote_state_changed(self, train_id):
+        # the control server modified the Full Mode model from another process, refresh the widgets and the
+        # diagnostics of the train, which decide whether it is uploaded when switching to Full Mode
+        if self.fullModeWidget is not None:
+            if train_id is None or train_id == self.fullModeWidget.pulseTrainIDSpinBox.value():
+                self.fullModeWidget.update_widgets()
+            if train_id is not None:
+                self.fullModeWidget.validate([train_id])
+        if train_id is not None:
+            self._on_train_statistics_changed()
+            self._on_train_overview_changed()
+
+    def _on_overview_trains_edited(self, train_ids):
+        self._build_tab(CONFIG_FULL_MODE_TAB)
+        if self.tabWidget.currentIndex() != CONFIG_FULL_MODE_TAB:
+            # the device runs the Simple Mode configuration: only the model changes, and the next switch to Full Mode
+            # sends the difference
+            self.fullModeWidget.update_widgets()
+            self._on_train_statistics_changed()
+            return
+        self.fullModeWidget.upload_trains(train_ids)
 
     def _on_action_save_config(self):
         filename, ok = QFileDialog.getSaveFileName(
@@ -717,6 +1733,59 @@ class StimJimGUI(QMainWindow):
             with open(filename, "w") as f:
                 json.dump(self.to_json(), f, indent=4)
 
+    def _on_action_stage_banks(self):
+        filenames, ok = QFileDialog.getOpenFileNames(
+            self, "Open configuration files", str(Path.home()), "Json files (*.json)"
+        )
+        if not (ok and filenames):
+            return
+        try:
+            config_banks = ConfigBanks(self.full_stimjim, len(filenames), limits=self.validation_limits)
+            for i, filename in enumerate(filenames):
+                with open(filename, "r") as f:
+                    json_dict = json.load(f)
+                config_banks.load(i, json_dict.get("FullMode", json_dict), name=Path(filename).stem)
+        except (StimJimBankFullException, OSError, ValueError, KeyError) as e:
+            self.serialOutputTextEdit.appendPlainText(f"Error loading configuration banks: {e}")
+            return
+        # the banks are Full Mode trains, the device must not keep running the Simple Mode configuration
+        self._build_tab(CONFIG_FULL_MODE_TAB)
+        config_banks.upload()
+        self.config_banks = config_banks
+        if self.tabWidget.currentIndex() != CONFIG_FULL_MODE_TAB:
+            self.tabWidget.setCurrentIndex(CONFIG_FULL_MODE_TAB)  # sends the rest of the Full Mode state
+        self.set_full_stimjim(self.full_stimjim)  # shows the trains of the banks
+
+        self.banks_menu.clear()
+        for i, bank in enumerate(config_banks.banks):
+            action = self.banks_menu.addAction(f"&{i + 1}: {bank.name}")
+            action.setCheckable(True)
+            if i < 9:
+                action.setShortcut(f"Ctrl+{i + 1}")
+            action.triggered.connect(lambda _, index=i: self._on_action_switch_bank(index))
+        self.banks_menu.setEnabled(True)
+        self.serialOutputTextEdit.appendPlainText(
+            "Pre-staged configuration banks: " + ", ".join(str(bank) for bank in config_banks.banks)
+        )
+
+    def _on_action_switch_bank(self, index: int):
+        if self.tabWidget.currentIndex() != CONFIG_FULL_MODE_TAB:
+            self.tabWidget.setCurrentIndex(CONFIG_FULL_MODE_TAB)
+        latency_ns = self.config_banks.switch(index)
+        # the triggers of the model were retargeted, so that Full Mode edits do not undo the switch
+        self.fullModeWidget.update_widgets()
+        self._on_train_overview_changed()
+        for i, action in enumerate(self.banks_menu.actions()):
+            action.setChecked(i == index)
+        self.statusBar().showMessage(
+            f"Switched to configuration '{self.config_banks.banks[index].name}' in {latency_ns / 1e3:.0f} μs"
+        )
+
+    def _clear_config_banks(self):
+        self.config_banks = None
+        self.banks_menu.clear()
+        self.banks_menu.setEnabled(False)
+
     def _on_action_save_log(self):
         filename, ok = QFileDialog.getSaveFileName(
             self, "Save current configuration", str(Path.home()), "Text file (*.txt)"
@@ -731,38 +1800,60 @@ class StimJimGUI(QMainWindow):
             self, "Open configuration file", str(Path.home()), "Json files (*.json)"
         )
         if ok and Path(filename).is_file():
-            with open(filename, "r") as f:
-                json_dict = json.load(f)
-
-            if "CurrentTab" in json_dict:
-                self.tabWidget.setCurrentIndex(json_dict["CurrentTab"])
-
-            if self.tabWidget.currentIndex() == 0:
-                self.update_full_mode_widget(json_dict=json_dict["FullMode"])
-                self.update_simple_mode_widget(json_dict=json_dict["SimpleMode"])
-            else:
-                self.update_simple_mode_widget(json_dict=json_dict["SimpleMode"])
-                self.update_full_mode_widget(json_dict=json_dict["FullMode"])
-
-    def update_full_mode_widget(self, json_dict):
-        try:
-            temp_stimjim = StimJim(self.serial)
-            temp_stimjim.from_json(json_dict=json_dict)
-            self.full_stimjim = temp_stimjim
-            self.fullModeWidget.stimjim = temp_stimjim
+            if self.config_loader is not None and self.config_loader.is_running:
+                self.statusBar().showMessage("A configuration file is already being loaded")
+                return
+            # parsing, validation and upload happen in the loader thread, widgets are refreshed in _on_config_loaded
+            self.config_loader = ConfigLoader(
+                filename,
+                self.serial,
+                self.tabWidget.currentIndex(),
+                self.validation_limits,
+                on_finished=self.config_loaded.emit,
+            )
+            self.statusBar().showMessage(f"Loading {filename}...")
+            self.config_loader.start()
+
+    def _on_config_loaded(self, loader: ConfigLoader):
+        if loader.error is not None:
+            self.serialOutputTextEdit.appendPlainText(f"Error loading config file: {loader.error}")
+            self.statusBar().clearMessage()
+            return
+        t_start = time.perf_counter_ns()
+        config = loader.config
+        self.validation_limits = loader.limits
+        if self.control_server is not None:
+            self.control_server.validation_limits = loader.limits
+        if self.fullModeWidget is not None:
+            self.fullModeWidget.validation_limits = loader.limits
+        # the loader has already sent the state of the current tab, the widgets only need to show it
+        self.set_simple_stimjim(config.simple_stimjim)
+        self.set_full_stimjim(config.full_stimjim)
+        self._clear_config_banks()  # their trains were replaced
+        with QSignalBlocker(self.tabWidget):
+            self.tabWidget.setCurrentIndex(loader.current_tab)
+        self._build_tab(loader.current_tab)
+        widgets_ns = time.perf_counter_ns() - t_start
+        message = f"{loader.summary()}, widgets {widgets_ns / 1e6:.1f} ms"
+        logger.info(message)
+        self.statusBar().showMessage(message)
+
+    def set_full_stimjim(self, stimjim: StimJim):
+        self.full_stimjim = stimjim
+        if self.overviewDock is not None:
+            self.overviewDock.set_stimjim(stimjim)
+        if self.control_server is not None:
+            self.control_server.stimjim = stimjim
+        if self.closed_loop is not None:
+            self.closed_loop.stimjim = stimjim
+        if self.fullModeWidget is not None:
+            self.fullModeWidget.stimjim = stimjim
             self.fullModeWidget.update_widgets()
-        except Exception as e:
-            self.serialOutputTextEdit.appendPlainText("Error loading config file")
-            logger.debug(f"Error while loading config file in Full Mode: {str(e)}")
-
-    def update_simple_mode_widget(self, json_dict):
-        try:
-            temp_stimjim = StimJim(self.serial)
-            temp_stimjim.from_json(json_dict=json_dict)
-            self.simple_stimjim = temp_stimjim
-            for w in self.simpleModeWidgets:
-                w.stimjim = temp_stimjim
-                w.update_widgets()
-        except Exception as e:
-            self.serialOutputTextEdit.appendPlainText("Error loading config file")
-            logger.debug(f"Error while loading config file in Simple Mode: {str(e)}")
+        self._on_train_statistics_changed()
+        self._on_train_overview_changed()
+
+    def set_simple_stimjim(self, stimjim: StimJim):
+        self.simple_stimjim = stimjim
+        for w in self.simpleModeWidgets:
+            w.stimjim = stimjim
+            w.update_widgets(upload=False)
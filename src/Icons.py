@@ -0,0 +1,92 @@
+"""
+Icons of the application (":/icons/<name>"), registered with the Qt resource system only when the first icon is needed.
+
+resources/resources.py embeds the icons as Python bytes literals, which are parsed and registered when it is imported.
+Instead, its data is written once to a binary resource file (ICONS_RCC_PATH, the format of `rcc -binary`), which Qt
+memory-maps when it is registered. The file is generated again whenever resources.py changes, and can be generated at
+install time with `python -m src.Icons`. If it cannot be written, resources.py is imported as before. The QIcon objects
+are cached, so that each icon is only decoded once.
+"""
+import ast
+import logging
+from pathlib import Path
+from typing import Dict
+
+from PyQt5.QtCore import QResource
+from PyQt5.QtGui import QIcon
+
+ICONS_RESOURCES_DIR = Path(__file__).resolve().parent.parent / "resources"
+ICONS_RESOURCES_MODULE_PATH = ICONS_RESOURCES_DIR / "resources.py"
+ICONS_RCC_PATH = ICONS_RESOURCES_DIR / "resources.rcc"
+ICONS_RCC_VERSION = 2  # version of qt_resource_struct_v2, supported since Qt 5.8
+ICONS_PREFIX = ":/icons/"
+
+logger = logging.getLogger("StimJimGUI")
+
+_registered = False
+_icons: Dict[str, QIcon] = {}
+
+
+def build_rcc(path: Path = ICONS_RCC_PATH) -> Path:
+    """
+    Writes the resources embedded in resources.py to path, as a binary resource file. Raises OSError if it cannot be
+    written
+    """
+    # read the literals without running the module, which would register them
+    blobs = {}
+    for node in ast.parse(ICONS_RESOURCES_MODULE_PATH.read_text()).body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and isinstance(node.value.value, bytes):
+                    blobs[target.id] = node.value.value
+    data, names, tree = blobs["qt_resource_data"], blobs["qt_resource_name"], blobs["qt_resource_struct_v2"]
+    # header: magic, format version, offsets of the tree, data and names (from the start of the file), then the blobs
+    header_size = 20
+    data_offset = header_size
+    names_offset = data_offset + len(data)
+    tree_offset = names_offset + len(names)
+    header = b"qres" + b"".join(
+        n.to_bytes(4, "big") for n in (ICONS_RCC_VERSION, tree_offset, data_offset, names_offset)
+    )
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(header + data + names + tree)
+    tmp_path.replace(path)  # so that another instance never registers a partial file
+    logger.debug(f"Wrote {ICONS_RESOURCES_MODULE_PATH} to {path}")
+    return path
+
+
+def register_resources():
+    """
+    Makes the ":/icons/..." resources available, once. Needed before building a form or an icon
+    """
+    global _registered
+    if _registered:
+        return
+    try:
+        if (
+            not ICONS_RCC_PATH.is_file()
+            or ICONS_RCC_PATH.stat().st_mtime < ICONS_RESOURCES_MODULE_PATH.stat().st_mtime
+        ):
+            build_rcc()
+        if not QResource.registerResource(str(ICONS_RCC_PATH)):
+            raise OSError(f"{ICONS_RCC_PATH} is not a valid resource file")
+    except OSError as e:
+        logger.debug(f"Could not use {ICONS_RCC_PATH}, registering the resources of {ICONS_RESOURCES_MODULE_PATH} ({e})")
+        # noinspection PyUnresolvedReferences
+        import resources.resources
+    _registered = True
+
+
+def get_icon(name: str) -> QIcon:
+    """
+    Returns the icon ":/icons/<name>"
+    """
+    icon = _icons.get(name)
+    if icon is None:
+        register_resources()
+        icon = _icons[name] = QIcon(ICONS_PREFIX + name)
+    return icon
+
+
+if __name__ == "__main__":
+    print(f"{ICONS_RESOURCES_MODULE_PATH} -> {build_rcc()}")
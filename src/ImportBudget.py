@@ -0,0 +1,113 @@
+"""
+Import-time budget of the GUI entry point: imports StimJimGUI.py in fresh interpreters with `python -X importtime`, prints
+the modules that take the most time, and fails (exit code 1) when:
+ - the import takes longer than the budget
+ - Qt is not the main cost of the import (less than IMPORT_MIN_QT_SHARE of the total)
+ - a module that should only be imported when its feature is used (IMPORT_DEFERRED_MODULES) is imported
+
+Usage: python -m src.ImportBudget [--budget-ms 250] [--repeat 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+IMPORT_ENTRY_POINT = "StimJimGUI"
+IMPORT_BUDGET_MS = 250.0  # generous, to pass on slow laptops: the point is to catch regressions
+IMPORT_MIN_QT_SHARE = 0.4  # the rest is the standard library and our own modules
+IMPORT_DEFERRED_MODULES = [
+    "numpy",  # Simple Mode compiler, validation, statistics, overview, waveform preview
+    "requests",  # broadcasting to OpenEphys
+    "asyncio",  # control server, closed-loop triggering
+    "multiprocessing",  # device process
+    "PyQt5.uic",  # only needed to compile the forms (see src.UiForms)
+    "resources.resources",  # the icons are registered from resources/resources.rcc (see src.Icons)
+]
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """
+    Returns the (name, depth, self_us, cumulative_us) of each import reported by -X importtime, in the order of the
+    report (a module comes after the modules it imports)
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure(entry_point: str = IMPORT_ENTRY_POINT) -> List[Tuple[str, int, int, int]]:
+    """
+    Returns the imports caused by entry_point (see parse_importtime), measured in a new interpreter
+    """
+    # like in a normal installation, the bytecode is compiled by the first run and reused by the next ones
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {entry_point}"],
+        cwd=REPO_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = parse_importtime(result.stderr)
+    # only keep the entry point and its dependencies, not what the interpreter imports at startup
+    end = max(i for i, entry in enumerate(entries) if entry[0] == entry_point and entry[1] == 0)
+    start = max((i + 1 for i in range(end) if entries[i][1] == 0), default=0)
+    return entries[start : end + 1]
+
+
+def best_of(n_runs: int, entry_point: str = IMPORT_ENTRY_POINT) -> Dict[str, Tuple[int, int]]:
+    """
+    Returns {module: (self_us, cumulative_us)}, the fastest of n_runs imports for each module, to limit the noise
+    """
+    best = {}
+    for _ in range(n_runs):
+        for name, _, self_us, cumulative_us in measure(entry_point):
+            previous = best.get(name, (self_us, cumulative_us))
+            best[name] = (min(previous[0], self_us), min(previous[1], cumulative_us))
+    return best
+
+
+def check(times: Dict[str, Tuple[int, int]], budget_ms: float, entry_point: str = IMPORT_ENTRY_POINT) -> List[str]:
+    """
+    Returns the reasons why the import of entry_point is over budget (empty if it is not)
+    """
+    failures = []
+    total_ms = times[entry_point][1] / 1e3
+    qt_ms = sum(self_us for name, (self_us, _) in times.items() if name.split(".")[0] == "PyQt5") / 1e3
+    if total_ms > budget_ms:
+        failures.append(f"import of {entry_point} took {total_ms:.1f} ms, the budget is {budget_ms:g} ms")
+    if qt_ms < IMPORT_MIN_QT_SHARE * total_ms:
+        failures.append(f"Qt only takes {qt_ms:.1f} ms of {total_ms:.1f} ms, other modules should be imported lazily")
+    for module in IMPORT_DEFERRED_MODULES:
+        if module in times:
+            failures.append(f"{module} is imported at startup, it should only be imported when used")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="StimJimImportBudget", description="Checks the import time of the StimJimGUI entry point"
+    )
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS, help="maximum import time, in ms")
+    parser.add_argument("--repeat", type=int, default=5, help="number of imports, the fastest one is kept")
+    parser.add_argument("--top", type=int, default=15, help="number of modules listed")
+    args = parser.parse_args()
+
+    times = best_of(args.repeat)
+    print(f"{'self [ms]':>10} {'cumulative [ms]':>16}  module")
+    for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][0])[: args.top]:
+        print(f"{self_us / 1e3:10.1f} {cumulative_us / 1e3:16.1f}  {name}")
+    print(f"Total: {times[IMPORT_ENTRY_POINT][1] / 1e3:.1f} ms (budget {args.budget_ms:g} ms)")
+    failures = check(times, args.budget_ms)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
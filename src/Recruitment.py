@@ -0,0 +1,210 @@
+"""
+Recruitment curves: the Simple Mode train of a channel is delivered at a ladder of amplitudes, expressed as multiples
+of the threshold (e.g. 0.5 to 3 x T), each repeated several times, in random order.
+
+All the amplitude variants are compiled at once and uploaded to free device slots before the first trial, and the
+command of each trial (R retarget of the trigger, and T/U manual trigger) is encoded in advance, so a trial is a single
+write of pre-encoded bytes.
+"""
+import csv
+import logging
+import threading
+import time
+
+import numpy as np
+
+from src.Scheduler import wait_until
+from src.SimpleMode import compile_simple_mode, decompile_simple_mode
+from src.StimJim import (
+    StimJim,
+    StimJimTrigDirection,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_MAX_PULSETRAINS,
+    STIMJIM_TRIGGER_COMMANDS,
+)
+from src.TrainArrays import TrainArrays
+from src.TrainLibrary import SlotAllocator, StimJimNoFreeSlotException
+from src.Validation import ValidationLimits, Severity, validate
+
+RECRUITMENT_START_DELAY_NS = 50_000_000
+RECRUITMENT_LOG_HEADER = ["trial", "level_xT", "amplitude", "slot", "t_monotonic_ns", "t_unix_s"]
+
+logger = logging.getLogger("StimJimGUI")
+
+
+def ladder_levels(start: float, stop: float, step: float) -> np.ndarray:
+    """
+    Returns the levels from start to stop (included) in steps of step, e.g. 0.5, 1.0 ... 3.0
+    """
+    n = int(round((stop - start) / step)) + 1
+    return np.round(start + step * np.arange(max(n, 1)), 9)
+
+
+class RecruitmentCurve(object):
+    def __init__(
+        self,
+        stimjim: StimJim,
+        channel_id: int,
+        threshold: float,
+        levels,
+        n_repeats: int = 1,
+        interval_s: float = 1.0,
+        shuffle: bool = True,
+        seed=None,
+        manual: bool = True,
+        direction=StimJimTrigDirection.RISING,
+        on_trial=None,
+        on_finished=None,
+        limits: ValidationLimits = None,
+    ):
+        """
+        Delivers the Simple Mode train of channel_id at amplitudes levels x threshold (in V or A). Each trial points
+        the channel's trigger at the train of that level and, if manual, fires it with T/U. Otherwise the trains are
+        fired by the TRIG input, and the trial time is the time of the retarget.
+        Raises ValueError, before anything is uploaded, if the train of a level is not valid (see src.Validation)
+        """
+        self.stimjim = stimjim
+        self.channel_id = channel_id
+        self.threshold = threshold
+        self.levels = np.asarray(levels, dtype=float)
+        self.interval_ns = int(interval_s * 1e9)
+        self.manual = manual
+        # called from the runner thread, with the last log entry after each trial and with the runner at the end
+        self.on_trial = on_trial
+        self.on_finished = on_finished
+        order = np.repeat(np.arange(len(self.levels)), n_repeats)
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(order)
+        self.order = order
+        self.log = []  # (trial, level, amplitude, slot, time.monotonic_ns of the write, time.time of the write)
+        self.error = None
+
+        # Simple Mode uses trains 0 and 1, the ladder goes in the other slots
+        self.allocator = SlotAllocator(
+            stimjim, slots=range(STIMJIM_N_OUTPUTS, STIMJIM_MAX_PULSETRAINS)
+        )
+        if len(self.levels) > len(self.allocator.slots):
+            raise StimJimNoFreeSlotException(
+                f"{len(self.levels)} levels but only {len(self.allocator.slots)} free slots"
+            )
+        params = decompile_simple_mode(
+            channel_id, TrainArrays.from_pulse_trains([stimjim.pulse_trains[channel_id]])
+        )
+        self.trains = compile_simple_mode(
+            channel_id,
+            params["mode"],
+            self.levels,
+            params["pulse_duration_s"],
+            params["bipolar"],
+            params["n_pulses"],
+            params["frequency_hz"],
+            threshold=threshold,
+        )
+        self.amplitudes = self.levels * threshold
+        errors = {}
+        for d in validate(self.trains, limits):
+            if d.severity == Severity.ERROR:
+                errors.setdefault(self.levels[d.train], f"[{d.rule}] {d.message}")
+        if errors:
+            raise ValueError(
+                "Some levels are not valid: "
+                + "; ".join(f"{level:g} x T: {message}" for level, message in errors.items())
+            )
+        self._keys = self.trains.get_keys()
+        self._direction = direction
+        # the trigger is pointed back at the Simple Mode train at the end
+        self._restore_command = f"R{channel_id:d},{channel_id:d},{direction:d}\n".encode()
+        self._commands = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def upload(self):
+        """
+        Uploads the trains of all the levels in a single write, and encodes the command of each level
+        """
+        slots = self.allocator.ensure_all(self._keys)
+        for key in self._keys:
+            self.allocator.pin(key)
+        fire = STIMJIM_TRIGGER_COMMANDS[self.channel_id]
+        self._commands = [
+            (
+                f"R{self.channel_id:d},{slot:d},{self._direction:d}\n"
+                + (f"{fire}{slot:d}\n" if self.manual else "")
+            ).encode()
+            for slot in slots
+        ]
+        return slots
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self._commands:
+            self.upload()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimRecruitmentCurve", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self) -> str:
+        return (
+            f"Recruitment curve on CH {self.channel_id}: {len(self.log)} of {len(self.order)} trials, "
+            f"{len(self.levels)} levels from {self.levels.min():g} to {self.levels.max():g} x T "
+            f"(T = {self.threshold:g})" + (f", failed ({self.error})" if self.error is not None else "")
+        )
+
+    def save_log(self, filename: str):
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(RECRUITMENT_LOG_HEADER)
+            writer.writerows(self.log)
+
+    def _run(self):
+        try:
+            self._record()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception(f"Recruitment curve on CH {self.channel_id} failed")
+        finally:
+            # always called, so that the GUI can restore the state of the device
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def _record(self):
+        logger.info(f"Starting recruitment curve: {len(self.order)} trials, levels {self.levels.tolist()} x T")
+        # time.time is only read once, trial times are converted from the monotonic clock
+        unix_offset_ns = time.time_ns() - time.monotonic_ns()
+        t_next = time.monotonic_ns() + RECRUITMENT_START_DELAY_NS
+        slots = [self.allocator.get_slot(key) for key in self._keys]
+        try:
+            for trial, level_index in enumerate(self.order.tolist()):
+                if not wait_until(t_next, stop_event=self._stop):
+                    break
+                self.stimjim.write(self._commands[level_index])
+                t_ns = time.monotonic_ns()
+                self.log.append(
+                    (
+                        trial,
+                        float(self.levels[level_index]),
+                        float(self.amplitudes[level_index]),
+                        slots[level_index],
+                        t_ns,
+                        (t_ns + unix_offset_ns) / 1e9,
+                    )
+                )
+                if self.on_trial is not None:
+                    self.on_trial(self.log[-1])
+                t_next += self.interval_ns
+        finally:
+            self.stimjim.write(self._restore_command)
+        logger.info(self.summary())
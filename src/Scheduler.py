@@ -0,0 +1,148 @@
+"""
+Host-side trigger scheduler: fires T/U manual triggers at fixed rate, following a Poisson process, or at a list of
+times, from a dedicated thread with sub-millisecond jitter.
+"""
+import logging
+import random
+import statistics
+import threading
+import time
+from typing import List
+
+from src.StimJim import StimJim, STIMJIM_TRIGGER_COMMANDS
+
+SCHEDULER_START_DELAY_NS = 50_000_000  # leave time for the thread to start before the first trigger
+SCHEDULER_SPIN_THRESHOLD_NS = 2_000_000  # sleep until that long before each deadline, then busy-wait
+SCHEDULER_LATENESS_SMOOTHING = 0.1  # weight of the last trigger in the running estimate of the write duration
+
+logger = logging.getLogger("StimJimGUI")
+
+
+def fixed_rate_times(rate_hz: float, n: int) -> List[int]:
+    """
+    Returns the offsets (in ns) of n triggers at rate_hz
+    """
+    return [int(i * 1e9 / rate_hz) for i in range(n)]
+
+
+def poisson_times(rate_hz: float, n: int, seed=None) -> List[int]:
+    """
+    Returns the offsets (in ns) of n triggers following a Poisson process of mean rate rate_hz
+    """
+    rng = random.Random(seed)
+    times, t = [], 0.0
+    for _ in range(n):
+        times.append(int(t * 1e9))
+        t += rng.expovariate(rate_hz)
+    return times
+
+
+def list_times(times_s) -> List[int]:
+    """
+    Returns the offsets (in ns) of triggers at times_s (in s)
+    """
+    return sorted(int(t * 1e9) for t in times_s)
+
+
+def wait_until(
+    deadline_ns: int,
+    spin_threshold_ns: int = SCHEDULER_SPIN_THRESHOLD_NS,
+    stop_event: threading.Event = None,
+) -> bool:
+    """
+    Sleeps until shortly before deadline_ns (time.monotonic_ns), then spins until it is reached.
+    Returns False if stop_event was set while sleeping
+    """
+    remaining = deadline_ns - time.monotonic_ns()
+    if remaining > spin_threshold_ns:
+        timeout = (remaining - spin_threshold_ns) * 1e-9
+        if stop_event is None:
+            time.sleep(timeout)
+        elif stop_event.wait(timeout):
+            return False
+    while time.monotonic_ns() < deadline_ns:
+        pass
+    return True
+
+
+class TriggerRun(object):
+    def __init__(self, trigger: int, train: int):
+        self.trigger = trigger
+        self.train = train
+        self.scheduled_ns = []
+        self.actual_ns = []
+
+    @property
+    def jitter_ns(self) -> List[int]:
+        return [a - s for s, a in zip(self.scheduled_ns, self.actual_ns)]
+
+    def summary(self) -> str:
+        jitter = self.jitter_ns
+        if not jitter:
+            return f"Trigger {self.trigger} -> train {self.train}: no trigger sent"
+        abs_jitter = sorted(abs(j) for j in jitter)
+        return (
+            f"Trigger {self.trigger} -> train {self.train}: {len(jitter)} triggers, "
+            f"jitter mean {statistics.fmean(jitter) / 1e3:.1f} μs, "
+            f"SD {statistics.pstdev(jitter) / 1e3:.1f} μs, "
+            f"99th percentile |jitter| {abs_jitter[int(0.99 * (len(abs_jitter) - 1))] / 1e3:.1f} μs, "
+            f"max |jitter| {abs_jitter[-1] / 1e3:.1f} μs"
+        )
+
+
+class TriggerScheduler(object):
+    def __init__(
+        self,
+        stimjim: StimJim,
+        trigger: int,
+        train: int,
+        times_ns: List[int],
+        on_finished=None,
+    ):
+        self.stimjim = stimjim
+        self.times_ns = times_ns
+        self.run = TriggerRun(trigger, train)
+        # called from the scheduler thread with the TriggerRun when all the triggers have been sent
+        self.on_finished = on_finished
+        self._command = f"{STIMJIM_TRIGGER_COMMANDS[trigger]}{train:d}\n".encode()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimTriggerScheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        logger.info(f"Scheduling {len(self.times_ns)} triggers: {self._command.strip().decode()}")
+        t0 = time.monotonic_ns() + SCHEDULER_START_DELAY_NS
+        lateness = 0.0
+        for offset in self.times_ns:
+            scheduled = t0 + offset
+            # deadlines are absolute so errors don't accumulate, and shifted by the typical dispatch time
+            if not wait_until(scheduled - int(lateness), stop_event=self._stop):
+                break
+            woken = time.monotonic_ns()
+            self.stimjim.write(self._command)
+            actual = time.monotonic_ns()
+            self.run.scheduled_ns.append(scheduled)
+            self.run.actual_ns.append(actual)
+            # only the write itself is compensated, occasional late wake-ups must not bias the next triggers
+            lateness += SCHEDULER_LATENESS_SMOOTHING * ((actual - woken) - lateness)
+        logger.info(self.run.summary())
+        if self.on_finished is not None:
+            self.on_finished(self.run)
@@ -0,0 +1,367 @@
+"""
+Protocol sequencer: runs multi-step experiments described in a JSON file, either from the GUI or headless.
+
+A protocol is a list of steps:
+
+    {"steps": [
+        {"type": "config", "file": "configA.json"},
+        {"type": "fire", "trigger": 0, "train": 0, "count": 50, "rate_hz": 0.2},
+        {"type": "ramp", "trigger": 0, "train": 0, "stage": 0, "channel": 0,
+         "start": 100, "stop": 1000, "n": 10, "interval_s": 5},
+        {"type": "wait", "duration_s": 10},
+        {"type": "config", "file": "configB.json"}
+    ]}
+
+"config" steps upload a configuration, either from a file saved by the GUI ("mode" selects "FullMode", the default, or
+"SimpleMode") or given inline as "config". "fire" steps send manual triggers at "rate_hz", or at "times_s".
+"ramp" steps upload and fire the train once for each amplitude of the ramp (in mV or μA), or of "values".
+
+The whole protocol is compiled to a timeline of pre-encoded commands before it starts. Trains uploaded by a step are
+sent while the previous step runs, unless that step uses them. Like in Full Mode, trains with validation errors are
+never uploaded: the protocol is refused when it is compiled.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from src.Scheduler import wait_until, fixed_rate_times, list_times
+from src.StimJim import (
+    StimJim,
+    PulseTrain,
+    Trigger,
+    StimJimTooManyStagesException,
+    STIMJIM_MAX_PULSETRAINS,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_N_TRIGGERS,
+    STIMJIM_TRIGGER_COMMANDS,
+    STIMJIM_SERIAL_BAUDRATE,
+)
+from src.Validation import ValidationLimits, Severity, validate
+
+SEQUENCER_START_DELAY_NS = 100_000_000
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+_MISSING = object()
+
+
+def _get_int(step: dict, index: int, key: str, minimum: int, maximum: int = None, default=_MISSING) -> int:
+    """
+    Returns step[key] (or default), raises ProtocolError unless it is an integer between minimum and maximum
+    """
+    value = step.get(key, default)
+    if value is _MISSING:
+        raise ProtocolError(f"Step {index} has no '{key}'")
+    if (
+        isinstance(value, bool)
+        or not isinstance(value, int)
+        or value < minimum
+        or (maximum is not None and value > maximum)
+    ):
+        condition = f"of at least {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+        raise ProtocolError(f"'{key}' of step {index} must be an integer {condition}, not {value!r}")
+    return value
+
+
+def _get_number(step: dict, index: int, key: str, minimum: float = None, default=_MISSING) -> float:
+    """
+    Returns step[key] (or default), raises ProtocolError unless it is a number, at least minimum
+    """
+    value = step.get(key, default)
+    if value is _MISSING:
+        raise ProtocolError(f"Step {index} has no '{key}'")
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (minimum is not None and value < minimum):
+        condition = "a number" if minimum is None else f"a number of at least {minimum:g}"
+        raise ProtocolError(f"'{key}' of step {index} must be {condition}, not {value!r}")
+    return value
+
+
+def _get_numbers(step: dict, index: int, key: str, minimum: float = None) -> List[float]:
+    values = step[key]
+    if not isinstance(values, list):
+        raise ProtocolError(f"'{key}' of step {index} must be a list of numbers, not {values!r}")
+    return [_get_number({key: value}, index, key, minimum) for value in values]
+
+
+class CompiledStep(object):
+    def __init__(self, index: int, kind: str):
+        self.index = index
+        self.kind = kind
+        self.uploads = []  # S commands, can be sent early
+        self.retargets = []  # R commands, sent when the step starts
+        self.actions = []  # (offset_ns, command) from the start of the step
+        self.duration_ns = 0
+        self.trains_written = set()
+        self.trains_fired = set()  # including the trains targeted by the TRIG inputs during the step
+
+    def __repr__(self):
+        return f"Step {self.index} [{self.kind}]: {len(self.uploads)} uploads, {len(self.actions)} actions"
+
+
+class Protocol(object):
+    def __init__(self, steps: List[dict], base_dir: Path = None):
+        self.steps = steps
+        self.base_dir = Path.cwd() if base_dir is None else base_dir
+
+    @staticmethod
+    def from_file(filename):
+        with open(filename, "r") as f:
+            json_dict = json.load(f)
+        if not isinstance(json_dict, dict) or not isinstance(json_dict.get("steps"), list):
+            raise ProtocolError(f"{filename} has no list of steps")
+        return Protocol(json_dict["steps"], base_dir=Path(filename).resolve().parent)
+
+    def _load_config(self, step: dict, index: int):
+        if "config" in step:
+            json_dict = step["config"]
+        elif isinstance(step.get("file"), str):
+            with open(self.base_dir / step["file"], "r") as f:
+                json_dict = json.load(f)
+        else:
+            raise ProtocolError(f"Step {index} needs a 'config' or a 'file'")
+        if not isinstance(json_dict, dict):
+            raise ProtocolError(f"The configuration of step {index} is not a JSON object")
+        json_dict = json_dict.get(step.get("mode", "FullMode"), json_dict)
+        try:
+            pulse_trains = [PulseTrain.from_json(d) for d in json_dict.get("pulse_trains", [])]
+            triggers = [Trigger.from_json(d) for d in json_dict.get("triggers", [])[:STIMJIM_N_TRIGGERS]]
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError, StimJimTooManyStagesException) as e:
+            raise ProtocolError(f"Invalid configuration in step {index} ({type(e).__name__}: {e})") from e
+        for train in pulse_trains:
+            _get_int(vars(train), index, "train_id", 0, STIMJIM_MAX_PULSETRAINS - 1)
+        for trigger in triggers:
+            _get_int(vars(trigger), index, "trig_id", 0, STIMJIM_N_TRIGGERS - 1)
+            _get_int(vars(trigger), index, "train_target", -1, STIMJIM_MAX_PULSETRAINS - 1)
+        return pulse_trains, triggers
+
+    def compile(self, limits: ValidationLimits = None) -> List[CompiledStep]:
+        """
+        Raises ProtocolError if a step is not valid, e.g. a field is missing, has the wrong type or is out of range,
+        or uploads a train with validation errors
+        """
+        from src.TrainArrays import TrainArrays
+
+        trains = [PulseTrain(i) for i in range(STIMJIM_MAX_PULSETRAINS)]
+        sent = {}  # train id -> last S command uploaded, so identical trains are not uploaded again
+        trigger_targets = set()  # trains that can be started by the TRIG inputs at any time
+        compiled = []
+
+        def upload(compiled_step: CompiledStep, train: PulseTrain, at_ns=None):
+            errors = [
+                f"[{d.rule}] {d.message}"
+                for d in validate(TrainArrays.from_pulse_trains([train]), limits)
+                if d.severity == Severity.ERROR
+            ]
+            if errors:
+                raise ProtocolError(
+                    f"Train {train.train_id} of step {compiled_step.index} is not valid: {'; '.join(errors)}"
+                )
+            command = train.get_stimjim_string()
+            if at_ns is not None:
+                compiled_step.actions.append((at_ns, command))
+            elif sent.get(train.train_id) != command:
+                compiled_step.uploads.append(command)
+            else:
+                return
+            sent[train.train_id] = command
+            compiled_step.trains_written.add(train.train_id)
+
+        for index, step in enumerate(self.steps):
+            if not isinstance(step, dict):
+                raise ProtocolError(f"Step {index} is not a JSON object")
+            kind = step.get("type")
+            compiled_step = CompiledStep(index, kind)
+            if kind == "config":
+                pulse_trains, triggers = self._load_config(step, index)
+                for train in pulse_trains:
+                    trains[train.train_id] = train
+                    upload(compiled_step, train)
+                for trigger in triggers:
+                    compiled_step.retargets.append(trigger.get_stimjim_string() + "\n")
+                if triggers:
+                    trigger_targets = {t.train_target for t in triggers if t.train_target >= 0}
+            elif kind == "fire":
+                trigger_id = _get_int(step, index, "trigger", 0, STIMJIM_N_TRIGGERS - 1)
+                train_id = _get_int(step, index, "train", 0, STIMJIM_MAX_PULSETRAINS - 1)
+                if "times_s" in step:
+                    offsets = list_times(_get_numbers(step, index, "times_s", minimum=0))
+                    duration_ns = offsets[-1] if offsets else 0
+                else:
+                    count = _get_int(step, index, "count", 1)
+                    rate_hz = _get_number(step, index, "rate_hz", minimum=0)
+                    if rate_hz == 0:
+                        raise ProtocolError(f"'rate_hz' of step {index} must be positive")
+                    offsets = fixed_rate_times(rate_hz, count)
+                    duration_ns = int(count * 1e9 / rate_hz)
+                command = f"{STIMJIM_TRIGGER_COMMANDS[trigger_id]}{train_id:d}\n"
+                compiled_step.actions = [(offset, command) for offset in offsets]
+                compiled_step.duration_ns = duration_ns
+                compiled_step.trains_fired.add(train_id)
+            elif kind == "ramp":
+                trigger_id = _get_int(step, index, "trigger", 0, STIMJIM_N_TRIGGERS - 1)
+                train_id = _get_int(step, index, "train", 0, STIMJIM_MAX_PULSETRAINS - 1)
+                channel = _get_int(step, index, "channel", 0, STIMJIM_N_OUTPUTS - 1, default=0)
+                if "values" in step:
+                    values = _get_numbers(step, index, "values")
+                else:
+                    n = _get_int(step, index, "n", 1)
+                    start = _get_number(step, index, "start")
+                    stop = _get_number(step, index, "stop")
+                    values = [start + i * (stop - start) / max(n - 1, 1) for i in range(n)]
+                train = trains[train_id]
+                if not train.stages:
+                    raise ProtocolError(f"Train {train_id} has no stages in step {index}")
+                stage = train.stages[_get_int(step, index, "stage", 0, len(train.stages) - 1, default=0)]
+                trigger_command = f"{STIMJIM_TRIGGER_COMMANDS[trigger_id]}{train_id:d}\n"
+                interval_ns = int(_get_number(step, index, "interval_s", minimum=0) * 1e9)
+                for i, value in enumerate(values):
+                    stage.channel_amps[channel] = int(value)
+                    upload(compiled_step, train, at_ns=i * interval_ns)
+                    compiled_step.actions.append((i * interval_ns, trigger_command))
+                compiled_step.duration_ns = len(values) * interval_ns
+                compiled_step.trains_fired.add(train_id)
+            elif kind == "wait":
+                compiled_step.duration_ns = int(_get_number(step, index, "duration_s", minimum=0) * 1e9)
+            else:
+                raise ProtocolError(f"Unknown step type '{kind}' in step {index}")
+            compiled_step.trains_fired |= trigger_targets
+            compiled.append(compiled_step)
+        return compiled
+
+
+def build_timeline(compiled: List[CompiledStep]):
+    """
+    Flattens the compiled steps into a list of (t_ns, step index, command bytes) relative to the start of the
+    protocol. Commands due at the same time are merged in a single write
+    """
+    timeline = []
+    t_ns = 0
+    for i, step in enumerate(compiled):
+        previous = compiled[i - 1] if i > 0 else None
+        if step.uploads:
+            if previous is not None and not step.trains_written & (
+                previous.trains_fired | previous.trains_written
+            ):
+                # the previous step doesn't touch these trains: upload them while it runs
+                timeline.append((t_ns - previous.duration_ns, step.index, "".join(step.uploads)))
+            else:
+                timeline.append((t_ns, step.index, "".join(step.uploads)))
+        if step.retargets:
+            timeline.append((t_ns, step.index, "".join(step.retargets)))
+        for offset, command in step.actions:
+            timeline.append((t_ns + offset, step.index, command))
+        t_ns += step.duration_ns
+    timeline.sort(key=lambda item: item[0])
+
+    merged = []
+    for t, index, command in timeline:
+        if merged and merged[-1][0] == t:
+            merged[-1] = (t, merged[-1][1], merged[-1][2] + command)
+        else:
+            merged.append((t, index, command))
+    return [(t, index, command.encode()) for t, index, command in merged], t_ns
+
+
+class ProtocolRunner(object):
+    def __init__(
+        self, stimjim: StimJim, protocol: Protocol, on_step=None, on_finished=None, limits: ValidationLimits = None
+    ):
+        self.stimjim = stimjim
+        self.compiled = protocol.compile(limits)
+        self.timeline, self.duration_ns = build_timeline(self.compiled)
+        # called from the runner thread with the index of each step as it starts, and when the protocol ends
+        self.on_step = on_step
+        self.on_finished = on_finished
+        self.log = []  # (step index, scheduled ns, actual ns)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimProtocolRunner", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self) -> str:
+        if not self.log:
+            return "Protocol: nothing sent"
+        lateness = [actual - scheduled for _, scheduled, actual in self.log]
+        return (
+            f"Protocol: {self.log[-1][0] + 1}/{len(self.compiled)} steps, {len(self.log)} writes, "
+            f"max lateness {max(lateness) / 1e3:.1f} μs"
+        )
+
+    def _run(self):
+        logger.info(
+            f"Running protocol: {len(self.compiled)} steps, {self.duration_ns / 1e9:.1f} s, "
+            f"{len(self.timeline)} writes"
+        )
+        t0 = time.monotonic_ns() + SEQUENCER_START_DELAY_NS
+        current_step = None
+        for t_ns, index, command in self.timeline:
+            if not wait_until(t0 + t_ns, stop_event=self._stop):
+                break
+            self.stimjim.write(command)
+            self.log.append((index, t0 + t_ns, time.monotonic_ns()))
+            if index != current_step:
+                current_step = index
+                if self.on_step is not None:
+                    self.on_step(index)
+        if not self._stop.is_set():
+            wait_until(t0 + self.duration_ns, stop_event=self._stop)
+        logger.info(self.summary())
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+
+if __name__ == "__main__":
+    import serial
+
+    parser = argparse.ArgumentParser(
+        prog="StimJimSequencer", description="Runs a StimJim protocol file without the GUI"
+    )
+    parser.add_argument("protocol", help="the JSON protocol file")
+    parser.add_argument("-p", "--port", required=True, help="the serial port of the StimJim")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the compiled timeline and exit"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    protocol = Protocol.from_file(args.protocol)
+    if args.dry_run:
+        timeline, duration_ns = build_timeline(protocol.compile())
+        for t_ns, index, command in timeline:
+            print(f"{t_ns / 1e9:10.4f} s  step {index:3d}  {command!r}")
+        print(f"Total duration: {duration_ns / 1e9:.3f} s")
+    else:
+        runner = ProtocolRunner(
+            StimJim(serial.Serial(args.port, baudrate=STIMJIM_SERIAL_BAUDRATE)), protocol
+        )
+        runner.start()
+        try:
+            runner.wait()
+        except KeyboardInterrupt:
+            runner.stop()
@@ -0,0 +1,93 @@
+"""
+Pure conversion between the Simple Mode parameters and pulse trains, without any Qt widget.
+
+All the parameters can be scalars or NumPy arrays (broadcast against each other), so thousands of Simple Mode
+configurations can be compiled at once.
+"""
+import numpy as np
+
+from src.StimJim import (
+    StimJimOutputModes,
+    STIMJIM_SCALING_FACTORS,
+    STIMJIM_DURATION_SCALING_FACTOR,
+)
+from src.TrainArrays import TrainArrays
+
+# STIMJIM_SCALING_FACTORS indexed by mode
+_SCALING_FACTORS = np.array([STIMJIM_SCALING_FACTORS[m] for m in StimJimOutputModes])
+
+
+def get_train_duration_s(pulse_duration_s, n_pulses, frequency_hz):
+    return (np.asarray(n_pulses) - 1) / np.asarray(frequency_hz) + np.asarray(pulse_duration_s)
+
+
+def compile_simple_mode(
+    channel_id: int,
+    mode,
+    amplitude,
+    pulse_duration_s,
+    bipolar,
+    n_pulses,
+    frequency_hz,
+    threshold=None,
+) -> TrainArrays:
+    """
+    Returns the trains produced by Simple Mode on output channel_id (the other output is grounded).
+    amplitude is in V or A depending on mode, or is a multiple of threshold (in V or A) if threshold is given
+    """
+    mode, amplitude, pulse_duration_s, bipolar, n_pulses, frequency_hz = np.broadcast_arrays(
+        np.asarray(mode, dtype=np.int64),
+        np.asarray(amplitude, dtype=float),
+        np.asarray(pulse_duration_s, dtype=float),
+        np.asarray(bipolar, dtype=bool),
+        np.asarray(n_pulses, dtype=np.int64),
+        np.asarray(frequency_hz, dtype=float),
+    )
+    shape = mode.shape
+    mode, amplitude, pulse_duration_s, bipolar, n_pulses, frequency_hz = (
+        a.ravel() for a in (mode, amplitude, pulse_duration_s, bipolar, n_pulses, frequency_hz)
+    )
+    if threshold is not None:
+        amplitude = amplitude * np.broadcast_to(np.asarray(threshold, dtype=float), shape).ravel()
+
+    arrays = TrainArrays.empty(mode.size)
+    arrays.modes[:, channel_id] = mode
+    arrays.period_us[:] = np.trunc(STIMJIM_DURATION_SCALING_FACTOR / frequency_hz)
+    arrays.duration_us[:] = np.trunc(
+        STIMJIM_DURATION_SCALING_FACTOR
+        * get_train_duration_s(pulse_duration_s, n_pulses, frequency_hz)
+    )
+    amp = np.trunc(amplitude * _SCALING_FACTORS[mode]).astype(np.int64)
+    stage_us = STIMJIM_DURATION_SCALING_FACTOR * pulse_duration_s
+    stage_us = np.trunc(np.where(bipolar, stage_us / 2, stage_us)).astype(np.int64)
+    arrays.n_stages[:] = np.where(bipolar, 2, 1)
+    arrays.amps[:, 0, channel_id] = amp
+    arrays.amps[:, 1, channel_id] = np.where(bipolar, -amp, 0)
+    arrays.stage_us[:, 0] = stage_us
+    arrays.stage_us[:, 1] = np.where(bipolar, stage_us, 0)
+    return arrays
+
+
+def decompile_simple_mode(channel_id: int, arrays: TrainArrays) -> dict:
+    """
+    Inverse of compile_simple_mode (same calculation as SimpleModeWidget.update_widgets). Returns a dict of arrays:
+    mode, amplitude (V or A), pulse_duration_s, bipolar, n_pulses, frequency_hz, train_duration_s
+    """
+    mode = arrays.modes[:, channel_id]
+    bipolar = arrays.n_stages > 1
+    pulse_duration_us = np.where(bipolar, arrays.stage_us[:, 0] * 2, arrays.stage_us[:, 0])
+    pulse_duration_s = pulse_duration_us / STIMJIM_DURATION_SCALING_FACTOR
+    train_duration_s = arrays.duration_us / STIMJIM_DURATION_SCALING_FACTOR
+    period_s = arrays.period_us / STIMJIM_DURATION_SCALING_FACTOR
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_pulses = np.trunc((train_duration_s - pulse_duration_s) / (arrays.period_us * 1e-6) + 1)
+        frequency_hz = 1 / period_s
+    return dict(
+        mode=mode,
+        amplitude=arrays.amps[:, 0, channel_id] / _SCALING_FACTORS[mode],
+        pulse_duration_s=pulse_duration_s,
+        bipolar=bipolar,
+        n_pulses=n_pulses.astype(np.int64),
+        frequency_hz=frequency_hz,
+        train_duration_s=train_duration_s,
+    )
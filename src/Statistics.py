@@ -0,0 +1,83 @@
+"""
+Safety statistics of pulse trains (charge, balance, amplitude, duty cycle), computed with NumPy for all the trains and
+both channels at once.
+
+Amplitudes are converted to V or A according to the mode of each channel, so charges are in C for channels in current
+mode, and in V.s for channels in voltage mode. Grounded and disconnected channels output nothing. Stages are cut as in
+the waveform (see src.Waveform): at the period, and at the end of the train.
+"""
+import numpy as np
+
+from src.StimJim import StimJim, StimJimOutputModes, STIMJIM_DURATION_SCALING_FACTOR
+from src.TrainArrays import TrainArrays
+from src.Waveform import (
+    channel_scales,
+    pulse_counts,
+    pulse_periods_us,
+    stage_edges_us,
+    active_amps,
+)
+
+STATISTICS_CHARGE_UNITS = {
+    StimJimOutputModes.VOLTAGE: "V.s",
+    StimJimOutputModes.CURRENT: "C",
+    StimJimOutputModes.DISCONNECTED: "",
+    StimJimOutputModes.GROUNDED: "",
+}
+
+
+class TrainStatistics(object):
+    """
+    For N trains, arrays of shape (N,) for the whole train, (N, STIMJIM_N_OUTPUTS) per channel, or
+    (N, MAX_N_PHASES, STIMJIM_N_OUTPUTS) per phase:
+     - n_pulses: number of pulses per train
+     - phase_charge: charge of each phase of one pulse
+     - net_charge: net charge of one pulse
+     - balance: net charge of one pulse relative to its absolute charge, 0 for perfectly balanced pulses
+     - peak: peak absolute amplitude
+     - rms: RMS amplitude over the duration of the train
+     - duty_cycle: fraction of the train during which the output is not 0
+     - total_charge: absolute charge delivered each time the train is triggered
+     - total_net_charge: net charge delivered each time the train is triggered
+    """
+
+    def __init__(self, arrays: TrainArrays):
+        self.arrays = arrays
+        seconds = 1 / STIMJIM_DURATION_SCALING_FACTOR
+        amps = active_amps(arrays) * channel_scales(arrays.modes)[:, None, :]
+        starts, ends = stage_edges_us(arrays)
+        stage_us = ends - starts
+
+        self.n_pulses = pulse_counts(arrays)
+        self.phase_charge = amps * (stage_us * seconds)[:, :, None]
+        self.net_charge = self.phase_charge.sum(axis=1)
+        absolute_charge = np.abs(self.phase_charge).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.balance = np.where(absolute_charge > 0, self.net_charge / absolute_charge, 0.0)
+        self.peak = np.abs(amps).max(axis=1)
+
+        # time spent in each stage during the whole train: all the pulses but the last are complete
+        last_pulse_us = arrays.duration_us - (self.n_pulses - 1) * pulse_periods_us(arrays)
+        last_stage_us = np.clip(last_pulse_us[:, None] - starts, 0, stage_us)
+        stage_total_s = (
+            np.maximum(self.n_pulses - 1, 0)[:, None] * stage_us
+            + np.where(self.n_pulses[:, None] > 0, last_stage_us, 0)
+        ) * seconds
+        duration_s = np.maximum(arrays.duration_us, 1)[:, None] * seconds
+        self.total_net_charge = (amps * stage_total_s[:, :, None]).sum(axis=1)
+        self.total_charge = (np.abs(amps) * stage_total_s[:, :, None]).sum(axis=1)
+        self.rms = np.sqrt((amps**2 * stage_total_s[:, :, None]).sum(axis=1) / duration_s)
+        self.duty_cycle = ((amps != 0) * stage_total_s[:, :, None]).sum(axis=1) / duration_s
+
+    def __len__(self):
+        return len(self.arrays)
+
+    @staticmethod
+    def from_stimjim(stimjim: StimJim):
+        return TrainStatistics(TrainArrays.from_pulse_trains(stimjim.pulse_trains))
+
+    def get_charge_units(self):
+        """
+        Returns the unit of the charges of each channel, shape (N, STIMJIM_N_OUTPUTS)
+        """
+        return [[STATISTICS_CHARGE_UNITS[m] for m in modes] for modes in self.arrays.modes.tolist()]
@@ -0,0 +1,136 @@
+"""
+Dock panel listing the safety statistics (see src.Statistics) of every active channel of every train that has stages.
+Channels whose pulses are not charge-balanced are highlighted.
+"""
+import math
+import time
+
+from PyQt5.QtCore import QAbstractTableModel, Qt
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import QDockWidget, QTableView, QHeaderView
+
+from src.StimJim import StimJim, STIMJIM_MODE_NAMES, STIMJIM_N_OUTPUTS, STIMJIM_UNITS
+
+STATISTICS_BALANCE_TOLERANCE = 0.01  # relative net charge above which a channel is highlighted
+STATISTICS_UNBALANCED_COLOR = QColor(255, 200, 200)
+SI_PREFIXES = {-4: "p", -3: "n", -2: "μ", -1: "m", 0: "", 1: "k", 2: "M"}
+
+
+def format_si(value: float, unit: str) -> str:
+    if value == 0 or not math.isfinite(value):
+        return f"{value:g} {unit}"
+    exponent = min(max(math.floor(math.log10(abs(value)) / 3), min(SI_PREFIXES)), max(SI_PREFIXES))
+    return f"{value / 10 ** (3 * exponent):.4g} {SI_PREFIXES[exponent]}{unit}"
+
+
+# noinspection PyMethodOverriding
+class TrainStatisticsModel(QAbstractTableModel):
+    HEADER = [
+        "Train",
+        "Channel",
+        "Pulses",
+        "Duty cycle",
+        "Peak",
+        "RMS",
+        "Charge per phase",
+        "Net charge / pulse",
+        "Balance",
+        "Charge / trigger",
+        "Net charge / trigger",
+    ]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.statistics = None
+        self.charge_units = []
+        self.rows = []  # (train, channel)
+
+    def set_statistics(self, statistics):
+        """
+        statistics is a src.Statistics.TrainStatistics
+        """
+        self.beginResetModel()
+        self.statistics = statistics
+        self.charge_units = statistics.get_charge_units()
+        arrays = statistics.arrays
+        self.rows = [
+            (i, ch)
+            for i in range(len(statistics))
+            if arrays.n_stages[i] > 0
+            for ch in range(STIMJIM_N_OUTPUTS)
+            if statistics.peak[i, ch] > 0
+        ]
+        self.endResetModel()
+
+    def headerData(self, section, orientation, role):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADER[section]
+        return None
+
+    def rowCount(self, index=None):
+        return len(self.rows)
+
+    def columnCount(self, index=None):
+        return len(self.HEADER)
+
+    def data(self, index, role):
+        i, ch = self.rows[index.row()]
+        st = self.statistics
+        if role == Qt.BackgroundRole:
+            if abs(st.balance[i, ch]) > STATISTICS_BALANCE_TOLERANCE:
+                return STATISTICS_UNBALANCED_COLOR
+            return None
+        if role != Qt.DisplayRole:
+            return None
+        mode = int(st.arrays.modes[i, ch])
+        unit = STIMJIM_UNITS[mode]
+        charge_unit = self.charge_units[i][ch]
+        column = self.HEADER[index.column()]
+        if column == "Train":
+            return str(i)
+        elif column == "Channel":
+            return f"{ch} ({STIMJIM_MODE_NAMES[mode]})"
+        elif column == "Pulses":
+            return str(int(st.n_pulses[i]))
+        elif column == "Duty cycle":
+            return f"{st.duty_cycle[i, ch] * 100:.3g} %"
+        elif column == "Peak":
+            return format_si(st.peak[i, ch], unit)
+        elif column == "RMS":
+            return format_si(st.rms[i, ch], unit)
+        elif column == "Charge per phase":
+            return ", ".join(
+                format_si(q, charge_unit) for q in st.phase_charge[i, : st.arrays.n_stages[i], ch]
+            )
+        elif column == "Net charge / pulse":
+            return format_si(st.net_charge[i, ch], charge_unit)
+        elif column == "Balance":
+            return f"{st.balance[i, ch] * 100:.3g} %"
+        elif column == "Charge / trigger":
+            return format_si(st.total_charge[i, ch], charge_unit)
+        elif column == "Net charge / trigger":
+            return format_si(st.total_net_charge[i, ch], charge_unit)
+        return None
+
+
+class TrainStatisticsDock(QDockWidget):
+    def __init__(self, parent=None):
+        super().__init__("Train statistics", parent)
+        self.setObjectName("trainStatisticsDock")
+        self.model = TrainStatisticsModel(self)
+        self.table = QTableView(self)
+        self.table.setModel(self.model)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.setWidget(self.table)
+        self.last_update_ns = 0  # time taken by the last update
+
+    def update_statistics(self, stimjim: StimJim):
+        if not self.isVisible():
+            return
+        # NumPy is only needed once the panel is shown
+        from src.Statistics import TrainStatistics
+
+        t_start = time.perf_counter_ns()
+        self.model.set_statistics(TrainStatistics.from_stimjim(stimjim))
+        self.last_update_ns = time.perf_counter_ns() - t_start
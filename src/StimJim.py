@@ -1,10 +1,11 @@
 import logging
+import threading
+import time
+import weakref
 import serial.tools.list_ports
 from enum import IntEnum
-from typing import List
+from typing import List, Tuple
 
-# noinspection PyUnresolvedReferences
-from PyQt5 import uic
 from PyQt5.QtWidgets import QInputDialog
 from serial.tools.list_ports_common import ListPortInfo
 
@@ -18,6 +19,49 @@ STIMJIM_MAX_PULSETRAINS = 100
 
 logger = logging.getLogger("StimJimGUI")
 
+# several StimJim objects (and threads) can share the same serial port, so writes are serialized per port
+_serial_locks = weakref.WeakKeyDictionary()
+
+
+def _get_serial_lock(serial_port) -> threading.Lock:
+    return _serial_locks.setdefault(serial_port, threading.Lock())
+
+
+class DeviceState(object):
+    """
+    Mirror of the state of the device, shared by all the StimJim objects writing to the same port: the last command
+    written for each pulse train slot (S) and each trigger (R). Slots that were never written since the GUI started are
+    unknown
+    """
+
+    _STATE_COMMANDS = (ord("S"), ord("R"))
+
+    def __init__(self):
+        self.commands = {}  # b"S12" or b"R0" -> last command written, without the newline
+
+    def record(self, data: bytes):
+        for line in data.split(b"\n"):
+            if line and line[0] in self._STATE_COMMANDS:
+                self.commands[line.split(b",", 1)[0]] = line
+
+    def diff(self, commands: List[str]) -> List[str]:
+        """
+        Returns the commands (S or R) that would change the state of the device
+        """
+        ret_val = []
+        for command in commands:
+            line = command.rstrip("\n").encode()
+            if self.commands.get(line.split(b",", 1)[0]) != line:
+                ret_val.append(command)
+        return ret_val
+
+
+_device_states = weakref.WeakKeyDictionary()
+
+
+def get_device_state(serial_port) -> DeviceState:
+    return _device_states.setdefault(serial_port, DeviceState())
+
 
 class StimJimOutputModes(IntEnum):
     VOLTAGE = 0
@@ -241,6 +285,8 @@ class PulseStage(object):
 class StimJim(object):
     def __init__(self, serial_port: serial.Serial):
         self._serial = serial_port
+        self._lock = _get_serial_lock(serial_port)
+        self.device_state = get_device_state(serial_port)
         self.triggers = [Trigger(trig_id=x) for x in range(STIMJIM_N_TRIGGERS)]
         self.pulse_trains = [PulseTrain(x) for x in range(STIMJIM_MAX_PULSETRAINS)]
 
@@ -252,11 +298,59 @@ class StimJim(object):
         logger.debug(f"Sending command [{temp}] to StimJim")
         if not command.endswith("\n"):
             command += "\n"
-        self._serial.write(command.encode())
+        self.write(command.encode())
+
+    def send_commands(self, commands: List[str]):
+        """
+        Sends several commands to the StimJim in a single write
+        """
+        commands = [c if c.endswith("\n") else c + "\n" for c in commands]
+        logger.debug(f"Sending {len(commands)} commands to StimJim")
+        self.write("".join(commands).encode())
+
+    def get_state_commands(self, train_ids=None, excluded=()) -> List[str]:
+        """
+        Returns the commands setting the trains train_ids (all by default, except those in excluded) and all the
+        triggers, i.e. the state of the device wanted by this object
+        """
+        if train_ids is None:
+            train_ids = range(len(self.pulse_trains))
+        commands = [self.pulse_trains[i].get_stimjim_string() for i in train_ids if i not in excluded]
+        commands += [trigger.get_stimjim_string() + "\n" for trigger in self.triggers]
+        return commands
+
+    def send_state(self, commands: List[str]) -> int:
+        """
+        Sends, in a single write, only the commands that change the state of the device. Returns the number of bytes
+        written
+        """
+        commands = self.device_state.diff(commands)
+        if not commands:
+            return 0
+        data = "".join(c if c.endswith("\n") else c + "\n" for c in commands).encode()
+        logger.debug(f"Sending {len(commands)} commands to StimJim to update its state")
+        self.write(data)
+        return len(data)
+
+    def write(self, data: bytes):
+        with self._lock:
+            self._serial.write(data)
+            self.device_state.record(data)
 
     def read_serial(self):
         return self._serial.read(self._serial.in_waiting).decode()
 
+    def read_serial_events(self) -> List[Tuple[int, str]]:
+        """
+        Returns the device output received so far as a list of (t_ns, text), where t_ns is the time.monotonic_ns() at
+        which it was read from the serial port: by the device process when there is one (see DeviceProcessSerial),
+        otherwise now
+        """
+        if hasattr(self._serial, "read_events"):
+            return [(t_ns, data.decode()) for t_ns, data in self._serial.read_events()]
+        text = self.read_serial()
+        return [(time.monotonic_ns(), text)] if text else []
+
     def to_json(self):
         return dict(
             triggers=[trigger.to_json() for trigger in self.triggers],
@@ -0,0 +1,143 @@
+"""
+Parameter sweeps (amplitude x pulse duration x frequency x bipolar), for recruitment curves and frequency-response
+studies.
+
+The trains of all the sweep points are generated at once with NumPy by the Simple Mode compiler, then fired in (by
+default) random order. Trains are uploaded in large batches to the free slots, and slots are recycled by a
+SlotAllocator. Like in Full Mode, trains with validation errors are never uploaded: the sweep is refused.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+
+from src.Scheduler import wait_until
+from src.SimpleMode import compile_simple_mode
+from src.StimJim import StimJim, StimJimOutputModes
+from src.TrainArrays import TrainArrays
+from src.TrainLibrary import SlotAllocator
+from src.Validation import ValidationLimits, Severity, validate
+
+SWEEP_START_DELAY_NS = 50_000_000
+SWEEP_RETRY_INTERVAL_S = 0.001
+
+logger = logging.getLogger("StimJimGUI")
+
+
+def sweep_points(amplitudes, pulse_durations_s, frequencies_hz, bipolar=(False,), n_pulses=(1,)):
+    """
+    Returns a dict of flat arrays with one entry per combination of the parameters:
+    amplitude (V or A), pulse_duration_s, frequency_hz, bipolar, n_pulses
+    """
+    grids = np.meshgrid(
+        np.asarray(amplitudes, dtype=float),
+        np.asarray(pulse_durations_s, dtype=float),
+        np.asarray(frequencies_hz, dtype=float),
+        np.asarray(bipolar, dtype=bool),
+        np.asarray(n_pulses, dtype=np.int64),
+        indexing="ij",
+    )
+    names = ["amplitude", "pulse_duration_s", "frequency_hz", "bipolar", "n_pulses"]
+    return {name: grid.ravel() for name, grid in zip(names, grids)}
+
+
+def compile_sweep(channel_id: int, mode: StimJimOutputModes, points: dict) -> TrainArrays:
+    """
+    Converts sweep points to trains on output channel_id
+    """
+    return compile_simple_mode(
+        channel_id,
+        mode,
+        points["amplitude"],
+        points["pulse_duration_s"],
+        points["bipolar"],
+        points["n_pulses"],
+        points["frequency_hz"],
+    )
+
+
+class SweepRunner(object):
+    def __init__(
+        self,
+        stimjim: StimJim,
+        trains: TrainArrays,
+        trigger: int,
+        interval_s: float,
+        shuffle: bool = True,
+        seed=None,
+        allocator: SlotAllocator = None,
+        on_finished=None,
+        limits: ValidationLimits = None,
+    ):
+        """
+        Raises ValueError, before anything is uploaded, if the trains of some sweep points are not valid
+        """
+        errors = {}
+        for d in validate(trains, limits):
+            if d.severity == Severity.ERROR:
+                errors.setdefault(d.train, f"[{d.rule}] {d.message}")
+        if errors:
+            raise ValueError(
+                "Some sweep points are not valid: "
+                + "; ".join(f"point {point}: {message}" for point, message in errors.items())
+            )
+        self.stimjim = stimjim
+        self.trains = trains
+        self.trigger = trigger
+        self.interval_ns = int(interval_s * 1e9)
+        self.allocator = SlotAllocator(stimjim) if allocator is None else allocator
+        self.order = (
+            np.random.default_rng(seed).permutation(len(trains))
+            if shuffle
+            else np.arange(len(trains))
+        )
+        self.on_finished = on_finished
+        self.log = []  # (sweep point index, slot, time.monotonic_ns of the trigger)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimSweepRunner", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        batch_size = len(self.allocator.slots)
+        logger.info(f"Running sweep of {len(self.order)} points, in batches of up to {batch_size}")
+        t_next = time.monotonic_ns() + SWEEP_START_DELAY_NS
+        order = self.order.tolist()
+        keys = []
+        i = 0
+        while i < len(order) and not self._stop.is_set():
+            if i == len(keys):
+                keys += self.trains[self.order[i : i + batch_size]].get_keys()
+            if self.allocator.get_slot(keys[i]) is None:
+                # upload the next trains to all the slots that are not in use
+                if self.allocator.prefetch(keys[i : i + batch_size]) == 0:
+                    # every slot holds a train that is still running
+                    self._stop.wait(SWEEP_RETRY_INTERVAL_S)
+                    continue
+            if not wait_until(t_next, stop_event=self._stop):
+                break
+            slot = self.allocator.fire(self.trigger, keys[i])
+            self.log.append((order[i], slot, time.monotonic_ns()))
+            t_next += self.interval_ns
+            i += 1
+        logger.info(f"Sweep done: {len(self.log)} points, slots {self.allocator.stats()}")
+        if self.on_finished is not None:
+            self.on_finished(self)
@@ -0,0 +1,421 @@
+"""
+Automated threshold search on a Simple Mode channel.
+
+At each trial, only the amplitude of the stage(s) of the channel's train changes: the S command is pre-formatted with
+everything else filled in, so a trial is one write (S command + T/U trigger), followed by waiting for a response
+from a response source:
+ - manual: yes/no answers given by the operator (Y/N keys in the GUI)
+ - "file:/path/to/file": lines appended to a file
+ - "udp:host:port" or "unix:/path/to/socket": datagrams
+Responses are "1", "y", "yes", "true" (response) or "0", "n", "no", "false" (no response). No response before the
+timeout counts as no response.
+"""
+import logging
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+from src.Scheduler import wait_until
+from src.StimJim import (
+    StimJim,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_MAX_VALS,
+    STIMJIM_SCALING_FACTORS,
+    STIMJIM_TRIGGER_COMMANDS,
+)
+
+THRESHOLD_RESPONSE_TIMEOUT_S = 0.5
+THRESHOLD_INTERVAL_S = 1.0  # minimum time between two trials
+THRESHOLD_MAX_TRIALS = 50
+THRESHOLD_POLL_INTERVAL_S = 0.1  # how often a waiting source checks if the search was stopped
+THRESHOLD_FILE_POLL_INTERVAL_S = 0.001
+THRESHOLD_READ_SIZE = 4096
+
+RESPONSE_TOKENS = {
+    b"1": True,
+    b"y": True,
+    b"yes": True,
+    b"true": True,
+    b"0": False,
+    b"n": False,
+    b"no": False,
+    b"false": False,
+}
+
+logger = logging.getLogger("StimJimGUI")
+
+
+def parse_response(token: bytes):
+    """
+    Returns True (response), False (no response) or None (not a response token)
+    """
+    return RESPONSE_TOKENS.get(token.strip().lower())
+
+
+class ResponseSource(object):
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def clear(self):
+        """
+        Discards the responses received so far, so that a late response to a trial is not attributed to the next one
+        """
+        pass
+
+    def wait(self, timeout_s: float, stop_event: threading.Event = None):
+        """
+        Returns the first response received within timeout_s, or None
+        """
+        raise NotImplementedError
+
+
+class ManualResponseSource(ResponseSource):
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def __repr__(self):
+        return "manual"
+
+    def respond(self, response: bool):
+        self._queue.put(response)
+
+    def clear(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def wait(self, timeout_s: float, stop_event: threading.Event = None):
+        deadline = time.monotonic() + timeout_s
+        while stop_event is None or not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                return self._queue.get(timeout=min(remaining, THRESHOLD_POLL_INTERVAL_S))
+            except queue.Empty:
+                pass
+        return None
+
+
+class FileResponseSource(ResponseSource):
+    """
+    Follows a text file, one response per line. Only the lines written after the search started are used
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+        self._buffer = b""
+
+    def __repr__(self):
+        return f"file:{self.filename}"
+
+    def open(self):
+        self._file = open(self.filename, "ab+")
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def clear(self):
+        self._file.seek(0, os.SEEK_END)
+        self._buffer = b""
+
+    def wait(self, timeout_s: float, stop_event: threading.Event = None):
+        deadline = time.monotonic() + timeout_s
+        while stop_event is None or not stop_event.is_set():
+            *lines, self._buffer = (self._buffer + self._file.read()).split(b"\n")
+            for line in lines:
+                response = parse_response(line)
+                if response is not None:
+                    return response
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(THRESHOLD_FILE_POLL_INTERVAL_S)
+        return None
+
+
+class SocketResponseSource(ResponseSource):
+    """
+    Receives datagrams on "udp:host:port" or "unix:/path/to/socket"
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self._sock = None
+
+    def __repr__(self):
+        return self.address
+
+    def open(self):
+        kind, _, target = self.address.partition(":")
+        if kind == "udp":
+            host, _, port = target.rpartition(":")
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind((host or "127.0.0.1", int(port)))
+        elif kind == "unix":
+            if os.path.exists(target):
+                os.remove(target)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(target)
+        else:
+            raise ValueError(f"Unknown response address '{self.address}'")
+        self._sock.setblocking(False)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            if self.address.startswith("unix:"):
+                os.remove(self.address[len("unix:") :])
+        self._sock = None
+
+    def clear(self):
+        while select.select([self._sock], [], [], 0)[0]:
+            self._sock.recv(THRESHOLD_READ_SIZE)
+
+    def wait(self, timeout_s: float, stop_event: threading.Event = None):
+        deadline = time.monotonic() + timeout_s
+        while stop_event is None or not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select(
+                [self._sock], [], [], min(remaining, THRESHOLD_POLL_INTERVAL_S)
+            )
+            if ready:
+                for token in self._sock.recv(THRESHOLD_READ_SIZE).split(b"\n"):
+                    response = parse_response(token)
+                    if response is not None:
+                        return response
+        return None
+
+
+def response_source_from_address(address: str = None) -> ResponseSource:
+    """
+    Returns a ManualResponseSource if address is empty, otherwise a file or socket source
+    """
+    if not address:
+        return ManualResponseSource()
+    if address.startswith("file:"):
+        return FileResponseSource(address[len("file:") :])
+    return SocketResponseSource(address)
+
+
+class BinarySearch(object):
+    """
+    Bisects [low, high] until the interval is narrower than tolerance. Assumes that there is a response at high and
+    none at low. The threshold is the lowest amplitude that gave a response
+    """
+
+    def __init__(self, low: float, high: float, tolerance: float):
+        self.low = low
+        self.high = high
+        self.tolerance = tolerance
+        self._responded = False
+
+    def __repr__(self):
+        return f"binary search in [{self.low:g}, {self.high:g}], tolerance {self.tolerance:g}"
+
+    @property
+    def done(self) -> bool:
+        return self.high - self.low <= self.tolerance
+
+    @property
+    def threshold(self):
+        return self.high if self._responded else None
+
+    def next_amplitude(self) -> float:
+        return (self.low + self.high) / 2
+
+    def update(self, response: bool):
+        amplitude = self.next_amplitude()
+        if response:
+            self.high = amplitude
+            self._responded = True
+        else:
+            self.low = amplitude
+
+
+class Staircase(object):
+    """
+    1-up/1-down staircase: the amplitude goes down by step after a response, and up by step otherwise. The step is
+    halved at each reversal (down to min_step), and the threshold is the mean of the amplitudes at the reversals
+    """
+
+    def __init__(
+        self, start: float, step: float, n_reversals: int = 6, min_step: float = 0.0
+    ):
+        self.amplitude = start
+        self.step = step
+        self.n_reversals = n_reversals
+        self.min_step = min_step
+        self.reversals = []
+        self._last_response = None
+
+    def __repr__(self):
+        return f"staircase from {self.amplitude:g}, step {self.step:g}, {self.n_reversals} reversals"
+
+    @property
+    def done(self) -> bool:
+        return len(self.reversals) >= self.n_reversals
+
+    @property
+    def threshold(self):
+        return sum(self.reversals) / len(self.reversals) if self.reversals else None
+
+    def next_amplitude(self) -> float:
+        return self.amplitude
+
+    def update(self, response: bool):
+        if self._last_response is not None and response != self._last_response:
+            self.reversals.append(self.amplitude)
+            self.step = max(self.step / 2, self.min_step)
+        self._last_response = response
+        # amplitudes are magnitudes, a negative one would reverse the polarity of the pulse
+        self.amplitude = max(self.amplitude + (-self.step if response else self.step), 0.0)
+
+
+class ThresholdSearch(object):
+    def __init__(
+        self,
+        stimjim: StimJim,
+        channel_id: int,
+        strategy,
+        source: ResponseSource,
+        response_timeout_s: float = THRESHOLD_RESPONSE_TIMEOUT_S,
+        interval_s: float = THRESHOLD_INTERVAL_S,
+        max_trials: int = THRESHOLD_MAX_TRIALS,
+        on_trial=None,
+        on_finished=None,
+    ):
+        """
+        Searches the threshold of the Simple Mode train of channel_id (train channel_id, fired by trigger channel_id).
+        Amplitudes are in V or A, depending on the mode of the channel
+        """
+        self.stimjim = stimjim
+        self.channel_id = channel_id
+        self.strategy = strategy
+        self.source = source
+        self.response_timeout_s = response_timeout_s
+        self.interval_ns = int(interval_s * 1e9)
+        self.max_trials = max_trials
+        # called from the search thread, with (amplitude, response) after each trial and with the search at the end
+        self.on_trial = on_trial
+        self.on_finished = on_finished
+        self.trials = []  # (amplitude, response, time.monotonic_ns of the trigger)
+        self.threshold = None
+        self.error = None
+
+        pulse_train = stimjim.pulse_trains[channel_id]
+        mode = pulse_train.get_mode(channel_id)
+        self.scale = STIMJIM_SCALING_FACTORS[mode]
+        self.max_amplitude = STIMJIM_MAX_VALS[mode]
+        self._template = self._make_template(pulse_train, channel_id)
+        # the search leaves the train as it was
+        self._restore_command = stimjim.get_stimjim_string(channel_id).encode()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _make_template(pulse_train, channel_id: int) -> str:
+        # Simple Mode trains have one stage, or two stages of opposite amplitudes (bipolar). Fields {0} and {1} are
+        # the amplitude and its opposite, in mV or μA
+        stages = []
+        for i, stage in enumerate(pulse_train.stages):
+            amps = [str(int(a)) for a in stage.channel_amps]
+            amps[channel_id] = "{0:d}" if i == 0 else "{1:d}"
+            stages.append(f";{amps[0]},{amps[1]},{int(stage.duration_us):d}")
+        modes = [int(pulse_train.get_mode(ch)) for ch in range(STIMJIM_N_OUTPUTS)]
+        return (
+            f"S{channel_id:d},{modes[0]:d},{modes[1]:d},"
+            f"{pulse_train.train_period_us:d},{pulse_train.train_duration_us:d}"
+            + "".join(stages)
+            + f"\n{STIMJIM_TRIGGER_COMMANDS[channel_id]}{channel_id:d}\n"
+        )
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        # opened here so that errors are raised to the caller
+        self.source.open()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="StimJimThresholdSearch", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self) -> str:
+        if self.error is not None:
+            result = f"failed ({self.error})"
+        elif self.threshold is None:
+            result = "no threshold found"
+        else:
+            result = f"threshold {self.threshold:g}"
+        return (
+            f"Threshold search on CH {self.channel_id} ({self.strategy}, responses from {self.source}): "
+            f"{result} after {len(self.trials)} trials"
+        )
+
+    def _run(self):
+        try:
+            self._search()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception(f"Threshold search on CH {self.channel_id} failed")
+        finally:
+            # always called, so that the GUI can restore the state of the device
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def _search(self):
+        logger.info(f"Starting threshold search on CH {self.channel_id}: {self.strategy}, responses from {self.source}")
+        try:
+            t_next = time.monotonic_ns()
+            while (
+                not self._stop.is_set()
+                and not self.strategy.done
+                and len(self.trials) < self.max_trials
+            ):
+                amplitude = min(
+                    max(self.strategy.next_amplitude(), -self.max_amplitude),
+                    self.max_amplitude,
+                )
+                amp = int(amplitude * self.scale)
+                command = self._template.format(amp, -amp).encode()
+                if not wait_until(t_next, stop_event=self._stop):
+                    break
+                self.source.clear()
+                self.stimjim.write(command)
+                t_fired = time.monotonic_ns()
+                response = self.source.wait(self.response_timeout_s, self._stop)
+                if self._stop.is_set():
+                    break
+                response = bool(response)
+                self.strategy.update(response)
+                self.trials.append((amplitude, response, t_fired))
+                if self.on_trial is not None:
+                    self.on_trial((amplitude, response))
+                t_next = t_fired + self.interval_ns
+        finally:
+            self.source.close()
+            self.stimjim.write(self._restore_command)
+        if not self._stop.is_set():
+            self.threshold = self.strategy.threshold
+        logger.info(self.summary())
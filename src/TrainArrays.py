@@ -0,0 +1,113 @@
+"""
+Compact representation of many pulse trains as NumPy arrays, for batch generation and analysis.
+
+For N trains:
+ - modes: (N, STIMJIM_N_OUTPUTS) output mode of each channel
+ - period_us, duration_us, n_stages: (N,)
+ - amps: (N, MAX_N_PHASES, STIMJIM_N_OUTPUTS) stage amplitudes, in mV or μA depending on the mode
+ - stage_us: (N, MAX_N_PHASES) stage durations
+Stages beyond n_stages are zero.
+"""
+from typing import List
+
+import numpy as np
+
+from src.StimJim import PulseTrain, PulseStage, STIMJIM_N_OUTPUTS, StimJimOutputModes
+
+
+class TrainArrays(object):
+    MAX_N_PHASES = PulseTrain.MAX_N_PHASES
+
+    def __init__(self, modes, period_us, duration_us, n_stages, amps, stage_us):
+        self.modes = np.asarray(modes, dtype=np.int64)
+        self.period_us = np.asarray(period_us, dtype=np.int64)
+        self.duration_us = np.asarray(duration_us, dtype=np.int64)
+        self.n_stages = np.asarray(n_stages, dtype=np.int64)
+        self.amps = np.asarray(amps, dtype=np.int64)
+        self.stage_us = np.asarray(stage_us, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.period_us)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = [item]
+        return TrainArrays(
+            self.modes[item],
+            self.period_us[item],
+            self.duration_us[item],
+            self.n_stages[item],
+            self.amps[item],
+            self.stage_us[item],
+        )
+
+    @staticmethod
+    def empty(n: int):
+        return TrainArrays(
+            np.full((n, STIMJIM_N_OUTPUTS), StimJimOutputModes.GROUNDED),
+            np.zeros(n),
+            np.zeros(n),
+            np.zeros(n),
+            np.zeros((n, TrainArrays.MAX_N_PHASES, STIMJIM_N_OUTPUTS)),
+            np.zeros((n, TrainArrays.MAX_N_PHASES)),
+        )
+
+    @staticmethod
+    def from_pulse_trains(pulse_trains: List[PulseTrain]):
+        # collect plain lists and convert them once, assigning to the arrays element by element is much slower
+        arrays = TrainArrays.empty(len(pulse_trains))
+        arrays.modes[:] = [[pt.get_mode(ch) for ch in range(STIMJIM_N_OUTPUTS)] for pt in pulse_trains]
+        arrays.period_us[:] = [pt.train_period_us for pt in pulse_trains]
+        arrays.duration_us[:] = [pt.train_duration_us for pt in pulse_trains]
+        arrays.n_stages[:] = [len(pt.stages) for pt in pulse_trains]
+        for i, pt in enumerate(pulse_trains):
+            if pt.stages:
+                n = len(pt.stages)
+                arrays.amps[i, :n] = [[int(a) for a in stage.channel_amps] for stage in pt.stages]
+                arrays.stage_us[i, :n] = [int(stage.duration_us) for stage in pt.stages]
+        return arrays
+
+    def to_pulse_trains(self, train_ids=None) -> List[PulseTrain]:
+        train_ids = range(len(self)) if train_ids is None else train_ids
+        pulse_trains = []
+        for i, train_id in enumerate(train_ids):
+            pt = PulseTrain(
+                int(train_id),
+                train_period_us=int(self.period_us[i]),
+                train_duration_us=int(self.duration_us[i]),
+                channel_modes=[StimJimOutputModes(int(m)) for m in self.modes[i]],
+            )
+            for j in range(self.n_stages[i]):
+                pt.add_stage(
+                    PulseStage(
+                        ch0_amp=int(self.amps[i, j, 0]),
+                        ch1_amp=int(self.amps[i, j, 1]),
+                        duration=int(self.stage_us[i, j]),
+                    )
+                )
+            pulse_trains.append(pt)
+        return pulse_trains
+
+    def get_keys(self) -> List[str]:
+        """
+        Returns the StimJim command of each train without the "S<train id>," prefix, which is also the key used by
+        TrainLibrary
+        """
+        keys = []
+        for modes, period, duration, n, amps, stage_us in zip(
+            self.modes.tolist(),
+            self.period_us.tolist(),
+            self.duration_us.tolist(),
+            self.n_stages.tolist(),
+            self.amps.tolist(),
+            self.stage_us.tolist(),
+        ):
+            key = f"{modes[0]:d},{modes[1]:d},{period:d},{duration:d}"
+            for j in range(n):
+                key += f";{amps[j][0]:d},{amps[j][1]:d},{stage_us[j]:d}"
+            keys.append(key)
+        return keys
+
+    def get_stimjim_strings(self, train_ids=None) -> List[str]:
+        train_ids = range(len(self)) if train_ids is None else train_ids
+        return [f"S{int(i):d},{key}\n" for i, key in zip(train_ids, self.get_keys())]
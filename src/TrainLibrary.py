@@ -0,0 +1,203 @@
+"""
+Virtual pulse trains: an unbounded library of trains, paged on demand into the STIMJIM_MAX_PULSETRAINS slots of the
+device.
+
+Trains are content-addressed: the key of a train is its StimJim command without the train id, so identical trains
+share a key and a device slot. SlotAllocator keeps track of which train is resident in which slot, uploads trains
+only on cache misses, and evicts the least recently used train when all the slots are taken.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from src.StimJim import (
+    StimJim,
+    PulseTrain,
+    StimJimTrigDirection,
+    STIMJIM_MAX_PULSETRAINS,
+    STIMJIM_N_TRIGGERS,
+    STIMJIM_TRIGGER_COMMANDS,
+)
+
+logger = logging.getLogger("StimJimGUI")
+
+
+class StimJimNoFreeSlotException(Exception):
+    pass
+
+
+class TrainLibrary(object):
+    def __init__(self):
+        self._trains = {}  # key -> train duration (μs)
+
+    @staticmethod
+    def get_key(pulse_train: PulseTrain) -> str:
+        # "S12,0,3,2000,1000000;..." -> "0,3,2000,1000000;..."
+        return pulse_train.get_stimjim_string().split(",", 1)[1].rstrip("\n")
+
+    def add(self, pulse_train: PulseTrain) -> str:
+        key = self.get_key(pulse_train)
+        self.add_key(key)
+        return key
+
+    def add_key(self, key: str) -> str:
+        if key not in self._trains:
+            self._trains[key] = int(key.split(";", 1)[0].split(",")[3])
+        return key
+
+    def get_duration_us(self, key: str) -> int:
+        return self._trains[key]
+
+    @staticmethod
+    def get_stimjim_string(key: str, slot: int) -> str:
+        return f"S{slot:d},{key}\n"
+
+    def __len__(self):
+        return len(self._trains)
+
+    def __contains__(self, key):
+        return key in self._trains
+
+
+class SlotAllocator(object):
+    def __init__(
+        self, stimjim: StimJim, library: TrainLibrary = None, slots=None
+    ):
+        self.stimjim = stimjim
+        self.library = TrainLibrary() if library is None else library
+        self.slots = list(range(STIMJIM_MAX_PULSETRAINS) if slots is None else slots)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._resident = OrderedDict()  # key -> slot, least recently used first
+        self._free = list(reversed(self.slots))
+        self._pinned = set()
+        self._busy_until_ns = {}  # key -> time at which the last train fired from that slot ends
+        self._trigger_targets = [None] * STIMJIM_N_TRIGGERS
+
+    def reset(self):
+        """
+        Forgets everything about the device slots, e.g. after the StimJim was restarted
+        """
+        self._resident.clear()
+        self._free = list(reversed(self.slots))
+        self._busy_until_ns.clear()
+        self._trigger_targets = [None] * STIMJIM_N_TRIGGERS
+
+    def get_slot(self, key: str):
+        """
+        Returns the slot holding that train, or None if it is not on the device
+        """
+        return self._resident.get(key)
+
+    def pin(self, key: str):
+        self._pinned.add(key)
+
+    def unpin(self, key: str):
+        self._pinned.discard(key)
+
+    def _evictable(self, key: str, now_ns: int) -> bool:
+        return (
+            key not in self._pinned
+            and key not in self._trigger_targets
+            and self._busy_until_ns.get(key, 0) <= now_ns
+        )
+
+    def ensure(self, key: str):
+        """
+        Makes sure that the train is resident on the device.
+        Returns a tuple (slot, command) where command is the upload command to send, or "" on cache hits
+        """
+        self.library.add_key(key)
+        slot = self._resident.get(key)
+        if slot is not None:
+            self._resident.move_to_end(key)
+            self.hits += 1
+            return slot, ""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            now_ns = time.monotonic_ns()
+            victim = next(
+                (k for k in self._resident if self._evictable(k, now_ns)), None
+            )
+            if victim is None:
+                raise StimJimNoFreeSlotException(
+                    f"All {len(self.slots)} slots hold trains that are pinned, targeted or running"
+                )
+            slot = self._resident.pop(victim)
+            self._busy_until_ns.pop(victim, None)
+            self.evictions += 1
+        self.misses += 1
+        self._resident[key] = slot
+        return slot, self.library.get_stimjim_string(key, slot)
+
+    def ensure_all(self, keys):
+        """
+        Makes all the trains resident, uploading the missing ones in a single write. Returns the list of slots
+        """
+        return self._ensure_batch(keys, partial=False)
+
+    def prefetch(self, keys) -> int:
+        """
+        Uploads as many of the trains as can be made resident right now, in a single write.
+        Returns the number of trains, from the start of keys, that are resident
+        """
+        return len(self._ensure_batch(keys, partial=True))
+
+    def _ensure_batch(self, keys, partial: bool):
+        slots, commands = [], []
+        # don't evict a train needed by this batch to make room for another one
+        batch_pins = set(keys) - self._pinned
+        self._pinned |= batch_pins
+        try:
+            for key in keys:
+                try:
+                    slot, command = self.ensure(key)
+                except StimJimNoFreeSlotException:
+                    if partial:
+                        break
+                    raise
+                slots.append(slot)
+                if command:
+                    commands.append(command)
+        finally:
+            self._pinned -= batch_pins
+            if commands:
+                self.stimjim.send_commands(commands)
+        return slots
+
+    def fire(self, trigger: int, key: str) -> int:
+        """
+        Fires the train with a manual trigger, uploading it first if needed. Returns the slot used
+        """
+        slot, command = self.ensure(key)
+        self._busy_until_ns[key] = (
+            time.monotonic_ns() + self.library.get_duration_us(key) * 1000
+        )
+        self.stimjim.write(
+            (command + f"{STIMJIM_TRIGGER_COMMANDS[trigger]}{slot:d}\n").encode()
+        )
+        return slot
+
+    def retarget(
+        self, trigger: int, key: str, direction=StimJimTrigDirection.RISING
+    ) -> int:
+        """
+        Points a TRIG input at the train, uploading it first if needed. Returns the slot used
+        """
+        slot, command = self.ensure(key)
+        self._trigger_targets[trigger] = key
+        self.stimjim.write((command + f"R{trigger:d},{slot:d},{direction:d}\n").encode())
+        return slot
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+            resident=len(self._resident),
+            library=len(self.library),
+        )
@@ -0,0 +1,377 @@
+"""
+Overview of all the Full Mode trains in a single table, with one row per stage, grouped by train (trains without
+stages have a single row). Rows are loaded in batches as the table is scrolled (fetchMore).
+
+Edits work on a TrainArrays copy of all the trains: bulk operations are applied with NumPy to all the selected cells
+at once, then the modified trains are replaced in the StimJim and reported with trainsEdited, so that they can be
+uploaded in a single write.
+"""
+from typing import List
+
+import numpy as np
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import (
+    QDockWidget,
+    QTableView,
+    QHeaderView,
+    QAbstractItemView,
+    QWidget,
+    QVBoxLayout,
+    QHBoxLayout,
+    QPushButton,
+    QInputDialog,
+)
+
+from src.StatisticsPanel import format_si
+from src.StimJim import (
+    StimJim,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_MODE_NAMES,
+    STIMJIM_UNITS,
+    STIMJIM_SCALING_FACTORS,
+    STIMJIM_DURATION_SCALING_FACTOR,
+    STIMJIM_MAX_PULSETRAINS,
+    StimJimOutputModes,
+)
+from src.TrainArrays import TrainArrays
+from src.Validation import max_amplitudes
+
+OVERVIEW_FETCH_BATCH = 64  # rows loaded at a time
+OVERVIEW_GROUP_COLOR = QColor(240, 240, 240)  # background of every other train
+
+
+def parse_train_ids(text: str) -> List[int]:
+    """
+    Parses a list of trains such as "3, 5-9"
+    """
+    train_ids = []
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        train_ids.extend(range(int(first), int(last or first) + 1))
+    for train_id in train_ids:
+        if not 0 <= train_id < STIMJIM_MAX_PULSETRAINS:
+            raise ValueError(f"Invalid train {train_id}")
+    return train_ids
+
+
+def amplitude_limits(modes) -> np.ndarray:
+    """
+    Returns the largest amplitude (mV or μA) that can be set for channels in the given modes: the limit of the mode for
+    active channels, the largest limit of all the modes for inactive ones
+    """
+    limits = max_amplitudes(modes)
+    return np.where(limits > 0, limits, max_amplitudes(list(StimJimOutputModes)).max())
+
+
+def scale_amplitudes(arrays: TrainArrays, trains, stages, channels, factor: float) -> np.ndarray:
+    """
+    Multiplies the amplitudes of the cells (trains[k], stages[k], channels[k]) by factor, within the limits of
+    amplitude_limits. Returns the modified trains
+    """
+    limits = amplitude_limits(arrays.modes[trains, channels])
+    amps = np.rint(arrays.amps[trains, stages, channels] * factor)
+    arrays.amps[trains, stages, channels] = np.clip(amps, -limits, limits)
+    return np.unique(trains)
+
+
+def shift_durations(arrays: TrainArrays, trains, stages, delta_us: int) -> np.ndarray:
+    """
+    Adds delta_us to the durations of the stages (trains[k], stages[k]), without going below 0. Returns the modified
+    trains
+    """
+    arrays.stage_us[trains, stages] = np.maximum(arrays.stage_us[trains, stages] + int(delta_us), 0)
+    return np.unique(trains)
+
+
+def set_modes(arrays: TrainArrays, trains, channels, mode: int) -> np.ndarray:
+    """
+    Sets the mode of the channels (trains[k], channels[k]). Returns the modified trains
+    """
+    arrays.modes[trains, channels] = int(mode)
+    return np.unique(trains)
+
+
+def copy_train(arrays: TrainArrays, source: int, targets) -> np.ndarray:
+    """
+    Copies train source into the targets. Returns the modified trains
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    for name in ["modes", "period_us", "duration_us", "n_stages", "amps", "stage_us"]:
+        values = getattr(arrays, name)
+        values[targets] = values[source]
+    return np.unique(targets)
+
+
+# noinspection PyMethodOverriding
+class TrainOverviewModel(QAbstractTableModel):
+    HEADER = [
+        "Train",
+        "CH0 mode",
+        "CH1 mode",
+        "Period",
+        "Duration",
+        "Stage",
+        "CH0 amp",
+        "CH1 amp",
+        "Stage duration",
+    ]
+    MODE_COLUMNS = [1, 2]
+    AMP_COLUMNS = [6, 7]
+    TRAIN_COLUMNS = [0, 1, 2, 3, 4]  # only shown on the first row of each train
+    STAGE_DURATION_COLUMN = 8
+
+    # emitted with the ids of the trains that were edited
+    trainsEdited = pyqtSignal(object)
+
+    def __init__(self, stimjim: StimJim, parent=None):
+        super().__init__(parent)
+        self.stimjim = stimjim
+        self.arrays = TrainArrays.empty(0)
+        self.row_trains = np.zeros(0, dtype=np.int64)
+        self.row_stages = np.zeros(0, dtype=np.int64)  # -1 for trains without stages
+        self._n_loaded = 0
+        self.refresh()
+
+    def set_stimjim(self, stimjim: StimJim):
+        self.stimjim = stimjim
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reads the trains again. The rows are only reset if the number of stages of a train changed
+        """
+        arrays = TrainArrays.from_pulse_trains(self.stimjim.pulse_trains)
+        if np.array_equal(arrays.n_stages, self.arrays.n_stages):
+            self.arrays = arrays
+            if self._n_loaded > 0:
+                self.dataChanged.emit(
+                    self.index(0, 0), self.index(self._n_loaded - 1, self.columnCount() - 1)
+                )
+            return
+        self.beginResetModel()
+        self.arrays = arrays
+        counts = np.maximum(arrays.n_stages, 1)
+        self.row_trains = np.repeat(np.arange(len(arrays)), counts)
+        first = np.cumsum(counts) - counts
+        self.row_stages = np.where(
+            arrays.n_stages[self.row_trains] > 0,
+            np.arange(len(self.row_trains)) - first[self.row_trains],
+            -1,
+        )
+        self._n_loaded = min(max(self._n_loaded, OVERVIEW_FETCH_BATCH), len(self.row_trains))
+        self.endResetModel()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._n_loaded < len(self.row_trains)
+
+    def fetchMore(self, parent=QModelIndex()):
+        n = min(OVERVIEW_FETCH_BATCH, len(self.row_trains) - self._n_loaded)
+        self.beginInsertRows(QModelIndex(), self._n_loaded, self._n_loaded + n - 1)
+        self._n_loaded += n
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADER[section]
+        return None
+
+    def rowCount(self, index=QModelIndex()):
+        return 0 if index.isValid() else self._n_loaded
+
+    def columnCount(self, index=QModelIndex()):
+        return len(self.HEADER)
+
+    def _is_shown(self, row: int, column: int) -> bool:
+        if column in self.TRAIN_COLUMNS:
+            return self.row_stages[row] <= 0
+        return self.row_stages[row] >= 0
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() not in [0, 5] + self.MODE_COLUMNS and self._is_shown(index.row(), index.column()):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def _get_value(self, row: int, column: int) -> int:
+        """
+        Returns the value of a cell, in mV, μA or μs
+        """
+        i, j = self.row_trains[row], self.row_stages[row]
+        if column == 3:
+            return self.arrays.period_us[i]
+        elif column == 4:
+            return self.arrays.duration_us[i]
+        elif column in self.AMP_COLUMNS:
+            return self.arrays.amps[i, j, self.AMP_COLUMNS.index(column)]
+        return self.arrays.stage_us[i, j]
+
+    def data(self, index, role):
+        row, column = index.row(), index.column()
+        i = int(self.row_trains[row])
+        if role == Qt.BackgroundRole:
+            return OVERVIEW_GROUP_COLOR if i % 2 else None
+        if role not in (Qt.DisplayRole, Qt.EditRole) or not self._is_shown(row, column):
+            return None
+        if column == 0:
+            return str(i)
+        elif column == 5:
+            return str(self.row_stages[row] + 1)
+        elif column in self.MODE_COLUMNS:
+            return STIMJIM_MODE_NAMES[int(self.arrays.modes[i, self.MODE_COLUMNS.index(column)])]
+        value = int(self._get_value(row, column))
+        if role == Qt.EditRole:
+            return value
+        if column in self.AMP_COLUMNS:
+            mode = int(self.arrays.modes[i, self.AMP_COLUMNS.index(column)])
+            return format_si(value / STIMJIM_SCALING_FACTORS[mode], STIMJIM_UNITS[mode]).strip()
+        return format_si(value / STIMJIM_DURATION_SCALING_FACTOR, "s")
+
+    def setData(self, index, value, role):
+        """
+        Rejects values that are not integers, negative durations and amplitudes beyond amplitude_limits
+        """
+        if role != Qt.EditRole or not self.flags(index) & Qt.ItemIsEditable:
+            return False
+        if isinstance(value, bool) or not isinstance(value, (int, np.integer)):
+            return False
+        row, column = index.row(), index.column()
+        i, j = self.row_trains[row], self.row_stages[row]
+        if column in self.AMP_COLUMNS:
+            if abs(value) > amplitude_limits(self.arrays.modes[i, self.AMP_COLUMNS.index(column)]):
+                return False
+        elif not 0 <= value <= np.iinfo(np.int64).max:
+            return False
+        if column == 3:
+            self.arrays.period_us[i] = value
+        elif column == 4:
+            self.arrays.duration_us[i] = value
+        elif column in self.AMP_COLUMNS:
+            self.arrays.amps[i, j, self.AMP_COLUMNS.index(column)] = value
+        else:
+            self.arrays.stage_us[i, j] = value
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
+        self._commit([i])
+        return True
+
+    def get_cells(self, indexes):
+        """
+        Returns the trains, stages and columns of the given indexes, as arrays
+        """
+        rows = np.array([index.row() for index in indexes], dtype=np.int64)
+        columns = np.array([index.column() for index in indexes], dtype=np.int64)
+        return self.row_trains[rows], self.row_stages[rows], columns
+
+    def scale_amplitudes(self, indexes, factor: float):
+        trains, stages, columns = self.get_cells(indexes)
+        mask = np.isin(columns, self.AMP_COLUMNS) & (stages >= 0)
+        channels = columns[mask] - self.AMP_COLUMNS[0]
+        self._apply(scale_amplitudes(self.arrays, trains[mask], stages[mask], channels, factor))
+
+    def shift_durations(self, indexes, delta_us: int):
+        trains, stages, columns = self.get_cells(indexes)
+        mask = (columns == self.STAGE_DURATION_COLUMN) & (stages >= 0)
+        self._apply(shift_durations(self.arrays, trains[mask], stages[mask], delta_us))
+
+    def set_mode(self, indexes, mode: int):
+        """
+        Sets the mode of the selected channels: any cell of an amplitude or mode column selects the channel of its
+        train
+        """
+        trains, _, columns = self.get_cells(indexes)
+        channel_columns = np.full(self.columnCount(), -1)
+        channel_columns[self.MODE_COLUMNS] = np.arange(STIMJIM_N_OUTPUTS)
+        channel_columns[self.AMP_COLUMNS] = np.arange(STIMJIM_N_OUTPUTS)
+        channels = channel_columns[columns]
+        mask = channels >= 0
+        self._apply(set_modes(self.arrays, trains[mask], channels[mask], mode))
+
+    def copy_train(self, source: int, targets):
+        self._apply(copy_train(self.arrays, source, targets))
+
+    def _apply(self, train_ids):
+        if len(train_ids) == 0:
+            return
+        self._commit(train_ids)
+        self.refresh()
+
+    def _commit(self, train_ids):
+        train_ids = [int(i) for i in train_ids]
+        for pulse_train in self.arrays[train_ids].to_pulse_trains(train_ids):
+            self.stimjim.pulse_trains[pulse_train.train_id] = pulse_train
+        self.trainsEdited.emit(train_ids)
+
+
+class TrainOverviewDock(QDockWidget):
+    def __init__(self, stimjim: StimJim, parent=None):
+        super().__init__("Trains overview", parent)
+        self.setObjectName("trainOverviewDock")
+        self.model = TrainOverviewModel(stimjim, self)
+        self.table = QTableView(self)
+        self.table.setModel(self.model)
+        self.table.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+
+        buttons = [
+            ("Scale amplitudes...", self._on_scale_amplitudes),
+            ("Shift durations...", self._on_shift_durations),
+            ("Set mode...", self._on_set_mode),
+            ("Copy train to...", self._on_copy_train),
+        ]
+        button_layout = QHBoxLayout()
+        for text, slot in buttons:
+            button = QPushButton(text, self)
+            button.clicked.connect(slot)
+            button_layout.addWidget(button)
+        button_layout.addStretch()
+
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(button_layout)
+        layout.addWidget(self.table)
+        self.setWidget(widget)
+
+    def set_stimjim(self, stimjim: StimJim):
+        self.model.set_stimjim(stimjim)
+
+    def update_overview(self):
+        if not self.isVisible():
+            return
+        self.model.refresh()
+
+    def _get_selection(self):
+        return self.table.selectionModel().selectedIndexes()
+
+    def _on_scale_amplitudes(self, _):
+        factor, ok = QInputDialog.getDouble(self, "Scale amplitudes", "Factor", 1.0, -100, 100, 3)
+        if ok:
+            self.model.scale_amplitudes(self._get_selection(), factor)
+
+    def _on_shift_durations(self, _):
+        delta, ok = QInputDialog.getDouble(self, "Shift durations", "Shift (s)", 0.0, -1e3, 1e3, 6)
+        if ok:
+            self.model.shift_durations(self._get_selection(), round(delta * STIMJIM_DURATION_SCALING_FACTOR))
+
+    def _on_set_mode(self, _):
+        names = list(STIMJIM_MODE_NAMES.values())
+        name, ok = QInputDialog.getItem(self, "Set mode", "Mode", names, 0, False)
+        if ok:
+            self.model.set_mode(self._get_selection(), names.index(name))
+
+    def _on_copy_train(self, _):
+        selection = self._get_selection()
+        if not selection:
+            return
+        source = int(self.model.row_trains[selection[0].row()])
+        text, ok = QInputDialog.getText(self, "Copy train", f"Copy train {source} to (e.g. 3, 5-9)")
+        if not ok:
+            return
+        try:
+            targets = parse_train_ids(text)
+        except ValueError:
+            return
+        self.model.copy_train(source, targets)
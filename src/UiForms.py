@@ -0,0 +1,95 @@
+"""
+Qt Designer forms (src/*.ui), compiled to Python instead of being parsed with uic.loadUi every time a widget is built.
+
+A form is compiled the first time it is used, and the generated module is cached in FORMS_CACHE_DIR, keyed by the hash
+of the .ui file, so it is only compiled again when the form changes. The cache can also be filled at install time
+with `python -m src.UiForms`. If the cache cannot be written, the form is loaded with uic.loadUi instead. Paths are
+relative to this file, so that the application can be launched from any directory. The icons of the forms are
+registered by src.Icons before a form is built.
+"""
+import hashlib
+import importlib.util
+import io
+import logging
+import re
+from pathlib import Path
+
+from src.Icons import register_resources
+
+FORMS_DIR = Path(__file__).resolve().parent
+FORMS_CACHE_DIR = FORMS_DIR / "__uicache__"
+# compiled forms import the resources of the .qrc files as <name>_rc, they are registered by setup_form instead
+_RESOURCE_IMPORT = re.compile(r"^import \w+_rc$\n?", re.MULTILINE)
+FORMS_CACHE_VERSION = 2  # part of the key of the compiled forms, to compile them again when their generation changes
+
+logger = logging.getLogger("StimJimGUI")
+
+_form_classes = {}  # form name -> Ui class, or None when the form is loaded at runtime
+
+
+def get_form_path(name: str) -> Path:
+    return FORMS_DIR / f"{name}.ui"
+
+
+def compile_form(name: str) -> Path:
+    """
+    Compiles the form into the cache if needed, and returns the path of the compiled module. Raises OSError if the
+    cache cannot be written
+    """
+    ui_path = get_form_path(name)
+    digest = hashlib.sha1(ui_path.read_bytes() + bytes([FORMS_CACHE_VERSION])).hexdigest()[:16]
+    module_path = FORMS_CACHE_DIR / f"ui_{name}_{digest}.py"
+    if not module_path.is_file():
+        from PyQt5 import uic
+
+        source = io.StringIO()
+        uic.compileUi(str(ui_path), source)
+        FORMS_CACHE_DIR.mkdir(exist_ok=True)
+        for old_module in FORMS_CACHE_DIR.glob(f"ui_{name}_*.py"):
+            old_module.unlink()
+        tmp_path = module_path.with_suffix(".tmp")
+        tmp_path.write_text(_RESOURCE_IMPORT.sub("", source.getvalue()))
+        tmp_path.replace(module_path)  # so that another instance never imports a partial file
+        logger.debug(f"Compiled form {ui_path} to {module_path}")
+    return module_path
+
+
+def load_form_class(name: str):
+    """
+    Returns the Ui class of the compiled form (see compile_form)
+    """
+    module_path = compile_form(name)
+    spec = importlib.util.spec_from_file_location(module_path.stem, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return next(
+        value for key, value in vars(module).items() if key.startswith("Ui_") and isinstance(value, type)
+    )
+
+
+def setup_form(widget, name: str):
+    """
+    Builds the form in widget, like uic.loadUi(<form>, widget): the child widgets become attributes of widget
+    """
+    register_resources()
+    if name not in _form_classes:
+        try:
+            _form_classes[name] = load_form_class(name)
+        except OSError as e:
+            logger.debug(f"Could not use a compiled version of form {name}, loading it at runtime ({e})")
+            _form_classes[name] = None
+    form_class = _form_classes[name]
+    if form_class is None:
+        from PyQt5 import uic
+
+        uic.loadUi(str(get_form_path(name)), widget)
+        return
+    form = form_class()
+    form.setupUi(widget)
+    for attribute, value in vars(form).items():
+        setattr(widget, attribute, value)
+
+
+if __name__ == "__main__":
+    for path in sorted(FORMS_DIR.glob("*.ui")):
+        print(f"{path.name} -> {compile_form(path.stem)}")
@@ -0,0 +1,220 @@
+"""
+Validation of pulse trains before they are uploaded: every rule is checked for all the trains at once with NumPy, and
+each violation is reported as a Diagnostic pointing at a train, and when relevant at a stage and a channel, i.e. at a
+cell of the stages table.
+
+Rules:
+ - amplitude_range (error): amplitude beyond STIMJIM_MAX_VALS for the mode of the channel
+ - charge_density (error): charge of a phase above the configured limit, for channels in current mode
+ - net_charge (error): net charge of a pulse above the configured limit, for channels in current mode
+ - inactive_channel (warning): non-zero amplitude on a grounded or disconnected channel
+ - period_overflow (warning): stage ending after train_period_us, it is cut by the next pulse
+ - duration_overflow (warning): stages longer than train_duration_us, the pulse is cut by the end of the train
+Trains with errors should not be uploaded.
+
+The GUI needs Severity and ValidationLimits before its window is shown, so NumPy (and the modules using it) is only
+imported by the functions that actually validate.
+"""
+from enum import IntEnum
+from typing import List
+
+from src.StimJim import (
+    StimJim,
+    StimJimOutputModes,
+    STIMJIM_MAX_VALS,
+    STIMJIM_SCALING_FACTORS,
+    STIMJIM_N_OUTPUTS,
+)
+
+# stage table column of the stage durations, the amplitudes are in the columns of their channel
+VALIDATION_DURATION_COLUMN = STIMJIM_N_OUTPUTS
+
+# largest amplitude (mV or μA) allowed in each mode
+_MAX_AMPS = [STIMJIM_MAX_VALS[m] * STIMJIM_SCALING_FACTORS[m] for m in StimJimOutputModes]
+
+
+def max_amplitudes(modes):
+    """
+    Returns the largest amplitude (mV or μA) allowed for channels in the given modes, 0 for inactive channels, as an
+    array of the shape of modes
+    """
+    import numpy as np
+
+    return np.array(_MAX_AMPS)[np.asarray(modes)]
+
+
+class Severity(IntEnum):
+    WARNING = 0
+    ERROR = 1
+
+
+class Diagnostic(object):
+    def __init__(
+        self, severity: Severity, rule: str, train: int, stage: int = -1, channel: int = -1, message: str = ""
+    ):
+        self.severity = severity
+        self.rule = rule
+        self.train = train
+        self.stage = stage
+        self.channel = channel
+        self.message = message
+
+    def __eq__(self, other):
+        return isinstance(other, Diagnostic) and self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        where = f"train {self.train}"
+        if self.stage >= 0:
+            where += f", stage {self.stage + 1}"
+        if self.channel >= 0:
+            where += f", CH {self.channel}"
+        return f"{self.severity.name} [{self.rule}] {where}: {self.message}"
+
+    @property
+    def column(self) -> int:
+        """
+        Column of the stages table concerned, or -1 for the whole train
+        """
+        if self.channel >= 0:
+            return self.channel
+        return VALIDATION_DURATION_COLUMN if self.stage >= 0 else -1
+
+
+class ValidationLimits(object):
+    """
+    Optional safety limits for channels in current mode. The charge density limit (per phase) needs the electrode area
+    """
+
+    def __init__(
+        self, electrode_area_cm2: float = None, max_charge_density_uc_cm2: float = None, max_net_charge_nc: float = None
+    ):
+        self.electrode_area_cm2 = electrode_area_cm2
+        self.max_charge_density_uc_cm2 = max_charge_density_uc_cm2
+        self.max_net_charge_nc = max_net_charge_nc
+
+    def to_json(self):
+        return self.__dict__
+
+    @staticmethod
+    def from_json(json_dict):
+        return ValidationLimits(**json_dict)
+
+
+def validate(arrays, limits: ValidationLimits = None) -> List[Diagnostic]:
+    """
+    Checks all the trains of arrays (a TrainArrays)
+    """
+    import numpy as np
+
+    from src.TrainArrays import TrainArrays
+    from src.Waveform import WAVEFORM_ACTIVE_MODES
+
+    limits = ValidationLimits() if limits is None else limits
+    diagnostics = []
+    stage_exists = np.arange(TrainArrays.MAX_N_PHASES) < arrays.n_stages[:, None]  # (N, MAX_N_PHASES)
+    cells = stage_exists[:, :, None]  # (N, MAX_N_PHASES, 1) broadcast over channels
+    modes = arrays.modes[:, None, :]
+    active = np.isin(modes, WAVEFORM_ACTIVE_MODES)
+    current = modes == StimJimOutputModes.CURRENT
+    amps = np.abs(arrays.amps)
+
+    def report(mask, severity, rule, message):
+        for train, stage, channel in zip(*np.nonzero(mask)):
+            diagnostics.append(
+                Diagnostic(severity, rule, int(train), int(stage), int(channel), message(train, stage, channel))
+            )
+
+    # amplitudes
+    max_amps = max_amplitudes(modes)
+    report(
+        cells & active & (amps > max_amps),
+        Severity.ERROR,
+        "amplitude_range",
+        lambda i, j, ch: f"amplitude {arrays.amps[i, j, ch]:d} exceeds ±{max_amps[i, 0, ch]:g} "
+        f"({StimJimOutputModes(int(arrays.modes[i, ch])).name.lower()} mode)",
+    )
+    report(
+        cells & ~active & (amps != 0),
+        Severity.WARNING,
+        "inactive_channel",
+        lambda i, j, ch: f"amplitude {arrays.amps[i, j, ch]:d} on a "
+        f"{StimJimOutputModes(int(arrays.modes[i, ch])).name.lower()} channel",
+    )
+
+    # charges, in nC (μA x μs = pC)
+    phase_charge_nc = arrays.amps * arrays.stage_us[:, :, None] * 1e-3
+    if limits.electrode_area_cm2 and limits.max_charge_density_uc_cm2:
+        density = np.abs(phase_charge_nc) * 1e-3 / limits.electrode_area_cm2
+        report(
+            cells & current & (density > limits.max_charge_density_uc_cm2),
+            Severity.ERROR,
+            "charge_density",
+            lambda i, j, ch: f"{density[i, j, ch]:.3g} μC/cm² per phase exceeds "
+            f"{limits.max_charge_density_uc_cm2:g} μC/cm²",
+        )
+    if limits.max_net_charge_nc is not None:
+        net = np.abs(np.where(cells, phase_charge_nc, 0).sum(axis=1))  # (N, STIMJIM_N_OUTPUTS)
+        mask = (net > limits.max_net_charge_nc) & (arrays.modes == StimJimOutputModes.CURRENT)
+        for train, channel in zip(*np.nonzero(mask)):
+            diagnostics.append(
+                Diagnostic(
+                    Severity.ERROR,
+                    "net_charge",
+                    int(train),
+                    channel=int(channel),
+                    message=f"net charge {net[train, channel]:.3g} nC per pulse exceeds "
+                    f"{limits.max_net_charge_nc:g} nC",
+                )
+            )
+
+    # timing
+    stage_us = np.where(stage_exists, arrays.stage_us, 0)
+    ends = np.cumsum(stage_us, axis=1)
+    overflow = stage_exists & (arrays.period_us[:, None] > 0) & (ends > arrays.period_us[:, None])
+    for train, stage in zip(*np.nonzero(overflow)):
+        diagnostics.append(
+            Diagnostic(
+                Severity.WARNING,
+                "period_overflow",
+                int(train),
+                int(stage),
+                message=f"stage ends at {ends[train, stage]:d} μs, after the period ({arrays.period_us[train]:d} μs)",
+            )
+        )
+    pulse_us = ends[:, -1]
+    for train in np.nonzero((arrays.n_stages > 0) & (pulse_us > arrays.duration_us))[0]:
+        diagnostics.append(
+            Diagnostic(
+                Severity.WARNING,
+                "duration_overflow",
+                int(train),
+                message=f"the stages last {pulse_us[train]:d} μs, longer than the train "
+                f"({arrays.duration_us[train]:d} μs)",
+            )
+        )
+    return diagnostics
+
+
+def validate_stimjim(stimjim: StimJim, limits: ValidationLimits = None, train_ids=None) -> List[Diagnostic]:
+    """
+    Checks the trains train_ids of stimjim (all by default). The rules only look at one train at a time, so the
+    diagnostics of the other trains do not change
+    """
+    from src.TrainArrays import TrainArrays
+
+    if train_ids is None:
+        return validate(TrainArrays.from_pulse_trains(stimjim.pulse_trains), limits)
+    train_ids = list(train_ids)
+    if not train_ids:
+        return []
+    diagnostics = validate(TrainArrays.from_pulse_trains([stimjim.pulse_trains[i] for i in train_ids]), limits)
+    for d in diagnostics:
+        d.train = train_ids[d.train]
+    return diagnostics
+
+
+def has_errors(diagnostics: List[Diagnostic], train: int = None) -> bool:
+    return any(
+        d.severity == Severity.ERROR and (train is None or d.train == train)
+        for d in diagnostics
+    )
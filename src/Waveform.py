@@ -0,0 +1,195 @@
+"""
+Waveform synthesis: the output of both channels when a train is fired, computed with NumPy for many trains at once.
+
+A train starts a pulse every train_period_us, until train_duration_us has elapsed. Each pulse plays the stages in
+order, and is cut short by the next pulse if the stages are longer than the period, or by the end of the train.
+Channels that are grounded or disconnected output nothing. Values are in mV or μA, depending on the mode of the
+channel (see channel_scales to convert them to V or A).
+
+Two forms are available:
+ - render(): samples at a fixed resolution, as an array of shape (n_trains, n_samples, STIMJIM_N_OUTPUTS)
+ - render_runs(): run-length form, i.e. the times at which the output changes and the values from these times on,
+   whose size only depends on the number of pulses and stages
+"""
+import numpy as np
+
+from src.StimJim import (
+    StimJimOutputModes,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_SCALING_FACTORS,
+)
+from src.TrainArrays import TrainArrays
+
+# modes in which the channel actually outputs the stage amplitudes
+WAVEFORM_ACTIVE_MODES = [StimJimOutputModes.VOLTAGE, StimJimOutputModes.CURRENT]
+
+
+def channel_scales(modes) -> np.ndarray:
+    """
+    Returns the factors converting the values of each channel (mV or μA) to V or A
+    """
+    modes = np.asarray(modes)
+    scales = np.array([1 / STIMJIM_SCALING_FACTORS[m] for m in StimJimOutputModes])
+    return scales[modes]
+
+
+def active_amps(arrays: TrainArrays) -> np.ndarray:
+    """
+    Returns the stage amplitudes (N, MAX_N_PHASES, STIMJIM_N_OUTPUTS), with 0 for missing stages and inactive channels
+    """
+    active = np.isin(arrays.modes, WAVEFORM_ACTIVE_MODES)  # (N, STIMJIM_N_OUTPUTS)
+    stage_exists = np.arange(TrainArrays.MAX_N_PHASES) < arrays.n_stages[:, None]  # (N, MAX_N_PHASES)
+    return arrays.amps * active[:, None, :] * stage_exists[:, :, None]
+
+
+def stage_edges_us(arrays: TrainArrays):
+    """
+    Returns the start and end of each stage relative to the start of the pulse, cut at the period, both of shape
+    (N, MAX_N_PHASES)
+    """
+    stage_us = np.where(
+        np.arange(TrainArrays.MAX_N_PHASES) < arrays.n_stages[:, None], arrays.stage_us, 0
+    )
+    ends = np.cumsum(stage_us, axis=1)
+    starts = ends - stage_us
+    limit = pulse_periods_us(arrays)[:, None]
+    return np.minimum(starts, limit), np.minimum(ends, limit)
+
+
+def pulse_periods_us(arrays: TrainArrays) -> np.ndarray:
+    """
+    Returns the time between pulses. A period of 0 means that the train has a single pulse
+    """
+    return np.where(arrays.period_us > 0, arrays.period_us, np.maximum(arrays.duration_us, 1))
+
+
+def pulse_counts(arrays: TrainArrays) -> np.ndarray:
+    """
+    Returns the number of pulses started during each train
+    """
+    period = pulse_periods_us(arrays)
+    return np.maximum(-(-arrays.duration_us // period), 0)
+
+
+def pulse_lengths_us(arrays: TrainArrays) -> np.ndarray:
+    """
+    Returns the length of the pulses (all the stages), cut at the period
+    """
+    return stage_edges_us(arrays)[1][:, -1]
+
+
+def render(
+    arrays: TrainArrays, resolution_us: float = 1.0, duration_us: float = None, dtype=np.int32
+):
+    """
+    Returns (t_us, samples), the sample times (n_samples,) and the values of the channels of all the trains
+    (n_trains, n_samples, STIMJIM_N_OUTPUTS), from 0 to duration_us (by default the duration of the longest train).
+    Memory grows with n_trains x n_samples, so long trains should be rendered with a coarse resolution or with
+    render_runs()
+    """
+    if duration_us is None:
+        duration_us = arrays.duration_us.max(initial=0)
+    t_us = np.arange(0, duration_us, resolution_us)
+    amps = active_amps(arrays).astype(dtype)
+    starts, ends = stage_edges_us(arrays)
+    period = pulse_periods_us(arrays)
+    phase = t_us[None, :] % period[:, None]  # (N, n_samples)
+    running = t_us[None, :] < arrays.duration_us[:, None]
+    samples = np.zeros((len(arrays), len(t_us), STIMJIM_N_OUTPUTS), dtype=dtype)
+    for j in range(TrainArrays.MAX_N_PHASES):
+        in_stage = running & (phase >= starts[:, j, None]) & (phase < ends[:, j, None])
+        samples += in_stage[:, :, None] * amps[:, None, j, :]
+    return t_us, samples
+
+
+class WaveformRuns(object):
+    """
+    Run-length waveforms of several trains, concatenated: the output of train i is values[k] from t_us[k] until
+    t_us[k + 1], for offsets[i] <= k < offsets[i + 1]. The last run of each train starts at the end of the train,
+    with all the channels at 0
+    """
+
+    def __init__(self, t_us, values, offsets):
+        self.t_us = t_us
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Returns (t_us, values) of train i
+        """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.t_us[start:stop], self.values[start:stop]
+
+
+def render_runs(arrays: TrainArrays) -> WaveformRuns:
+    n = len(arrays)
+    amps = active_amps(arrays)
+    starts, ends = stage_edges_us(arrays)
+    period = pulse_periods_us(arrays)
+    n_pulses = pulse_counts(arrays)
+    # every pulse has one edge at the start of each stage, and one when it goes back to 0
+    n_edges = arrays.n_stages + 1
+    counts = n_pulses * n_edges
+    train = np.repeat(np.arange(n), counts)
+    first = np.cumsum(counts) - counts
+    k = np.arange(counts.sum()) - first[train]
+    pulse, edge = np.divmod(k, n_edges[train])
+    is_stage = edge < arrays.n_stages[train]
+    stage = np.minimum(edge, TrainArrays.MAX_N_PHASES - 1)
+    t_us = pulse * period[train] + np.where(
+        is_stage, starts[train, stage], ends[train, arrays.n_stages[train] - 1]
+    )
+    values = np.where(is_stage[:, None], amps[train, stage], 0)
+
+    # edges are already in time order within each train. Add the end of each train, where everything goes back to 0
+    keep = t_us < arrays.duration_us[train]
+    train, t_us, values = train[keep], t_us[keep], values[keep]
+    train_ends = np.searchsorted(train, np.arange(n), side="right")
+    train = np.insert(train, train_ends, np.arange(n))
+    t_us = np.insert(t_us, train_ends, arrays.duration_us)
+    values = np.insert(values, train_ends, 0, axis=0)
+
+    # drop the runs that are immediately replaced (zero length), then merge consecutive runs with the same values
+    last_of_train = np.append(train[1:] != train[:-1], True)
+    next_t = np.append(t_us[1:], -1)
+    keep = last_of_train | (next_t != t_us)
+    train, t_us, values = train[keep], t_us[keep], values[keep]
+    first_of_train = np.insert(train[1:] != train[:-1], 0, True)
+    changed = np.insert(np.any(values[1:] != values[:-1], axis=1), 0, True)
+    keep = first_of_train | changed
+    # the end of the train is always kept, even when the output is already 0
+    keep |= np.append(train[1:] != train[:-1], True)
+    train, t_us, values = train[keep], t_us[keep], values[keep]
+
+    offsets = np.searchsorted(train, np.arange(n + 1))
+    return WaveformRuns(t_us, values, offsets)
+
+
+def decimate_minmax(t_us, values, t0_us: float, t1_us: float, n_bins: int):
+    """
+    Returns (mins, maxs), the extremes of a run-length waveform (t_us, values) in n_bins equal bins between t0_us and
+    t1_us, each of shape (n_bins, n_channels). This only depends on the number of runs and bins, not on the duration
+    """
+    edges = np.linspace(t0_us, t1_us, n_bins + 1)
+    # value at the start of each bin...
+    idx = np.searchsorted(t_us, edges[:-1], side="right") - 1
+    start_values = np.where((idx >= 0)[:, None], values[np.maximum(idx, 0)], 0)
+    mins = start_values.copy()
+    maxs = start_values.copy()
+    # ...and of the runs starting inside the bin
+    inside = (t_us > t0_us) & (t_us < t1_us)
+    bins = np.minimum(
+        ((t_us[inside] - t0_us) * (n_bins / (t1_us - t0_us))).astype(np.int64), n_bins - 1
+    )
+    if bins.size:
+        # the runs are in time order, so the runs of each bin are contiguous
+        firsts = np.flatnonzero(np.diff(bins, prepend=-1))
+        bins = bins[firsts]
+        values = values[inside]
+        mins[bins] = np.minimum(mins[bins], np.minimum.reduceat(values, firsts))
+        maxs[bins] = np.maximum(maxs[bins], np.maximum.reduceat(values, firsts))
+    return mins, maxs
@@ -0,0 +1,165 @@
+"""
+Preview of the output of a pulse train, drawn at screen resolution.
+
+The train is kept as a one-train TrainArrays, so that editing a stage only changes a few numbers. Its run-length
+waveform and the min/max decimation are computed lazily when the widget is painted, and repaints requested by a burst
+of edits (e.g. while scrolling the mouse wheel over a spin box) are merged by Qt into a single one per frame.
+The mouse wheel zooms around the cursor, double-click shows the whole train again.
+"""
+import time
+
+import numpy as np
+from PyQt5.QtCore import Qt, QPointF, QSize
+from PyQt5.QtGui import QPainter, QColor, QPolygonF, QPen
+from PyQt5.QtWidgets import QWidget, QSizePolicy
+
+from src.StimJim import (
+    PulseTrain,
+    STIMJIM_N_OUTPUTS,
+    STIMJIM_UNITS,
+    STIMJIM_DURATION_SCALING_FACTOR,
+)
+from src.TrainArrays import TrainArrays
+from src.Waveform import render_runs, decimate_minmax, channel_scales
+
+WAVEFORM_PREVIEW_COLORS = [QColor(31, 119, 180), QColor(214, 39, 40)]
+WAVEFORM_PREVIEW_MARGIN = 4
+WAVEFORM_PREVIEW_ZOOM_FACTOR = 1.25  # per wheel step
+WAVEFORM_PREVIEW_MIN_SPAN_US = 10
+
+
+class WaveformPreviewWidget(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.setMinimumHeight(80)
+        self.arrays = TrainArrays.empty(1)
+        self.last_render_ns = 0  # time taken by the last repaint
+        self._runs = None
+        self._bins = None  # (key, mins, maxs)
+        self._view = None  # (t0_us, t1_us), None for the whole train
+
+    def sizeHint(self):
+        return QSize(400, 120)
+
+    def set_pulse_train(self, pulse_train: PulseTrain):
+        self.arrays = TrainArrays.from_pulse_trains([pulse_train])
+        self._view = None
+        self._invalidate()
+
+    def set_mode(self, channel: int, mode: int):
+        self.arrays.modes[0, channel] = int(mode)
+        self._invalidate()
+
+    def set_timing(self, period_us: float = None, duration_us: float = None):
+        if period_us is not None:
+            self.arrays.period_us[0] = int(period_us)
+        if duration_us is not None:
+            self.arrays.duration_us[0] = int(duration_us)
+        self._invalidate()
+
+    def set_stage_value(self, row: int, column: int, value: float):
+        """
+        Changes one cell of the stages table: column 0 and 1 are the amplitudes (mV or μA), column 2 the duration (μs)
+        """
+        if row >= self.arrays.n_stages[0]:
+            return
+        cell = (
+            self.arrays.amps[0, row, column : column + 1]
+            if column < STIMJIM_N_OUTPUTS
+            else self.arrays.stage_us[0, row : row + 1]
+        )
+        if cell[0] != int(value):
+            cell[0] = int(value)
+            self._invalidate()
+
+    def _invalidate(self):
+        self._runs = None
+        self._bins = None
+        self.update()
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps == 0 or self.width() <= 2 * WAVEFORM_PREVIEW_MARGIN:
+            return
+        t0, t1 = self._get_view()
+        x = (event.pos().x() - WAVEFORM_PREVIEW_MARGIN) / (self.width() - 2 * WAVEFORM_PREVIEW_MARGIN)
+        center = t0 + min(max(x, 0.0), 1.0) * (t1 - t0)
+        span = max((t1 - t0) / WAVEFORM_PREVIEW_ZOOM_FACTOR ** steps, WAVEFORM_PREVIEW_MIN_SPAN_US)
+        full = self._get_duration_us()
+        if span >= full:
+            self._view = None
+        else:
+            t0 = min(max(center - (center - t0) * span / (t1 - t0), 0), full - span)
+            self._view = (t0, t0 + span)
+        self._bins = None
+        self.update()
+        event.accept()
+
+    def mouseDoubleClickEvent(self, event):
+        self._view = None
+        self._bins = None
+        self.update()
+
+    def _get_duration_us(self) -> float:
+        return max(float(self.arrays.duration_us[0]), 1.0)
+
+    def _get_view(self):
+        return self._view if self._view is not None else (0.0, self._get_duration_us())
+
+    def _get_bins(self, n_bins: int):
+        t0, t1 = self._get_view()
+        key = (n_bins, t0, t1)
+        if self._bins is None or self._bins[0] != key:
+            if self._runs is None:
+                self._runs = render_runs(self.arrays)[0]
+            mins, maxs = decimate_minmax(*self._runs, t0, t1, n_bins)
+            self._bins = (key, mins, maxs)
+        return self._bins[1], self._bins[2]
+
+    def paintEvent(self, event):
+        t_start = time.perf_counter_ns()
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        width = self.width() - 2 * WAVEFORM_PREVIEW_MARGIN
+        if width <= 0:
+            return
+        mins, maxs = self._get_bins(width)
+        lane_height = (self.height() - 2 * WAVEFORM_PREVIEW_MARGIN) / STIMJIM_N_OUTPUTS
+        scales = channel_scales(self.arrays.modes[0])
+        x = WAVEFORM_PREVIEW_MARGIN + np.arange(width)
+        for ch in range(STIMJIM_N_OUTPUTS):
+            top = WAVEFORM_PREVIEW_MARGIN + ch * lane_height
+            middle = top + lane_height / 2
+            full_scale = max(np.abs(mins[:, ch]).max(), np.abs(maxs[:, ch]).max(), 1)
+            y_scale = (lane_height / 2 - WAVEFORM_PREVIEW_MARGIN) / full_scale
+            painter.setPen(QPen(self.palette().mid().color(), 0, Qt.DotLine))
+            painter.drawLine(QPointF(x[0], middle), QPointF(x[-1], middle))
+            # envelope: the max of each pixel column from left to right, then the min from right to left
+            polygon = QPolygonF(2 * width)
+            # fill the points in place, building thousands of QPointF in Python is too slow
+            buffer = polygon.data()
+            buffer.setsize(2 * width * 2 * np.dtype(np.float64).itemsize)
+            points = np.frombuffer(buffer, dtype=np.float64).reshape(2, width, 2)
+            points[0, :, 0] = x
+            points[0, :, 1] = middle - maxs[:, ch] * y_scale
+            points[1, :, 0] = x[::-1]
+            points[1, :, 1] = middle - mins[::-1, ch] * y_scale
+            painter.setPen(QPen(WAVEFORM_PREVIEW_COLORS[ch], 0))
+            painter.setBrush(WAVEFORM_PREVIEW_COLORS[ch])
+            painter.drawPolygon(polygon)
+            mode = int(self.arrays.modes[0, ch])
+            painter.setPen(self.palette().text().color())
+            painter.drawText(
+                QPointF(WAVEFORM_PREVIEW_MARGIN * 2, top + painter.fontMetrics().ascent()),
+                f"CH {ch}  ±{full_scale * scales[ch]:.3g} {STIMJIM_UNITS[mode]}",
+            )
+        t0, t1 = self._get_view()
+        label = f"{t0 / STIMJIM_DURATION_SCALING_FACTOR:.6g} - {t1 / STIMJIM_DURATION_SCALING_FACTOR:.6g} s"
+        painter.drawText(
+            self.rect().adjusted(0, 0, -WAVEFORM_PREVIEW_MARGIN * 2, -WAVEFORM_PREVIEW_MARGIN),
+            Qt.AlignRight | Qt.AlignBottom,
+            label,
+        )
+        painter.end()
+        self.last_render_ns = time.perf_counter_ns() - t_start
@@ -23,7 +23,6 @@ import sys
 from decimal import Decimal as D  # Use decimal to avoid accumulating floating-point errors
 from decimal import ROUND_FLOOR
 
-import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 __all__ = ['ScienDSpinBox', 'ScienSpinBox']
@@ -252,8 +251,8 @@ class ScienDSpinBox(QtWidgets.QAbstractSpinBox):
     def __init__(self, *args, **kwargs):
         super(ScienDSpinBox, self).__init__(*args, **kwargs)
         self.__value = D('0.00')
-        self.__minimum = -np.inf
-        self.__maximum = np.inf
+        self.__minimum = -math.inf
+        self.__maximum = math.inf
         self.__decimals = 2  # default in QtDesigner
         self.__prefix = ''
         self.__suffix = ''
@@ -838,7 +837,7 @@ class ScienDSpinBox(QtWidgets.QAbstractSpinBox):
         :return: str, the formatted string representing the input value
         """
         # Catch infinity value
-        if np.isinf(float(value)):
+        if math.isinf(float(value)):
             if value < 0:
                 return '-inf '
             else:
@@ -1106,7 +1105,7 @@ class ScienSpinBox(QtWidgets.QAbstractSpinBox):
         Will perform range checking and ignore NaN values.
         Will emit valueChanged if the new value is different from the old one.
         """
-        if value is np.nan:
+        if isinstance(value, float) and math.isnan(value):
             return
 
         value = int(value)